@@ -6,12 +6,36 @@ Ferramenta interna para geração de anúncios e títulos para Google Ads.
 """
 
 import os
+import io
+import asyncio
+import bisect
+import contextvars
+import functools
+import csv
 import json
+import time
+import uuid
+import zlib
+import unicodedata
+import queue
 import random
-import requests
-from flask import Flask, request, jsonify, send_from_directory
+import sqlite3
+import hashlib
+import heapq
+import itertools
+import threading
+import importlib.util
+from typing import Annotated
+import httpx
+from urllib.parse import urlsplit
+from collections import Counter, OrderedDict, deque, namedtuple
+from contextlib import aclosing, asynccontextmanager, contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from flask import Flask, Response, g, request, jsonify, send_from_directory
 from flask_cors import CORS
-from openai import OpenAI
+from anthropic import APITimeoutError as AnthropicTimeoutError, Anthropic, AnthropicError, AsyncAnthropic
+from openai import APITimeoutError, AsyncOpenAI, OpenAI, OpenAIError
+from pydantic import BaseModel, StringConstraints, TypeAdapter, ValidationError
 from dotenv import load_dotenv
 from werkzeug.middleware.proxy_fix import ProxyFix
 import string
@@ -48,16 +72,1074 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "*").split(",")
 CORS(app, origins=allowed_origins, supports_credentials=True)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# =============================================================================
+# ARMAZENAMENTO LOCAL - SQLite e Cache em Dois Níveis
+# =============================================================================
+
+# Diretório dos bancos SQLite locais (cache, etc)
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+
+_sqlite_local = threading.local()
+
+
+def get_sqlite(name: str) -> sqlite3.Connection:
+    """Retorna a conexão SQLite da thread atual para o banco local `name`."""
+    connections = getattr(_sqlite_local, "connections", None)
+    if connections is None:
+        connections = _sqlite_local.connections = {}
+
+    if name not in connections:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(CACHE_DIR, f"{name}.sqlite3"), timeout=10)
+        # WAL permite leituras concorrentes entre workers do gunicorn
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        connections[name] = conn
+    return connections[name]
+
+
+class TieredCache:
+    """Cache em dois níveis (LRU em memória + SQLite em disco) com TTL e métricas."""
+
+    # A cada N escritas, remove expirados e aplica o limite de tamanho do disco
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, name: str, ttl: float, negative_ttl: float | None = None,
+                 max_memory_items: int = 1000, max_disk_items: int = 100000):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._metrics = {"memory_hits": 0, "disk_hits": 0, "negative_hits": 0,
+                         "misses": 0, "writes": 0, "evictions": 0}
+        self._db_ready = False
+
+    def _db(self) -> sqlite3.Connection:
+        conn = get_sqlite(self.name)
+        if not self._db_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    negative INTEGER NOT NULL DEFAULT 0,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache_entries (accessed_at)")
+            conn.commit()
+            self._db_ready = True
+        return conn
+
+    def _count(self, metric: str, amount: int = 1):
+        with self._lock:
+            self._metrics[metric] += amount
+
+    def _remember(self, key: str, value, negative: bool, expires_at: float):
+        with self._lock:
+            self._memory[key] = (value, negative, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+                self._metrics["evictions"] += 1
+
+    def get(self, key: str) -> tuple:
+        """Retorna (encontrado, valor). Entradas expiradas contam como miss."""
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[2] > now:
+                self._memory.move_to_end(key)
+                self._metrics["negative_hits" if entry[1] else "memory_hits"] += 1
+                metrics.inc("cache_requests_total", cache=self.name, result="negative_hit" if entry[1] else "memory_hit")
+                return True, entry[0]
+            if entry:
+                del self._memory[key]
+
+        try:
+            conn = self._db()
+            row = conn.execute(
+                "SELECT value, negative, expires_at FROM cache_entries WHERE key = ? AND expires_at > ?",
+                (key, now)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE cache_entries SET accessed_at = ? WHERE key = ?", (now, key))
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"[Cache:{self.name}] Erro ao ler do disco: {e}")
+            row = None
+
+        if not row:
+            self._count("misses")
+            metrics.inc("cache_requests_total", cache=self.name, result="miss")
+            return False, None
+
+        value = json.loads(row[0])
+        self._remember(key, value, bool(row[1]), row[2])
+        self._count("negative_hits" if row[1] else "disk_hits")
+        metrics.inc("cache_requests_total", cache=self.name, result="negative_hit" if row[1] else "disk_hit")
+        return True, value
+
+    def set(self, key: str, value, negative: bool = False, ttl: float | None = None):
+        """Grava o valor nos dois níveis. Resultados negativos usam o TTL curto."""
+        now = time.time()
+        if ttl is None:
+            ttl = self.negative_ttl if negative else self.ttl
+        expires_at = now + ttl
+
+        self._remember(key, value, negative, expires_at)
+        self._count("writes")
+
+        try:
+            conn = self._db()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (key, value, negative, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), int(negative), expires_at, now)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"[Cache:{self.name}] Erro ao gravar no disco: {e}")
+            return
+
+        with self._lock:
+            self._writes += 1
+            run_eviction = self._writes % self.EVICTION_INTERVAL == 0
+        if run_eviction:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        try:
+            conn = self._db()
+            removed = conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),)).rowcount
+            removed += conn.execute("""
+                DELETE FROM cache_entries WHERE key IN (
+                    SELECT key FROM cache_entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_disk_items,)).rowcount
+            conn.commit()
+            self._count("evictions", removed)
+        except sqlite3.Error as e:
+            print(f"[Cache:{self.name}] Erro na limpeza do disco: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["memory_items"] = len(self._memory)
+        hits = metrics["memory_hits"] + metrics["disk_hits"] + metrics["negative_hits"]
+        total = hits + metrics["misses"]
+        metrics["hit_ratio"] = round(hits / total, 4) if total else 0.0
+        return metrics
+
+
+# Single-flight: requisições idênticas e simultâneas compartilham uma única execução
+# SINGLEFLIGHT_ENABLED: liga a deduplicação (varreduras A-Z e chamadas à IA)
+# SINGLEFLIGHT_CROSS_PROCESS: também entre os workers do gunicorn (lease + resultado no SQLite)
+# SINGLEFLIGHT_POLL_INTERVAL: segundos entre as consultas de quem espera outro worker
+# SINGLEFLIGHT_RESULT_TTL: segundos que o resultado compartilhado fica disponível para os outros workers
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+SINGLEFLIGHT_CROSS_PROCESS = os.getenv("SINGLEFLIGHT_CROSS_PROCESS", "true").lower() == "true"
+SINGLEFLIGHT_POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", "0.1"))
+SINGLEFLIGHT_RESULT_TTL = float(os.getenv("SINGLEFLIGHT_RESULT_TTL", "60"))
+
+
+class Flight:
+    """Participação em um single-flight: o líder executa e publica; os demais recebem `result`."""
+
+    def __init__(self, group, key: str, leader: bool, result=None, future=None, owner: str | None = None):
+        self.group = group
+        self.key = key
+        self.leader = leader
+        self.result = result
+        self._future = future
+        self._owner = owner
+        self._done = not leader
+
+    def finish(self, result):
+        """Publica o resultado para quem está esperando (neste e nos outros workers)."""
+        if not self._done:
+            self._done = True
+            self.group._complete(self.key, self._future, self._owner, result)
+
+    def abandon(self):
+        """Desiste sem resultado (erro ou cancelamento): quem espera tenta executar por conta própria."""
+        if not self._done:
+            self._done = True
+            self.group._complete(self.key, self._future, self._owner, None, shared=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.abandon()
+        return False
+
+
+class SingleFlight:
+    """Deduplica execuções idênticas em andamento.
+
+    No processo, quem chega durante uma execução espera o mesmo Future; entre
+    workers, um lease no SQLite elege o líder e os demais leem o resultado que
+    ele grava. Se o líder falhar, um dos que esperam assume.
+    """
+
+    def __init__(self, name: str, lease_ttl: float):
+        self.name = name
+        self.lease_ttl = lease_ttl
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._async_inflight = {}
+        self._db_ready = False
+
+    def _db(self) -> sqlite3.Connection:
+        conn = get_sqlite("singleflight")
+        if not self._db_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS flight_leases (
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (name, key)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS flight_results (
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    finished_at REAL NOT NULL,
+                    PRIMARY KEY (name, key)
+                )
+            """)
+            conn.commit()
+            self._db_ready = True
+        return conn
+
+    def _try_lease(self, key: str, owner: str) -> bool:
+        now = time.time()
+        conn = self._db()
+        conn.execute("DELETE FROM flight_leases WHERE name = ? AND key = ? AND expires_at <= ?", (self.name, key, now))
+        acquired = conn.execute("INSERT OR IGNORE INTO flight_leases (name, key, owner, expires_at) VALUES (?, ?, ?, ?)",
+                                (self.name, key, owner, now + self.lease_ttl)).rowcount == 1
+        conn.commit()
+        return acquired
+
+    def _release_lease(self, key: str, owner: str):
+        conn = self._db()
+        conn.execute("DELETE FROM flight_leases WHERE name = ? AND key = ? AND owner = ?", (self.name, key, owner))
+        conn.commit()
+
+    def _read_result(self, key: str, since: float) -> tuple:
+        # Só vale resultado concluído depois que este pedido começou a esperar
+        row = self._db().execute("SELECT value FROM flight_results WHERE name = ? AND key = ? AND finished_at >= ?",
+                                 (self.name, key, since)).fetchone()
+        return (True, json.loads(row[0])) if row else (False, None)
+
+    def _poll_lease(self, key: str, owner: str, since: float, deadline: float):
+        """Uma rodada da disputa: ("lead", owner), ("result", valor) ou None para esperar mais."""
+        try:
+            if self._try_lease(key, owner):
+                # O líder anterior grava o resultado e libera o lease no mesmo commit
+                found, value = self._read_result(key, since)
+                if not found:
+                    return "lead", owner
+                self._release_lease(key, owner)
+                return "result", value
+            found, value = self._read_result(key, since)
+            if found:
+                return "result", value
+        except sqlite3.Error as e:
+            print(f"[SingleFlight:{self.name}] Erro no SQLite, executando sem coordenação: {e}")
+            return "lead", None
+        if time.monotonic() >= deadline:
+            # Líder de outro worker sumiu sem liberar o lease: executa mesmo assim
+            metrics.inc("singleflight_total", flight=self.name, role="lease_timeout")
+            return "lead", None
+        return None
+
+    def _lease_args(self, key: str, timeout: float | None) -> tuple:
+        wait = self.lease_ttl if timeout is None else min(self.lease_ttl, timeout)
+        return key, f"{os.getpid()}:{uuid.uuid4().hex}", time.time(), time.monotonic() + wait
+
+    def _follower_timeout(self):
+        metrics.inc("singleflight_total", flight=self.name, role="follower_timeout")
+        record_cut(f"singleflight.{self.name}", "timeout")
+        return DeadlineExceeded(f"Prazo esgotado esperando a execução compartilhada ({self.name})")
+
+    def _joined(self, key: str, future, role: str, value) -> Flight:
+        if role == "result":
+            self._complete(key, future, None, value)
+            metrics.inc("singleflight_total", flight=self.name, role="follower_remote")
+            return Flight(self, key, leader=False, result=value)
+        metrics.inc("singleflight_total", flight=self.name, role="leader")
+        return Flight(self, key, leader=True, future=future, owner=value)
+
+    def begin(self, key: str, timeout: float | None = None) -> Flight:
+        """Entra no single-flight de `key`: retorna como líder ou já com o resultado compartilhado.
+
+        Com `timeout`, quem espera o líder deste processo desiste após esse tempo
+        (DeadlineExceeded); o de outro worker passa a executar por conta própria.
+        """
+        if not SINGLEFLIGHT_ENABLED:
+            return Flight(self, key, leader=True)
+
+        wait_until = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                future = self._inflight.get(key)
+                local_leader = future is None
+                if local_leader:
+                    future = self._inflight[key] = Future()
+
+            if not local_leader:
+                try:
+                    shared, value = future.result(
+                        timeout=None if wait_until is None else max(0.0, wait_until - time.monotonic())
+                    )
+                except TimeoutError:
+                    raise self._follower_timeout()
+                if shared:
+                    metrics.inc("singleflight_total", flight=self.name, role="follower_local")
+                    return Flight(self, key, leader=False, result=value)
+                continue  # o líder desistiu: disputa de novo
+
+            outcome = ("lead", None)
+            if SINGLEFLIGHT_CROSS_PROCESS:
+                lease = self._lease_args(key, None if wait_until is None else wait_until - time.monotonic())
+                while (outcome := self._poll_lease(*lease)) is None:
+                    time.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+            return self._joined(key, future, *outcome)
+
+    async def begin_async(self, key: str, timeout: float | None = None) -> Flight:
+        """Versão assíncrona de begin (espera e consulta o lease sem bloquear o event loop)."""
+        if not SINGLEFLIGHT_ENABLED:
+            return Flight(self, key, leader=True)
+
+        wait_until = None if timeout is None else time.monotonic() + timeout
+        while True:
+            future = self._async_inflight.get(key)
+            if future is not None:
+                try:
+                    shared, value = await asyncio.wait_for(
+                        asyncio.shield(future),
+                        timeout=None if wait_until is None else max(0.0, wait_until - time.monotonic())
+                    )
+                except TimeoutError:
+                    raise self._follower_timeout()
+                if shared:
+                    metrics.inc("singleflight_total", flight=self.name, role="follower_local")
+                    return Flight(self, key, leader=False, result=value)
+                continue
+            future = self._async_inflight[key] = asyncio.get_running_loop().create_future()
+
+            outcome = ("lead", None)
+            if SINGLEFLIGHT_CROSS_PROCESS:
+                lease = self._lease_args(key, None if wait_until is None else wait_until - time.monotonic())
+                # O SQLite roda em uma thread; a espera entre as rodadas, no event loop
+                while (outcome := await asyncio.to_thread(self._poll_lease, *lease)) is None:
+                    await asyncio.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+            return self._joined(key, future, *outcome)
+
+    def _complete(self, key: str, future, owner: str | None, value, shared: bool = True):
+        if owner:
+            try:
+                conn = self._db()
+                if shared:
+                    now = time.time()
+                    conn.execute("INSERT OR REPLACE INTO flight_results (name, key, value, finished_at) "
+                                 "VALUES (?, ?, ?, ?)", (self.name, key, json.dumps(value, ensure_ascii=False), now))
+                    conn.execute("DELETE FROM flight_results WHERE finished_at < ?", (now - SINGLEFLIGHT_RESULT_TTL,))
+                conn.execute("DELETE FROM flight_leases WHERE name = ? AND key = ? AND owner = ?", (self.name, key, owner))
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"[SingleFlight:{self.name}] Erro ao publicar resultado: {e}")
+
+        if future is None:
+            return
+        # Sai do mapa antes de avisar: quem chegar depois começa uma execução nova
+        with self._lock:
+            if isinstance(future, asyncio.Future):
+                if self._async_inflight.get(key) is future:
+                    del self._async_inflight[key]
+            elif self._inflight.get(key) is future:
+                del self._inflight[key]
+        if not future.done():
+            future.set_result((shared, value))
+
+
+# =============================================================================
+# OBSERVABILIDADE - Tracing por Requisição e Métricas (Prometheus)
+# =============================================================================
+
+# METRICS_ENABLED: coleta de métricas e endpoint /metrics
+# METRICS_FLUSH_INTERVAL: segundos entre as gravações das métricas do worker no SQLite
+#   (o /metrics soma as métricas de todos os workers do gunicorn)
+# METRICS_WORKER_TTL: workers sem gravar há mais que isso (segundos) saem da soma
+# TRACE_LOG: imprime um resumo por requisição ("[Trace <id>] POST /full_pipeline 200 ...")
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+METRICS_WORKER_TTL = float(os.getenv("METRICS_WORKER_TTL", "86400"))
+TRACE_LOG = os.getenv("TRACE_LOG", "true").lower() == "true"
+
+METRICS_PREFIX = "gerador"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# nome -> (tipo, descrição)
+METRICS_HELP = {
+    "http_request_duration_seconds": ("histogram", "Duração das requisições HTTP por endpoint"),
+    "stage_duration_seconds": ("histogram", "Duração de cada etapa (sondagens, cascata, IA, parsing)"),
+    "cache_requests_total": ("counter", "Consultas aos caches por resultado"),
+    "scraper_requests_total": ("counter", "Chamadas ao Google Autocomplete por resultado"),
+    "cascade_stage_total": ("counter", "Estágios da cascata de fallback por status"),
+    "llm_requests_total": ("counter", "Chamadas à IA por saída e resultado"),
+    "llm_tokens_total": ("counter", "Tokens consumidos na IA por saída e tipo"),
+    "requests_rejected_total": ("counter", "Requisições recusadas com 503 por saturação do worker"),
+    "singleflight_total": ("counter", "Execuções deduplicadas por single-flight (líder ou carona)"),
+    "autocomplete_sweeps_total": ("counter", "Varreduras do autocomplete por modo e motivo de parada"),
+    "keyword_corpus_total": ("counter", "Consultas ao corpus de keywords (fresh, stale ou miss)"),
+    "history_reuse_total": ("counter", "Pedidos com \"reuse\" atendidos (hit) ou não (miss) pelo histórico"),
+    "deadline_cuts_total": ("counter", "Etapas puladas ou encurtadas pelo prazo da requisição"),
+    "llm_first_token_seconds": ("histogram", "Tempo até o primeiro token da IA por provedor e modelo"),
+    "llm_hedge_total": ("counter", "Chamadas à IA com hedge por resultado (not_needed, primary_won, hedge_won, failover)"),
+    "llm_queue_wait_seconds": ("histogram", "Espera por uma vaga na fila justa da IA por fila (interactive/batch)"),
+    "llm_scheduler_rejected_total": ("counter", "Chamadas à IA recusadas por falta de vaga no prazo ou de orçamento"),
+}
+
+
+class MetricsRegistry:
+    """Contadores e histogramas do processo, somados entre os workers via SQLite."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._last_flush = 0.0
+        self._db_ready = False
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Registra uma duração no histograma (contagem por bucket, soma e total)."""
+        if not METRICS_ENABLED:
+            return
+        key = self._key(name, labels)
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            values = self._histograms.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 3))
+            values[index] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, list(labels), list(values)] for (name, labels), values in self._histograms.items()]
+            }
+
+    def _db(self) -> sqlite3.Connection:
+        conn = get_sqlite("metrics")
+        if not self._db_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metrics_workers (
+                    pid INTEGER PRIMARY KEY,
+                    snapshot TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.commit()
+            self._db_ready = True
+        return conn
+
+    def flush(self, force: bool = False):
+        """Grava as métricas deste worker (no máximo a cada METRICS_FLUSH_INTERVAL segundos)."""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_flush < METRICS_FLUSH_INTERVAL:
+                return
+            self._last_flush = now
+        try:
+            conn = self._db()
+            conn.execute("INSERT OR REPLACE INTO metrics_workers (pid, snapshot, updated_at) VALUES (?, ?, ?)",
+                         (os.getpid(), json.dumps(self.snapshot()), now))
+            conn.execute("DELETE FROM metrics_workers WHERE updated_at < ?", (now - METRICS_WORKER_TTL,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"[Métricas] Erro ao gravar: {e}")
+
+    def collect(self) -> tuple:
+        """Soma as métricas de todos os workers. Retorna (contadores, histogramas)."""
+        self.flush(force=True)
+        try:
+            rows = self._db().execute("SELECT snapshot FROM metrics_workers WHERE updated_at >= ?",
+                                      (time.time() - METRICS_WORKER_TTL,)).fetchall()
+            snapshots = [json.loads(row[0]) for row in rows]
+        except sqlite3.Error as e:
+            print(f"[Métricas] Erro ao ler: {e}")
+            snapshots = [self.snapshot()]
+
+        counters, histograms = {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                total = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+        return counters, histograms
+
+    def render(self) -> str:
+        """Métricas no formato texto do Prometheus."""
+        counters, histograms = self.collect()
+
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+            return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + "}"
+
+        lines = []
+        for name, (kind, description) in METRICS_HELP.items():
+            metric = f"{METRICS_PREFIX}_{name}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            if kind == "counter":
+                for (series, labels), value in sorted(counters.items()):
+                    if series == name:
+                        lines.append(f"{metric}{fmt_labels(labels)} {value:g}")
+                continue
+            for (series, labels), values in sorted(histograms.items()):
+                if series != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(LATENCY_BUCKETS) + ["+Inf"], values[:-2]):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{fmt_labels(labels, [('le', bound)])} {cumulative:g}")
+                lines.append(f"{metric}_sum{fmt_labels(labels)} {values[-2]:.6f}")
+                lines.append(f"{metric}_count{fmt_labels(labels)} {values[-1]:g}")
+
+        # Taxa de acerto por cache (derivada de cache_requests_total)
+        metric = f"{METRICS_PREFIX}_cache_hit_ratio"
+        lines.append(f"# HELP {metric} Proporção de consultas respondidas pelo cache")
+        lines.append(f"# TYPE {metric} gauge")
+        totals = {}
+        for (series, labels), value in counters.items():
+            if series == "cache_requests_total":
+                labels = dict(labels)
+                hits, total = totals.get(labels["cache"], (0, 0))
+                totals[labels["cache"]] = (hits + (value if labels["result"] != "miss" else 0), total + value)
+        for cache_name, (hits, total) in sorted(totals.items()):
+            lines.append(f'{metric}{{cache="{cache_name}"}} {hits / total if total else 0:.4f}')
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+class RequestTrace:
+    """Etapas cronometradas de uma requisição (ou job), identificadas por um request id."""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            count, total = self._stages.get(stage, (0, 0.0))
+            self._stages[stage] = (count + 1, total + seconds)
+
+    def summary(self) -> str:
+        with self._lock:
+            stages = sorted(self._stages.items(), key=lambda item: -item[1][1])
+        return ", ".join(f"{stage} {count}x {total * 1000:.0f}ms" for stage, (count, total) in stages)
+
+    def server_timing(self) -> str:
+        """Valor do header Server-Timing (tempo somado de cada etapa)."""
+        with self._lock:
+            stages = list(self._stages.items())
+        return ", ".join(f'{stage};dur={total * 1000:.1f};desc="{count}x"' for stage, (count, total) in stages)
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+REQUEST_ID_ALLOWED = set(string.ascii_letters + string.digits + "-_.")
+
+
+def new_request_id(incoming: str | None = None) -> str:
+    """Reaproveita o X-Request-ID recebido (se for seguro) ou gera um novo."""
+    if incoming and len(incoming) <= 64 and set(incoming) <= REQUEST_ID_ALLOWED:
+        return incoming
+    return uuid.uuid4().hex
+
+
+def record_stage(stage: str, seconds: float):
+    """Registra a duração de uma etapa no histograma e no trace da requisição atual."""
+    metrics.observe("stage_duration_seconds", seconds, stage=stage)
+    trace = current_trace.get()
+    if trace:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def trace_span(stage: str):
+    """Cronometra o bloco como uma etapa (ex: "autocomplete_probe", "llm_call.assets")."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def with_trace(fn):
+    """Envolve `fn` para rodar em outra thread com o trace da thread atual."""
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+# =============================================================================
+# DEADLINE - Orçamento de Tempo por Requisição
+# =============================================================================
+# Cada execução do pipeline, de /generate_assets e de /generate_winning_ads tem um
+# prazo total, propagado (como o trace) para as sondagens do autocomplete, os
+# estágios da cascata e as chamadas à IA. Com pouco tempo restante, as etapas
+# recebem timeouts menores, são puladas ou devolvem o parcial; a resposta lista o
+# que foi encurtado em "deadline.cut_short".
+# PIPELINE_DEADLINE: prazo padrão (segundos) dessas requisições; 0 = sem prazo.
+#   Mantenha abaixo do GUNICORN_TIMEOUT (trabalho que passa disso ninguém recebe)
+# PIPELINE_DEADLINE_MAX: maior prazo aceito no campo "deadline" da requisição
+# DEADLINE_KEYWORDS_SHARE: fração do prazo que a cascata de keywords pode usar
+#   (o restante fica reservado para a Ad-Intelligence)
+# DEADLINE_MIN_LLM_CALL: tempo mínimo (segundos) para iniciar uma chamada à IA;
+#   com menos que isso a chamada é pulada
+PIPELINE_DEADLINE = float(os.getenv("PIPELINE_DEADLINE", "90"))
+PIPELINE_DEADLINE_MAX = float(os.getenv("PIPELINE_DEADLINE_MAX", "300"))
+DEADLINE_KEYWORDS_SHARE = float(os.getenv("DEADLINE_KEYWORDS_SHARE", "0.5"))
+DEADLINE_MIN_LLM_CALL = float(os.getenv("DEADLINE_MIN_LLM_CALL", "2"))
+
+
+class DeadlineExceeded(TimeoutError):
+    """O prazo da requisição acabou antes (ou durante) uma etapa."""
+
+
+class Deadline:
+    """Prazo absoluto de uma requisição e registro das etapas encurtadas por ele.
+
+    `within(share)` cria um sub-prazo (ex: só a cascata de keywords) que
+    registra os cortes no mesmo relatório.
+    """
+
+    def __init__(self, seconds: float, expires_at: float | None = None, parent=None):
+        self.budget = seconds
+        self.started = time.monotonic()
+        self.expires_at = self.started + seconds if expires_at is None else expires_at
+        self._root = parent._root if parent else self
+        self._lock = threading.Lock()
+        self._cuts = []
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def within(self, share: float):
+        """Sub-prazo que termina após `share` do tempo restante."""
+        return Deadline(self.budget, self.started + (self.expires_at - self.started) * share, parent=self)
+
+    def cut(self, stage: str, action: str, **details):
+        """Registra uma etapa pulada ("skipped"), parcial ("partial") ou sem resultado ("timeout")."""
+        root = self._root
+        with root._lock:
+            root._cuts.append({"stage": stage, "action": action, **details})
+        metrics.inc("deadline_cuts_total", stage=stage, action=action)
+        print(f"[Deadline] Etapa '{stage}' encurtada ({action}) com {self.remaining() * 1000:.0f}ms restantes")
+
+    @property
+    def cuts(self) -> list:
+        root = self._root
+        with root._lock:
+            return list(root._cuts)
+
+    def report(self) -> dict:
+        root = self._root
+        return {
+            "budget_s": root.budget,
+            "elapsed_ms": int((time.monotonic() - root.started) * 1000),
+            "cut_short": root.cuts
+        }
+
+
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+def deadline_remaining(limit: float | None = None) -> float | None:
+    """Tempo restante do prazo atual limitado a `limit` (sem prazo: o próprio `limit`)."""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return limit
+    return deadline.remaining() if limit is None else min(limit, deadline.remaining())
+
+
+def deadline_expired() -> bool:
+    deadline = current_deadline.get()
+    return deadline is not None and deadline.expired()
+
+
+def record_cut(stage: str, action: str, **details):
+    """Registra no prazo atual (se houver) que a etapa foi encurtada."""
+    deadline = current_deadline.get()
+    if deadline:
+        deadline.cut(stage, action, **details)
+
+
+@contextmanager
+def deadline_scope(deadline: Deadline | None):
+    """Define o prazo das etapas executadas no bloco (e nas threads criadas com with_trace)."""
+    token = current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        current_deadline.reset(token)
+
+
+def make_deadline(seconds: float | None = None) -> Deadline | None:
+    """Prazo de uma requisição: `seconds` ou PIPELINE_DEADLINE (None se 0 = sem prazo)."""
+    budget = PIPELINE_DEADLINE if seconds is None else seconds
+    return Deadline(budget) if budget > 0 else None
+
+
+def parse_deadline(value) -> tuple:
+    """Lê o campo "deadline" (segundos). Retorna (segundos ou None, erro)."""
+    if value in (None, ""):
+        return None, None
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        seconds = -1.0
+    if not 0 < seconds <= PIPELINE_DEADLINE_MAX:
+        return None, f"O campo 'deadline' deve ser um número de segundos entre 0 e {PIPELINE_DEADLINE_MAX:g}"
+    return seconds, None
+
+
+def deadline_exceeded_response(e: DeadlineExceeded, deadline: Deadline | None):
+    """Resposta 504 para uma chamada à IA sem resultado dentro do prazo da requisição."""
+    body = {"success": False, "error": str(e)}
+    if deadline:
+        body["deadline"] = deadline.report()
+    return jsonify(body), 504
 
 
 # =============================================================================
 # DATA HUNTER - Scraper de Google Autocomplete
 # =============================================================================
 
-def get_google_autocomplete(query: str) -> list:
-    """Busca sugestões do Google Autocomplete para uma query."""
-    url = "http://suggestqueries.google.com/complete/search"
+AUTOCOMPLETE_URL = os.getenv("AUTOCOMPLETE_URL", "https://suggestqueries.google.com/complete/search")
+
+# Pool de conexões HTTP compartilhado pelo Data Hunter
+# HTTP_POOL_MAX_CONNECTIONS: total de conexões abertas no pool
+# HTTP_POOL_MAX_KEEPALIVE: conexões ociosas mantidas vivas para reuso
+# HTTP_POOL_KEEPALIVE_EXPIRY: segundos que uma conexão ociosa fica no pool
+# HTTP_MAX_CONNECTIONS_PER_HOST: requisições simultâneas por host (a espera pela vaga conta no timeout)
+# HTTP2_ENABLED: usa HTTP/2 (pacote "h2", de httpx[http2]); sem ele, HTTP/1.1
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "20"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "10"))
+HTTP_POOL_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY", "30"))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "10"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+
+
+class PooledHTTPClient:
+    """Cliente HTTP thread-safe com keep-alive, limite por host e contadores de reuso."""
+
+    def __init__(self, max_connections: int, max_keepalive: int, keepalive_expiry: float,
+                 max_per_host: int, http2: bool = True, timeout: float = 5):
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        self.max_per_host = max(1, max_per_host)
+        self.timeout = timeout
+        self._client = httpx.Client(
+            http2=self.http2,
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        )
+        self._lock = threading.Lock()
+        self._host_slots = {}
+        self._counters = {"requests": 0, "new_connections": 0, "reused_connections": 0, "http2_requests": 0,
+                          "errors": 0, "host_slot_timeouts": 0}
+
+    def _slot_for(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def _incr(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def get(self, url: str, timeout: float | None = None, **kwargs) -> httpx.Response:
+        """GET pelo pool. A espera pela vaga do host e a requisição somam no máximo `timeout` (e o prazo atual)."""
+        timeout = deadline_remaining(self.timeout if timeout is None else timeout)
+        started = time.monotonic()
+        slot = self._slot_for(url)
+        if not slot.acquire(timeout=max(0.0, timeout)):
+            self._incr("host_slot_timeouts")
+            raise httpx.PoolTimeout(f"Sem vaga para {urlsplit(url).netloc} em {timeout:.1f}s")
+        # httpcore só emite "connection.connect_tcp" quando abre um socket novo; se a
+        # requisição chega a enviar os headers sem ele, reusou uma conexão do pool
+        connection = {"new": False, "sent": False}
+
+        def trace(event_name: str, info: dict):
+            if event_name == "connection.connect_tcp.complete":
+                connection["new"] = True
+            elif event_name.endswith("send_request_headers.complete"):
+                connection["sent"] = True
+
+        try:
+            self._incr("requests")
+            remaining = max(0.001, timeout - (time.monotonic() - started))
+            response = self._client.get(url, timeout=remaining, extensions={"trace": trace}, **kwargs)
+        except Exception:
+            self._incr("errors")
+            raise
+        finally:
+            slot.release()
+            if connection["new"]:
+                self._incr("new_connections")
+            elif connection["sent"]:
+                self._incr("reused_connections")
+        if response.http_version == "HTTP/2":
+            self._incr("http2_requests")
+        return response
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+        counters["http2"] = self.http2
+        counters["max_connections_per_host"] = self.max_per_host
+        return counters
+
+
+http_pool = PooledHTTPClient(
+    max_connections=HTTP_POOL_MAX_CONNECTIONS,
+    max_keepalive=HTTP_POOL_MAX_KEEPALIVE,
+    keepalive_expiry=HTTP_POOL_KEEPALIVE_EXPIRY,
+    max_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+    http2=HTTP2_ENABLED,
+)
+
+
+# Cache de sugestões por query (memória + SQLite)
+# AUTOCOMPLETE_CACHE_TTL: validade (segundos) de uma query com sugestões
+# AUTOCOMPLETE_CACHE_NEGATIVE_TTL: validade de queries vazias ou que falharam
+AUTOCOMPLETE_CACHE_TTL = float(os.getenv("AUTOCOMPLETE_CACHE_TTL", "86400"))
+AUTOCOMPLETE_CACHE_NEGATIVE_TTL = float(os.getenv("AUTOCOMPLETE_CACHE_NEGATIVE_TTL", "900"))
+AUTOCOMPLETE_CACHE_MEMORY_ITEMS = int(os.getenv("AUTOCOMPLETE_CACHE_MEMORY_ITEMS", "5000"))
+AUTOCOMPLETE_CACHE_DISK_ITEMS = int(os.getenv("AUTOCOMPLETE_CACHE_DISK_ITEMS", "200000"))
+
+autocomplete_cache = TieredCache(
+    "autocomplete",
+    ttl=AUTOCOMPLETE_CACHE_TTL,
+    negative_ttl=AUTOCOMPLETE_CACHE_NEGATIVE_TTL,
+    max_memory_items=AUTOCOMPLETE_CACHE_MEMORY_ITEMS,
+    max_disk_items=AUTOCOMPLETE_CACHE_DISK_ITEMS,
+)
+
+# Renovação do corpus de keywords: ignora o cache na leitura (mas grava o resultado novo)
+autocomplete_refresh = contextvars.ContextVar("autocomplete_refresh", default=False)
+
+
+# Proteção contra bloqueio do Google (compartilhada entre workers via SQLite)
+# SCRAPER_RATE_PER_SEC / SCRAPER_RATE_BURST: token bucket de chamadas ao autocomplete
+# SCRAPER_RATE_MAX_WAIT: espera máxima (segundos) por um token antes de desistir da query
+# SCRAPER_MAX_RETRIES: novas tentativas em 429/5xx/timeout (backoff exponencial com jitter)
+# SCRAPER_BREAKER_THRESHOLD: falhas seguidas que abrem o circuit breaker
+# SCRAPER_BREAKER_COOLDOWN: segundos com o scraper desligado após abrir o breaker
+SCRAPER_RATE_PER_SEC = float(os.getenv("SCRAPER_RATE_PER_SEC", "10"))
+SCRAPER_RATE_BURST = float(os.getenv("SCRAPER_RATE_BURST", "20"))
+SCRAPER_RATE_MAX_WAIT = float(os.getenv("SCRAPER_RATE_MAX_WAIT", "3"))
+SCRAPER_MAX_RETRIES = int(os.getenv("SCRAPER_MAX_RETRIES", "2"))
+SCRAPER_BACKOFF_BASE = float(os.getenv("SCRAPER_BACKOFF_BASE", "0.5"))
+SCRAPER_BACKOFF_MAX = float(os.getenv("SCRAPER_BACKOFF_MAX", "4"))
+SCRAPER_BREAKER_THRESHOLD = int(os.getenv("SCRAPER_BREAKER_THRESHOLD", "5"))
+SCRAPER_BREAKER_COOLDOWN = float(os.getenv("SCRAPER_BREAKER_COOLDOWN", "120"))
+
+
+class ScraperThrottled(Exception):
+    """O Google respondeu 429/5xx (ou a conexão falhou): não é um resultado vazio real."""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ScraperInvalidResponse(Exception):
+    """O Google respondeu outro erro HTTP ou um corpo que não é o JSON do autocomplete."""
+
+
+_scraper_state_ready = False
+
+
+def scraper_state_db() -> sqlite3.Connection:
+    """Banco compartilhado do rate limiter e do circuit breaker."""
+    global _scraper_state_ready
+    conn = get_sqlite("scraper_state")
+    if not _scraper_state_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS token_buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS circuit_breakers (
+                name TEXT PRIMARY KEY,
+                failures INTEGER NOT NULL DEFAULT 0,
+                opened_until REAL NOT NULL DEFAULT 0
+            )
+        """)
+        conn.commit()
+        _scraper_state_ready = True
+    return conn
+
+
+class SharedTokenBucket:
+    """Token bucket cujo estado fica no SQLite, valendo para todos os workers do gunicorn."""
+
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, burst)
+
+    def _try_acquire(self) -> float:
+        """Consome um token. Retorna 0 se conseguiu, senão os segundos até o próximo token."""
+        conn = scraper_state_db()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (self.name,)).fetchone()
+            tokens = self.burst if not row else min(self.burst, row[0] + (now - row[1]) * self.rate)
+            wait_time = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait_time = (1 - tokens) / self.rate
+            conn.execute(
+                "INSERT OR REPLACE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                (self.name, tokens, now)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return wait_time
+
+    def acquire(self, timeout: float) -> bool:
+        """Espera até `timeout` segundos por um token."""
+        if self.rate <= 0:
+            return True
+        expires_at = time.monotonic() + timeout
+        while True:
+            wait_time = self._try_acquire()
+            if wait_time == 0:
+                return True
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(wait_time, remaining))
+
+
+class SharedCircuitBreaker:
+    """Circuit breaker compartilhado: após N falhas seguidas, desliga o recurso por um tempo."""
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+
+    def is_open(self) -> bool:
+        row = scraper_state_db().execute(
+            "SELECT opened_until FROM circuit_breakers WHERE name = ?", (self.name,)
+        ).fetchone()
+        return bool(row) and row[0] > time.time()
+
+    def record_success(self):
+        conn = scraper_state_db()
+        conn.execute("UPDATE circuit_breakers SET failures = 0 WHERE name = ? AND failures > 0", (self.name,))
+        conn.commit()
+
+    def record_failure(self):
+        conn = scraper_state_db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT failures FROM circuit_breakers WHERE name = ?", (self.name,)).fetchone()
+            failures = (row[0] if row else 0) + 1
+            opened_until = time.time() + self.cooldown if failures >= self.threshold else 0
+            conn.execute(
+                "INSERT OR REPLACE INTO circuit_breakers (name, failures, opened_until) VALUES (?, ?, ?)",
+                (self.name, failures, opened_until)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if opened_until:
+            print(f"[Data Hunter] Circuit breaker aberto por {self.cooldown:.0f}s após {failures} falhas seguidas")
+
+    def stats(self) -> dict:
+        row = scraper_state_db().execute(
+            "SELECT failures, opened_until FROM circuit_breakers WHERE name = ?", (self.name,)
+        ).fetchone()
+        failures, opened_until = row or (0, 0)
+        return {
+            "state": "open" if opened_until > time.time() else "closed",
+            "consecutive_failures": failures,
+            "opened_until": opened_until or None
+        }
+
+
+scraper_rate_limiter = SharedTokenBucket("autocomplete", SCRAPER_RATE_PER_SEC, SCRAPER_RATE_BURST)
+scraper_breaker = SharedCircuitBreaker("autocomplete", SCRAPER_BREAKER_THRESHOLD, SCRAPER_BREAKER_COOLDOWN)
+
+_scraper_counters_lock = threading.Lock()
+scraper_counters = {"throttled": 0, "retries": 0, "rate_limited": 0, "breaker_skips": 0}
+
+
+def _count_scraper(counter: str):
+    with _scraper_counters_lock:
+        scraper_counters[counter] += 1
+
+
+def fetch_google_autocomplete(query: str, timeout: float | None = None) -> list:
+    """Consulta o Google Autocomplete sem cache.
+
+    Levanta ScraperThrottled em 429/5xx ou falha de conexão e ScraperInvalidResponse
+    para outros erros HTTP ou JSON inválido. `timeout` substitui o timeout do pool.
+    """
     params = {
         "client": "firefox",
         "q": query,
@@ -74,51 +1156,150 @@ def get_google_autocomplete(query: str) -> list:
     }
 
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            if len(data) > 1 and isinstance(data[1], list):
-                return data[1]
-    except Exception as e:
-        print(f"Erro no autocomplete: {e}")
+        response = http_pool.get(AUTOCOMPLETE_URL, params=params, headers=headers, timeout=timeout)
+    except httpx.TransportError as e:
+        raise ScraperThrottled(f"Falha de conexão: {e}")
+
+    if response.status_code == 429 or response.status_code >= 500:
+        retry_after = response.headers.get("Retry-After", "")
+        raise ScraperThrottled(
+            f"HTTP {response.status_code}",
+            retry_after=float(retry_after) if retry_after.isdigit() else None
+        )
 
+    if not response.is_success:
+        raise ScraperInvalidResponse(f"HTTP {response.status_code}")
+    try:
+        data = response.json()
+    except ValueError as e:
+        raise ScraperInvalidResponse(f"JSON inválido: {e}")
+    if isinstance(data, list) and len(data) > 1 and isinstance(data[1], list):
+        return data[1]
     return []
 
 
-def scrape_autocomplete_az(ramo: str, localizacao: str = "") -> list:
-    """Faz varredura de A-Z no Google Autocomplete para um ramo com localização."""
-    all_suggestions = set()
+def backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    """Backoff exponencial com jitter completo, respeitando o Retry-After quando houver."""
+    delay = random.uniform(0, min(SCRAPER_BACKOFF_MAX, SCRAPER_BACKOFF_BASE * (2 ** attempt)))
+    if retry_after:
+        delay = max(delay, min(retry_after, SCRAPER_BACKOFF_MAX))
+    return delay
 
-    # Define a base da query com ou sem localização
-    base_query = f"{ramo} em {localizacao}" if localizacao else ramo
 
-    # Busca base (sem letra)
-    base_suggestions = get_google_autocomplete(base_query)
-    all_suggestions.update(base_suggestions)
+def get_google_autocomplete(query: str) -> list:
+    """Busca sugestões do Google Autocomplete para uma query (com cache, rate limit e backoff).
+
+    Dentro do prazo da requisição, a espera por token, o timeout e o backoff
+    ficam limitados ao tempo restante; sem tempo, retorna [] sem consultar.
+    """
+    cache_key = " ".join(query.lower().split())
+
+    if not autocomplete_refresh.get():
+        found, cached = autocomplete_cache.get(cache_key)
+        if found:
+            return cached
+
+    for attempt in range(SCRAPER_MAX_RETRIES + 1):
+        if scraper_breaker.is_open():
+            _count_scraper("breaker_skips")
+            metrics.inc("scraper_requests_total", result="breaker_open")
+            return []
+        if deadline_expired():
+            metrics.inc("scraper_requests_total", result="deadline")
+            return []
+        if not scraper_rate_limiter.acquire(deadline_remaining(SCRAPER_RATE_MAX_WAIT)):
+            _count_scraper("rate_limited")
+            metrics.inc("scraper_requests_total", result="rate_limited")
+            return []
+
+        try:
+            with trace_span("autocomplete_probe"):
+                suggestions = fetch_google_autocomplete(query, timeout=deadline_remaining(http_pool.timeout))
+        except ScraperThrottled as e:
+            if deadline_expired():
+                # Timeout causado pelo prazo da requisição: não é culpa do Google
+                metrics.inc("scraper_requests_total", result="deadline")
+                return []
+            # Bloqueio/instabilidade: não entra no cache negativo
+            _count_scraper("throttled")
+            metrics.inc("scraper_requests_total", result="throttled")
+            scraper_breaker.record_failure()
+            if attempt == SCRAPER_MAX_RETRIES:
+                print(f"Autocomplete bloqueado/indisponível para '{query}': {e}")
+                return []
+            delay = backoff_delay(attempt, e.retry_after)
+            if delay >= deadline_remaining(delay + 1):
+                # Não sobra tempo para esperar o backoff e tentar de novo
+                metrics.inc("scraper_requests_total", result="deadline")
+                return []
+            _count_scraper("retries")
+            time.sleep(delay)
+            continue
+        except ScraperInvalidResponse as e:
+            # Resposta inesperada: não conta no breaker (só 429/5xx/conexão contam)
+            print(f"Erro no autocomplete: {e}")
+            metrics.inc("scraper_requests_total", result="error")
+            suggestions = []
+        else:
+            scraper_breaker.record_success()
+            metrics.inc("scraper_requests_total", result="ok" if suggestions else "empty")
+
+        # Vazios e respostas inválidas entram no cache negativo (TTL curto)
+        autocomplete_cache.set(cache_key, suggestions, negative=not suggestions)
+        return suggestions
+
+    return []
 
-    # Busca com cada letra do alfabeto
-    for letter in string.ascii_lowercase:
-        query = f"{base_query} {letter}"
-        suggestions = get_google_autocomplete(query)
-        all_suggestions.update(suggestions)
 
-    # Busca com variações comuns (com localização)
-    variations = [
-        f"{ramo} em {localizacao} como",
-        f"{ramo} em {localizacao} onde",
-        f"{ramo} em {localizacao} qual",
-        f"{ramo} em {localizacao} quanto",
-        f"{ramo} em {localizacao} melhor",
-        f"{ramo} em {localizacao} preço",
-        f"{ramo} {localizacao}",
-        f"comprar {ramo} em {localizacao}",
-        f"contratar {ramo} em {localizacao}",
-        f"alugar {ramo} em {localizacao}",
-        f"{ramo} barato em {localizacao}",
-        f"{ramo} perto {localizacao}",
-        f"melhor {ramo} em {localizacao}",
-        f"{ramo} {localizacao} preço",
-    ] if localizacao else [
+# Limites do motor de varredura concorrente
+# SCRAPER_MAX_IN_FLIGHT: máximo de chamadas simultâneas ao autocomplete por varredura
+# SCRAPER_SWEEP_DEADLINE: tempo máximo (segundos) de uma varredura; ao estourar, retorna o parcial
+SCRAPER_MAX_IN_FLIGHT = int(os.getenv("SCRAPER_MAX_IN_FLIGHT", "10"))
+SCRAPER_SWEEP_DEADLINE = float(os.getenv("SCRAPER_SWEEP_DEADLINE", "8"))
+
+# Modo da varredura (padrão fixed, o comportamento original):
+# - fixed: dispara sempre o conjunto fixo (base, A-Z e variações)
+# - adaptive: prioriza as sondagens pelo rendimento de sugestões inéditas,
+#   aprofunda os ramos produtivos (duas letras / sugestões como semente) e
+#   para ao esgotar o orçamento ou ao saturar
+SCRAPER_MODES = ("fixed", "adaptive")
+SCRAPER_MODE = os.getenv("SCRAPER_MODE", "fixed")
+SCRAPER_PROBE_BUDGET = int(os.getenv("SCRAPER_PROBE_BUDGET", "40"))
+SCRAPER_MAX_DEPTH = int(os.getenv("SCRAPER_MAX_DEPTH", "2"))
+SCRAPER_EXPAND_MIN_YIELD = int(os.getenv("SCRAPER_EXPAND_MIN_YIELD", "4"))
+SCRAPER_EXPAND_FANOUT = int(os.getenv("SCRAPER_EXPAND_FANOUT", "6"))
+SCRAPER_SATURATION_WINDOW = int(os.getenv("SCRAPER_SATURATION_WINDOW", "10"))
+SCRAPER_SATURATION_MIN_NEW = int(os.getenv("SCRAPER_SATURATION_MIN_NEW", "5"))
+
+# Iniciais mais comuns do português primeiro (estimativa inicial das sondagens A-Z)
+LETTER_PRIOR = "cpamsdebtrflvigonhjuqzxkwy"
+# Sugestões esperadas numa sondagem A-Z de letra comum / numa variação
+PROBE_EXPECTED_YIELD = 8.0
+VARIATION_EXPECTED_YIELD = 4.0
+
+sweep_flights = SingleFlight("autocomplete_sweep", lease_ttl=SCRAPER_SWEEP_DEADLINE + 30)
+
+
+def autocomplete_variations(ramo: str, localizacao: str = "") -> list:
+    """Variações comuns de intenção (como, onde, preço, comprar...) para a varredura."""
+    if localizacao:
+        return [
+            f"{ramo} em {localizacao} como",
+            f"{ramo} em {localizacao} onde",
+            f"{ramo} em {localizacao} qual",
+            f"{ramo} em {localizacao} quanto",
+            f"{ramo} em {localizacao} melhor",
+            f"{ramo} em {localizacao} preço",
+            f"{ramo} {localizacao}",
+            f"comprar {ramo} em {localizacao}",
+            f"contratar {ramo} em {localizacao}",
+            f"alugar {ramo} em {localizacao}",
+            f"{ramo} barato em {localizacao}",
+            f"{ramo} perto {localizacao}",
+            f"melhor {ramo} em {localizacao}",
+            f"{ramo} {localizacao} preço",
+        ]
+    return [
         f"{ramo} como",
         f"{ramo} onde",
         f"{ramo} qual",
@@ -132,14 +1313,2303 @@ def scrape_autocomplete_az(ramo: str, localizacao: str = "") -> list:
         f"{ramo} perto"
     ]
 
-    for variation in variations:
-        suggestions = get_google_autocomplete(variation)
-        all_suggestions.update(suggestions)
+
+def build_autocomplete_queries(ramo: str, localizacao: str = "") -> list:
+    """Monta a lista de queries da varredura: base, A-Z e variações comuns."""
+
+    # Define a base da query com ou sem localização
+    base_query = f"{ramo} em {localizacao}" if localizacao else ramo
+
+    # Busca base (sem letra) + busca com cada letra do alfabeto
+    queries = [base_query]
+    queries.extend(f"{base_query} {letter}" for letter in string.ascii_lowercase)
+
+    # Busca com variações comuns (com localização)
+    queries.extend(autocomplete_variations(ramo, localizacao))
+
+    # Remove queries repetidas mantendo a ordem
+    return list(dict.fromkeys(queries))
+
+
+def run_autocomplete_sweep(queries: list, max_in_flight: int | None = None,
+                           deadline: float | None = None, on_result=None, cancel_event=None) -> tuple:
+    """Executa as queries em paralelo (concorrência limitada). Retorna ({query: sugestões}, parada).
+
+    Ao atingir o deadline (segundos) ou quando `cancel_event` é sinalizado, as
+    queries pendentes são canceladas e o resultado parcial é retornado
+    (parada "deadline" ou "cancelled"; completa, "complete").
+    `on_result(query, sugestões)` é chamado na thread de quem iniciou a
+    varredura assim que cada query termina.
+    """
+    max_in_flight = max(1, max_in_flight or SCRAPER_MAX_IN_FLIGHT)
+    # Nunca passa do prazo da requisição (se houver)
+    deadline = deadline_remaining(SCRAPER_SWEEP_DEADLINE if deadline is None else deadline)
+    expires_at = time.monotonic() + deadline
+
+    results = {}
+    started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="autocomplete")
+    try:
+        pending = {executor.submit(with_trace(get_google_autocomplete), query): query for query in queries}
+        while pending:
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0 or (cancel_event and cancel_event.is_set()):
+                break
+            # Com cancelamento possível, acorda periodicamente para checar o evento
+            timeout = min(remaining, 0.2) if cancel_event else remaining
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                query = pending.pop(future)
+                try:
+                    results[query] = future.result()
+                except Exception as e:
+                    print(f"Erro no autocomplete: {e}")
+                    results[query] = []
+                if on_result:
+                    on_result(query, results[query])
+
+        stop = "complete"
+        if pending and cancel_event and cancel_event.is_set():
+            stop = "cancelled"
+        elif pending:
+            stop = "deadline"
+            print(f"[Data Hunter] Deadline de {deadline:.1f}s atingido: "
+                  f"{len(results)}/{len(queries)} queries concluídas")
+            record_cut("autocomplete_sweep", "partial", queries=len(results))
+        metrics.inc("autocomplete_sweeps_total", mode="fixed", stop=stop)
+    finally:
+        # Não espera as chamadas em andamento: o resultado parcial já foi coletado
+        executor.shutdown(wait=False, cancel_futures=True)
+        record_stage("autocomplete_sweep", time.perf_counter() - started)
+
+    return results, stop
+
+
+class ProbeFrontier:
+    """Fronteira da varredura adaptativa: escolhe a próxima sondagem pelo rendimento esperado.
+
+    A estimativa de cada sondagem (sugestões inéditas esperadas) é calibrada
+    pelo rendimento real já observado no seu tipo (letra, variação, duas
+    letras, sugestão). Sondagens produtivas geram filhos até SCRAPER_MAX_DEPTH.
+    """
+
+    def __init__(self, ramo: str, localizacao: str = ""):
+        self.base_query = f"{ramo} em {localizacao}" if localizacao else ramo
+        self.seen = set()
+        self._frontier = {}   # query -> (estimativa, tipo, profundidade)
+        self._known = set()   # queries (normalizadas) já enfileiradas
+        self._probes = {}     # query -> (estimativa, tipo, profundidade) das sondagens disparadas
+        self._kinds = {}      # tipo -> [rendimento observado, rendimento estimado]
+        self._recent = deque(maxlen=max(1, SCRAPER_SATURATION_WINDOW))
+
+        self._push(self.base_query, float("inf"), "base", 0)
+        for rank, letter in enumerate(LETTER_PRIOR):
+            estimate = PROBE_EXPECTED_YIELD * (1 - 0.8 * rank / len(LETTER_PRIOR))
+            self._push(f"{self.base_query} {letter}", estimate, "letter", 1)
+        for query in autocomplete_variations(ramo, localizacao):
+            self._push(query, VARIATION_EXPECTED_YIELD, "variation", 1)
+
+    @property
+    def issued(self) -> int:
+        return len(self._probes)
+
+    @property
+    def saturated(self) -> bool:
+        """As últimas SCRAPER_SATURATION_WINDOW sondagens quase não trouxeram sugestões novas."""
+        return len(self._recent) == self._recent.maxlen and sum(self._recent) < SCRAPER_SATURATION_MIN_NEW
+
+    def _push(self, query: str, estimate: float, kind: str, depth: int):
+        key = " ".join(query.lower().split())
+        if key not in self._known:
+            self._known.add(key)
+            self._frontier[query] = (estimate, kind, depth)
+
+    def _score(self, query: str) -> float:
+        estimate, kind, _ = self._frontier[query]
+        observed, expected = self._kinds.get(kind, (0.0, 0.0))
+        return estimate * (observed + 1) / (expected + 1)
+
+    def next_query(self) -> str | None:
+        """Retira da fronteira a sondagem de maior rendimento esperado (None se vazia)."""
+        if not self._frontier:
+            return None
+        query = max(self._frontier, key=self._score)
+        self._probes[query] = self._frontier.pop(query)
+        return query
+
+    def record(self, query: str, suggestions: list) -> list:
+        """Registra o resultado de uma sondagem e retorna as sugestões inéditas."""
+        estimate, kind, depth = self._probes[query]
+        new_suggestions = [s for s in dict.fromkeys(suggestions) if s not in self.seen]
+        self.seen.update(new_suggestions)
+
+        self._recent.append(len(new_suggestions))
+        if kind != "base":
+            stats = self._kinds.setdefault(kind, [0.0, 0.0])
+            stats[0] += len(new_suggestions)
+            stats[1] += estimate
+        if 0 < depth < SCRAPER_MAX_DEPTH and len(new_suggestions) >= SCRAPER_EXPAND_MIN_YIELD:
+            self._expand(query, kind, depth, new_suggestions)
+        return new_suggestions
+
+    def _expand(self, query: str, kind: str, depth: int, new_suggestions: list):
+        """Aprofunda um ramo produtivo: sufixos de duas letras e sugestões usadas como semente."""
+        fanout = max(1, SCRAPER_EXPAND_FANOUT)
+        two_letter = []
+        if kind == "letter":
+            # Segundas letras mais frequentes nas sugestões do ramo, depois as vogais
+            prefix = query.lower()
+            second_letters = Counter(
+                s.lower()[len(prefix)] for s in new_suggestions
+                if s.lower().startswith(prefix) and s.lower()[len(prefix):][:1] in string.ascii_lowercase
+            )
+            letters = [letter for letter, _ in second_letters.most_common()]
+            letters += [vowel for vowel in "aeiou" if vowel not in second_letters]
+            two_letter = [f"{query}{letter}" for letter in letters][:(fanout + 1) // 2]
+        seeded = [s for s in new_suggestions if len(s) > len(query)][:fanout - len(two_letter)]
+
+        # O filho herda o rendimento do pai, decrescente pela posição
+        base_estimate = len(new_suggestions) / 2
+        for children, child_kind in ((two_letter, "two_letter"), (seeded, "suggestion")):
+            for position, child in enumerate(children):
+                self._push(child, base_estimate / (1 + 0.5 * position), child_kind, depth + 1)
+
+
+def run_adaptive_sweep(ramo: str, localizacao: str = "", budget: int | None = None,
+                       max_in_flight: int | None = None, deadline: float | None = None,
+                       on_result=None, cancel_event=None) -> tuple:
+    """Varredura adaptativa com orçamento de sondagens. Retorna ({query: sugestões}, parada).
+
+    Dispara até `budget` queries (SCRAPER_PROBE_BUDGET), sempre a de maior
+    rendimento esperado na fronteira, e para antes ao saturar. Deadline,
+    cancelamento, a parada e `on_result` seguem run_autocomplete_sweep.
+    """
+    budget = SCRAPER_PROBE_BUDGET if budget is None else budget
+    max_in_flight = max(1, max_in_flight or SCRAPER_MAX_IN_FLIGHT)
+    # Nunca passa do prazo da requisição (se houver)
+    deadline = deadline_remaining(SCRAPER_SWEEP_DEADLINE if deadline is None else deadline)
+    expires_at = time.monotonic() + deadline
+
+    frontier = ProbeFrontier(ramo, localizacao)
+    results = {}
+    stop = "frontier"
+    started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="autocomplete")
+    try:
+        pending = {}
+        while True:
+            # Completa as vagas com as melhores sondagens (a fronteira muda a cada resultado)
+            while len(pending) < max_in_flight and frontier.issued < budget and not frontier.saturated:
+                query = frontier.next_query()
+                if query is None:
+                    break
+                pending[executor.submit(with_trace(get_google_autocomplete), query)] = query
+            if not pending:
+                break
+
+            remaining = expires_at - time.monotonic()
+            if cancel_event and cancel_event.is_set():
+                stop = "cancelled"
+                break
+            if remaining <= 0:
+                stop = "deadline"
+                print(f"[Data Hunter] Deadline de {deadline:.1f}s atingido: "
+                      f"{len(results)}/{frontier.issued} queries concluídas")
+                record_cut("autocomplete_sweep", "partial", queries=len(results))
+                break
+            timeout = min(remaining, 0.2) if cancel_event else remaining
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                query = pending.pop(future)
+                try:
+                    results[query] = future.result()
+                except Exception as e:
+                    print(f"Erro no autocomplete: {e}")
+                    results[query] = []
+                frontier.record(query, results[query])
+                if on_result:
+                    on_result(query, results[query])
+
+        if stop == "frontier":
+            if frontier.saturated:
+                stop = "saturation"
+            elif frontier.issued >= budget:
+                stop = "budget"
+        metrics.inc("autocomplete_sweeps_total", mode="adaptive", stop=stop)
+        print(f"[Data Hunter] Varredura adaptativa: {len(results)} sondagens, "
+              f"{len(frontier.seen)} sugestões únicas "
+              f"({len(frontier.seen) / max(1, len(results)):.1f}/sondagem), parada: {stop}")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        record_stage("autocomplete_sweep", time.perf_counter() - started)
+
+    return results, stop
+
+
+# Paradas de varredura que deixam sondagens pendentes para trás (resultado parcial)
+PARTIAL_SWEEP_STOPS = ("deadline", "cancelled")
+
+
+def scrape_autocomplete_az(ramo: str, localizacao: str = "", on_batch=None, cancel_event=None,
+                           probe_results: dict | None = None, sweep_status: dict | None = None) -> list:
+    """Faz varredura de A-Z no Google Autocomplete para um ramo com localização.
+
+    A varredura é fixa ou adaptativa (com orçamento de sondagens), conforme SCRAPER_MODE.
+
+    Se informado, `on_batch(query, novas_sugestões)` recebe as sugestões
+    inéditas de cada query assim que ela termina. `cancel_event` interrompe a
+    varredura retornando o que já foi coletado. `probe_results`, se for um
+    dict, é preenchido com {query: sugestões} (usado no ranking das keywords).
+    `sweep_status`, se for um dict, recebe "partial": True quando o prazo da
+    varredura (SCRAPER_SWEEP_DEADLINE ou o da requisição) ou o cancelamento
+    deixaram sondagens pendentes.
+    """
+    all_suggestions = set()
+    partial = False
+
+    def collect(query, suggestions):
+        new_suggestions = [s for s in dict.fromkeys(suggestions) if s not in all_suggestions]
+        all_suggestions.update(new_suggestions)
+        if on_batch and new_suggestions:
+            on_batch(query, new_suggestions)
+
+    if scraper_breaker.is_open():
+        print("[Data Hunter] Circuit breaker aberto: varredura ignorada")
+        return []
+
+    # Varreduras idênticas simultâneas (neste ou em outro worker) viram uma só
+    try:
+        flight = sweep_flights.begin("|".join(sweep_key(ramo, localizacao)), timeout=deadline_remaining())
+    except DeadlineExceeded:
+        if sweep_status is not None:
+            sweep_status["partial"] = True
+        return []
+    if flight.leader:
+        with flight:
+            if SCRAPER_MODE == "adaptive":
+                results, stop = run_adaptive_sweep(ramo, localizacao, on_result=collect, cancel_event=cancel_event)
+            else:
+                results, stop = run_autocomplete_sweep(build_autocomplete_queries(ramo, localizacao),
+                                                       on_result=collect, cancel_event=cancel_event)
+            # Varredura cancelada ou cortada por um prazo é parcial: não é compartilhada
+            partial = stop in PARTIAL_SWEEP_STOPS
+            if not partial:
+                flight.finish(results)
+    else:
+        # Reproduz as sondagens na ordem em que terminaram no líder
+        results = flight.result
+        for query, suggestions in results.items():
+            collect(query, suggestions)
+
+    if probe_results is not None:
+        probe_results.update(results)
+    if sweep_status is not None:
+        sweep_status["partial"] = partial
 
     # Remove duplicatas e retorna lista ordenada
     return sorted(list(all_suggestions))
 
 
+# =============================================================================
+# CORPUS DE KEYWORDS - Pré-varredura (warm-up) e Stale-While-Revalidate
+# =============================================================================
+# A maior parte do tráfego cobre poucos pares (ramo, cidade): o resultado de cada
+# varredura fica num corpus persistente e é servido dali enquanto não expirar.
+# CORPUS_FRESH_TTL: idade (segundos) até a entrada ficar "velha" (servida + renovada em segundo plano)
+# CORPUS_MAX_STALE: idade máxima servida; acima disso a varredura volta a ser síncrona
+# CORPUS_REFRESH_WORKERS: renovações simultâneas em segundo plano por worker
+
+CORPUS_ENABLED = os.getenv("CORPUS_ENABLED", "true").lower() == "true"
+CORPUS_FRESH_TTL = float(os.getenv("CORPUS_FRESH_TTL", "86400"))
+CORPUS_MAX_STALE = float(os.getenv("CORPUS_MAX_STALE", "604800"))
+CORPUS_REFRESH_WORKERS = int(os.getenv("CORPUS_REFRESH_WORKERS", "2"))
+
+_corpus_refresh_executor = ThreadPoolExecutor(max_workers=max(1, CORPUS_REFRESH_WORKERS),
+                                              thread_name_prefix="corpus-refresh")
+
+
+def sweep_key(ramo: str, localizacao: str = "") -> tuple:
+    """Chave normalizada de um par (ramo, localização)."""
+    return " ".join(ramo.lower().split()), " ".join(localizacao.lower().split())
+
+
+class KeywordCorpus:
+    """Keywords e sondagens de cada (ramo, localização) em SQLite, com idade e popularidade."""
+
+    def __init__(self, name: str = "keyword_corpus"):
+        self.name = name
+        self._db_ready = False
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def _db(self) -> sqlite3.Connection:
+        conn = get_sqlite(self.name)
+        if not self._db_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS corpus_entries (
+                    ramo_key TEXT NOT NULL,
+                    localizacao_key TEXT NOT NULL,
+                    ramo TEXT NOT NULL,
+                    localizacao TEXT NOT NULL,
+                    keywords TEXT NOT NULL,
+                    probes TEXT NOT NULL,
+                    total INTEGER NOT NULL,
+                    scraped_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    last_hit_at REAL,
+                    PRIMARY KEY (ramo_key, localizacao_key)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_corpus_scraped_at ON corpus_entries (scraped_at)")
+            conn.commit()
+            self._db_ready = True
+        return conn
+
+    def peek(self, ramo: str, localizacao: str = "") -> dict | None:
+        """Entrada armazenada (sem contar acesso), com `age` em segundos."""
+        row = self._db().execute(
+            "SELECT keywords, probes, scraped_at FROM corpus_entries WHERE ramo_key = ? AND localizacao_key = ?",
+            sweep_key(ramo, localizacao)
+        ).fetchone()
+        if not row:
+            return None
+        return {"keywords": json.loads(row[0]), "probes": json.loads(row[1]), "age": time.time() - row[2]}
+
+    def get(self, ramo: str, localizacao: str = "") -> dict | None:
+        """Entrada servível (status "fresh" ou "stale") ou None se ausente/expirada."""
+        entry = self.peek(ramo, localizacao)
+        if entry is None or entry["age"] > CORPUS_MAX_STALE:
+            return None
+        entry["status"] = "fresh" if entry["age"] <= CORPUS_FRESH_TTL else "stale"
+        conn = self._db()
+        conn.execute(
+            "UPDATE corpus_entries SET hits = hits + 1, last_hit_at = ? WHERE ramo_key = ? AND localizacao_key = ?",
+            (time.time(), *sweep_key(ramo, localizacao))
+        )
+        conn.commit()
+        return entry
+
+    def put(self, ramo: str, localizacao: str, keywords: list, probes: dict, partial: bool = False):
+        """Grava a varredura do par. Uma varredura parcial (cortada por prazo) só entra se não houver
+        entrada e já nasce velha: é servida, mas renovada no primeiro acesso.
+        """
+        scraped_at = time.time() - CORPUS_FRESH_TTL - 1 if partial else time.time()
+        conflict = "NOTHING" if partial else """UPDATE SET
+                ramo = excluded.ramo, localizacao = excluded.localizacao, keywords = excluded.keywords,
+                probes = excluded.probes, total = excluded.total, scraped_at = excluded.scraped_at"""
+        conn = self._db()
+        conn.execute(f"""
+            INSERT INTO corpus_entries (ramo_key, localizacao_key, ramo, localizacao, keywords, probes, total, scraped_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (ramo_key, localizacao_key) DO {conflict}
+        """, (*sweep_key(ramo, localizacao), ramo, localizacao, json.dumps(keywords, ensure_ascii=False),
+              json.dumps(probes, ensure_ascii=False), len(keywords), scraped_at))
+        conn.commit()
+
+    def due_for_refresh(self, older_than: float, limit: int = 100) -> list:
+        """Pares varridos há mais de `older_than` segundos e ainda servíveis, os mais acessados primeiro."""
+        now = time.time()
+        rows = self._db().execute("""
+            SELECT ramo, localizacao FROM corpus_entries
+            WHERE scraped_at < ? AND scraped_at >= ?
+            ORDER BY hits DESC, scraped_at ASC LIMIT ?
+        """, (now - older_than, now - CORPUS_MAX_STALE, limit)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def revalidate(self, ramo: str, localizacao: str = ""):
+        """Agenda a renovação em segundo plano (uma por par em cada worker)."""
+        key = sweep_key(ramo, localizacao)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        _corpus_refresh_executor.submit(self._revalidate, ramo, localizacao, key)
+
+    def _revalidate(self, ramo: str, localizacao: str, key: tuple):
+        trace = RequestTrace(f"corpus-{uuid.uuid4().hex[:8]}")
+        current_trace.set(trace)
+        try:
+            # Outro worker pode ter renovado enquanto esta tarefa esperava na fila
+            entry = self.peek(ramo, localizacao)
+            if entry is None or entry["age"] > CORPUS_FRESH_TTL:
+                keywords = refresh_keyword_corpus(ramo, localizacao)
+                print(f"[Corpus] Renovado '{ramo}' em '{localizacao or 'Brasil'}': {len(keywords)} keywords "
+                      f"em {(time.monotonic() - trace.started) * 1000:.0f}ms")
+        except Exception as e:
+            print(f"[Corpus] Erro ao renovar '{ramo}' em '{localizacao}': {e}")
+        finally:
+            current_trace.set(None)
+            with self._lock:
+                self._refreshing.discard(key)
+            metrics.flush()
+
+    def stats(self) -> dict:
+        now = time.time()
+        total, fresh, servable, hits = self._db().execute("""
+            SELECT COUNT(*), COALESCE(SUM(scraped_at >= ?), 0), COALESCE(SUM(scraped_at >= ?), 0),
+                   COALESCE(SUM(hits), 0)
+            FROM corpus_entries
+        """, (now - CORPUS_FRESH_TTL, now - CORPUS_MAX_STALE)).fetchone()
+        with self._lock:
+            refreshing = len(self._refreshing)
+        return {"entries": total, "fresh": fresh, "stale": servable - fresh, "expired": total - servable,
+                "hits": hits, "refreshing": refreshing}
+
+
+keyword_corpus = KeywordCorpus()
+
+
+def refresh_keyword_corpus(ramo: str, localizacao: str = "") -> list:
+    """Refaz a varredura ignorando o cache do autocomplete e grava o resultado no corpus."""
+    probes = {}
+    status = {}
+    token = autocomplete_refresh.set(True)
+    try:
+        keywords = scrape_autocomplete_az(ramo, localizacao, probe_results=probes, sweep_status=status)
+    finally:
+        autocomplete_refresh.reset(token)
+    # Varredura vazia (breaker aberto, bloqueio) mantém a entrada anterior; parcial não a substitui
+    if keywords:
+        keyword_corpus.put(ramo, localizacao, keywords, probes, partial=status.get("partial", False))
+    return keywords
+
+
+def scrape_keywords(ramo: str, localizacao: str = "", on_batch=None, cancel_event=None,
+                    probe_results: dict | None = None) -> list:
+    """scrape_autocomplete_az servido pelo corpus (stale-while-revalidate).
+
+    Entrada fresca: servida direto. Velha: servida e renovada em segundo plano.
+    Ausente ou expirada: varredura síncrona, gravada no corpus.
+    """
+    entry = keyword_corpus.get(ramo, localizacao) if CORPUS_ENABLED else None
+    if entry is None:
+        metrics.inc("keyword_corpus_total", result="miss")
+        probes = {}
+        status = {}
+        keywords = scrape_autocomplete_az(ramo, localizacao, on_batch=on_batch, cancel_event=cancel_event,
+                                          probe_results=probes, sweep_status=status)
+        if probe_results is not None:
+            probe_results.update(probes)
+        # Cortada por prazo entra como parcial (já velha); cancelada (outro estágio venceu) não entra
+        if CORPUS_ENABLED and keywords and not (cancel_event and cancel_event.is_set()):
+            keyword_corpus.put(ramo, localizacao, keywords, probes, partial=status.get("partial", False))
+        return keywords
+
+    metrics.inc("keyword_corpus_total", result=entry["status"])
+    if entry["status"] == "stale":
+        keyword_corpus.revalidate(ramo, localizacao)
+
+    # Reproduz as sondagens gravadas para quem acompanha o progresso (SSE)
+    if on_batch:
+        seen = set()
+        for query, suggestions in entry["probes"].items():
+            new_suggestions = [s for s in dict.fromkeys(suggestions) if s not in seen]
+            seen.update(new_suggestions)
+            if new_suggestions:
+                on_batch(query, new_suggestions)
+    if probe_results is not None:
+        probe_results.update(entry["probes"])
+    return list(entry["keywords"])
+
+
+# =============================================================================
+# KEYWORD ENGINE - Normalização, Deduplicação e Ranking
+# =============================================================================
+
+# KEYWORD_DEDUP_THRESHOLD: similaridade (Jaccard dos tokens) a partir da qual duas keywords são a mesma ideia
+KEYWORD_DEDUP_THRESHOLD = float(os.getenv("KEYWORD_DEDUP_THRESHOLD", "0.75"))
+
+# Palavras sem peso semântico, ignoradas na comparação
+KEYWORD_STOPWORDS = {
+    "a", "o", "as", "os", "de", "do", "da", "dos", "das", "em", "no", "na", "nos", "nas",
+    "e", "para", "pra", "por", "com", "um", "uma", "ao", "aos"
+}
+
+# MinHash com LSH (16 permutações em 4 bandas de 4): só keywords que colidem em
+# alguma banda são comparadas, evitando comparações O(n²)
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_BANDS = 4
+_MINHASH_ROWS = 4
+_minhash_rng = random.Random(1337)
+_MINHASH_PARAMS = [
+    (_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME))
+    for _ in range(_MINHASH_BANDS * _MINHASH_ROWS)
+]
+
+
+def normalize_keyword(keyword: str) -> str:
+    """Minúsculas, sem acentos e sem pontuação, com espaços simples."""
+    text = unicodedata.normalize("NFKD", keyword.lower())
+    text = "".join(char if char.isalnum() else " " for char in text if not unicodedata.combining(char))
+    return " ".join(text.split())
+
+
+def _stem_token(token: str) -> str:
+    # Plural simples do português: "implantes" -> "implante", "clareamentos" -> "clareamento"
+    if len(token) > 4 and token.endswith(("oes", "aes")):
+        return token[:-3] + "ao"
+    if len(token) > 3 and token.endswith("ns"):
+        return token[:-2] + "m"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def keyword_tokens(keyword: str) -> frozenset:
+    """Conjunto de tokens normalizados (sem stopwords e no singular) de uma keyword."""
+    tokens = frozenset(
+        _stem_token(token) for token in normalize_keyword(keyword).split() if token not in KEYWORD_STOPWORDS
+    )
+    return tokens or frozenset(normalize_keyword(keyword).split())
+
+
+def _minhash_signature(tokens: frozenset) -> tuple:
+    hashes = [zlib.crc32(token.encode("utf-8")) for token in tokens] or [0]
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS)
+
+
+def keyword_probe_scores(probe_results: dict) -> dict:
+    """Pontua cada sugestão pela frequência nas sondagens do autocomplete e pela posição em cada lista."""
+    scores = {}
+    for suggestions in probe_results.values():
+        for position, suggestion in enumerate(suggestions):
+            scores[suggestion] = scores.get(suggestion, 0.0) + 1.0 + 1.0 / (1 + position)
+    return scores
+
+
+def cluster_keywords(keywords: list, threshold: float | None = None) -> list:
+    """Agrupa keywords quase duplicadas (acentos, plurais, ordem das palavras, termos extras).
+
+    Retorna uma lista de clusters (listas de keywords), na ordem da primeira ocorrência.
+    """
+    threshold = KEYWORD_DEDUP_THRESHOLD if threshold is None else threshold
+
+    # 1) Mesmo conjunto de tokens = mesma keyword (agrupamento exato em O(n))
+    groups = {}
+    for keyword in dict.fromkeys(keywords):
+        groups.setdefault(keyword_tokens(keyword), []).append(keyword)
+    token_sets = list(groups)
+
+    # 2) Quase duplicadas via MinHash + LSH, com confirmação pelo Jaccard exato
+    parent = list(range(len(token_sets)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets = {}
+    for index, tokens in enumerate(token_sets):
+        signature = _minhash_signature(tokens)
+        for band in range(_MINHASH_BANDS):
+            key = (band, signature[band * _MINHASH_ROWS:(band + 1) * _MINHASH_ROWS])
+            buckets.setdefault(key, []).append(index)
+
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        # Compara cada membro com os representativos já formados no bucket
+        representatives = []
+        for index in members:
+            for rep in representatives:
+                a, b = token_sets[index], token_sets[rep]
+                if len(a & b) / len(a | b) >= threshold:
+                    parent[find(index)] = find(rep)
+                    break
+            else:
+                representatives.append(index)
+
+    clusters = {}
+    for index, tokens in enumerate(token_sets):
+        clusters.setdefault(find(index), []).extend(groups[tokens])
+    return list(clusters.values())
+
+
+def rank_keywords(keywords: list, probe_results: dict | None = None) -> list:
+    """Deduplica e ordena as keywords por relevância, retornando um representante por cluster.
+
+    Com `probe_results` ({query: sugestões} da varredura), a relevância vem da
+    frequência/posição das sugestões nas sondagens; sem ele, da ordem de entrada.
+    """
+    if probe_results:
+        scores = keyword_probe_scores(probe_results)
+    else:
+        scores = {keyword: 1.0 / (1 + i) for i, keyword in enumerate(dict.fromkeys(keywords))}
+
+    ranked = []
+    for cluster in cluster_keywords(keywords):
+        cluster_score = sum(scores.get(keyword, 0.0) for keyword in cluster)
+        # Representante: a variação mais bem pontuada (empate: a mais curta)
+        representative = max(cluster, key=lambda keyword: (scores.get(keyword, 0.0), -len(keyword)))
+        ranked.append((cluster_score, representative))
+
+    ranked.sort(key=lambda item: -item[0])
+    return [keyword for _, keyword in ranked]
+
+
+# =============================================================================
+# FILTRO DE LOCALIZAÇÃO - Gazetteer de Municípios e UFs
+# =============================================================================
+
+# Remove, antes do prompt, keywords que citam cidades/estados diferentes da localização do cliente.
+# O gazetteer (data/municipios_br.csv, "nome;uf") vem da base GeoNames (CC-BY 4.0).
+LOCATION_FILTER_ENABLED = os.getenv("LOCATION_FILTER_ENABLED", "true").lower() == "true"
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          "data", "municipios_br.csv"))
+
+BRAZIL_STATES = {
+    "AC": "Acre", "AL": "Alagoas", "AP": "Amapá", "AM": "Amazonas", "BA": "Bahia", "CE": "Ceará",
+    "DF": "Distrito Federal", "ES": "Espírito Santo", "GO": "Goiás", "MA": "Maranhão", "MT": "Mato Grosso",
+    "MS": "Mato Grosso do Sul", "MG": "Minas Gerais", "PA": "Pará", "PB": "Paraíba", "PR": "Paraná",
+    "PE": "Pernambuco", "PI": "Piauí", "RJ": "Rio de Janeiro", "RN": "Rio Grande do Norte",
+    "RS": "Rio Grande do Sul", "RO": "Rondônia", "RR": "Roraima", "SC": "Santa Catarina",
+    "SP": "São Paulo", "SE": "Sergipe", "TO": "Tocantins"
+}
+
+# Siglas que não colidem com palavras comuns ("se", "to", "es", "pa", "ma", "am", "ap"... ficam de fora)
+UNAMBIGUOUS_UF_SIGLAS = {"sp", "rj", "mg", "pr", "rs", "sc", "ba", "go", "df", "ce", "pe", "pb", "rn",
+                         "ms", "mt", "ro", "rr", "pi"}
+
+# Nomes de lugares que também são palavras comuns: só contam como lugar depois de
+# "em", "no", "na", "perto"... ou antes de uma sigla de UF
+AMBIGUOUS_PLACE_NAMES = {
+    "alegre", "alvorada", "amparo", "aurora", "balsas", "bandeirantes", "barra", "barreiras", "bonito",
+    "brejo", "cachoeira", "caldas", "campestre", "capela", "caridade", "carmo", "castelo", "central",
+    "chapada", "colina", "colorado", "concordia", "conquista", "coqueiral", "cordeiro", "corrente",
+    "cristal", "cruz", "cruzeiro", "divino", "dourado", "eldorado", "encantado", "esperanca", "estancia",
+    "estrela", "farol", "fartura", "feliz", "figueira", "flores", "floresta", "florida", "formiga",
+    "formosa", "fronteira", "gloria", "graca", "harmonia", "horizonte", "imperatriz", "independencia",
+    "jardim", "lagoa", "lapa", "liberdade", "luz", "mata", "milagres", "mineiros", "mirante", "moeda",
+    "natal", "oliveira", "oriente", "ouro", "palma", "palmas", "palmeira", "paraiso", "patos", "paulista",
+    "pedra", "piedade", "pinhal", "pinhao", "pinheiro", "planalto", "pontal", "porto", "posse", "prata",
+    "primavera", "princesa", "progresso", "recreio", "redencao", "remanso", "reserva", "restinga",
+    "ribeirao", "rosario", "salgado", "salinas", "salto", "santana", "serra", "sertao",
+    "socorro", "solidao", "sossego", "tabuleiro", "tapera", "torres", "trindade", "triunfo", "turvo",
+    "uniao", "vargem", "vera", "vertentes", "vigia", "vitoria", "para", "acre",
+    # Palavras de anúncio e nomes de bairro muito comuns ("clínica sorriso", "bairro boa vista")
+    "sorriso", "saude", "vida nova", "boa vista", "bela vista", "bom jardim", "bom retiro", "bom sucesso",
+    "boa esperanca", "nova esperanca", "vista alegre", "boa viagem", "ipanema", "copacabana", "pinheiros",
+    "perdizes", "pompeia", "bom jesus", "santa cruz", "santa luzia", "santa rita", "santo antonio",
+    "sao bento", "sao francisco", "sao joao", "sao jose", "sao miguel", "sao pedro"
+}
+LOCATIVE_WORDS = {"em", "no", "na", "perto", "proximo", "proxima", "regiao", "cidade"}
+# Capitais com o nome do estado: como localização, valem a cidade (os outros homônimos, ex: a
+# cidade de Paraná/RN, valem o estado)
+STATE_NAMED_CAPITALS = {"sao paulo", "rio de janeiro"}
+
+
+class TokenAutomaton:
+    """Autômato Aho-Corasick sobre palavras: encontra todos os padrões em uma única passada."""
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+
+    def add(self, tokens: tuple):
+        node = 0
+        for token in tokens:
+            if token not in self._goto[node]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][token] = len(self._goto) - 1
+            node = self._goto[node][token]
+        self._out[node].append(len(tokens))
+
+    def build(self):
+        pending = list(self._goto[0].values())
+        while pending:
+            next_level = []
+            for node in pending:
+                for token, child in self._goto[node].items():
+                    fallback = self._fail[node]
+                    while fallback and token not in self._goto[fallback]:
+                        fallback = self._fail[fallback]
+                    self._fail[child] = self._goto[fallback].get(token, 0)
+                    self._out[child] = self._out[child] + self._out[self._fail[child]]
+                    next_level.append(child)
+            pending = next_level
+
+    def find(self, tokens: list) -> list:
+        """Retorna os trechos (início, fim) encontrados, priorizando os mais longos sem sobreposição."""
+        spans = []
+        node = 0
+        for i, token in enumerate(tokens):
+            while node and token not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(token, 0)
+            spans.extend((i - length + 1, i + 1) for length in self._out[node])
+
+        selected = []
+        taken = set()
+        for start, end in sorted(spans, key=lambda span: (span[0] - span[1], span[0])):
+            if not taken.intersection(range(start, end)):
+                taken.update(range(start, end))
+                selected.append((start, end))
+        return sorted(selected)
+
+
+class Gazetteer:
+    """Municípios e UFs do Brasil indexados para busca em keywords."""
+
+    def __init__(self, path: str):
+        # nome normalizado -> {"cities": UFs dos municípios com esse nome, "states": UFs com esse nome/sigla}
+        # Cidade e estado homônimos ("São Paulo", "Rio de Janeiro") ficam separados
+        self.places = {}
+        self.automaton = TokenAutomaton()
+
+        with open(path, encoding="utf-8") as f:
+            for row in csv.DictReader(f, delimiter=";"):
+                self._add(normalize_keyword(row["nome"]), row["uf"], "cities")
+        for uf, name in BRAZIL_STATES.items():
+            self._add(normalize_keyword(name), uf, "states")
+            if uf.lower() in UNAMBIGUOUS_UF_SIGLAS:
+                self._add(uf.lower(), uf, "states")
+
+        for name in self.places:
+            self.automaton.add(tuple(name.split()))
+        self.automaton.build()
+
+    def _add(self, name: str, uf: str, kind: str):
+        place = self.places.setdefault(name, {"cities": set(), "states": set()})
+        place[kind].add(uf)
+
+    def find_places(self, text: str, literal: bool = False) -> list:
+        """Lugares citados no texto: lista de nomes normalizados.
+
+        Nomes ambíguos ("sorriso", "boa vista") só contam com marcador de lugar,
+        exceto em `literal` (o texto é uma localização, ex: a do cliente).
+        """
+        tokens = normalize_keyword(text).split()
+        places = []
+        for start, end in self.automaton.find(tokens):
+            name = " ".join(tokens[start:end])
+            ambiguous = name in AMBIGUOUS_PLACE_NAMES or (end - start == 1 and len(name) <= 3
+                                                          and name not in UNAMBIGUOUS_UF_SIGLAS)
+            if ambiguous and not literal:
+                before = tokens[start - 1] if start > 0 else ""
+                after = tokens[end] if end < len(tokens) else ""
+                if before not in LOCATIVE_WORDS and after not in UNAMBIGUOUS_UF_SIGLAS:
+                    continue
+            places.append(name)
+        return places
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer() -> Gazetteer | None:
+    """Carrega o gazetteer uma vez por processo (None se o arquivo não existir)."""
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None:
+            try:
+                _gazetteer = Gazetteer(GAZETTEER_PATH)
+            except OSError as e:
+                print(f"[Filtro de Localização] Gazetteer indisponível: {e}")
+                _gazetteer = False
+    return _gazetteer or None
+
+
+def filter_keywords_by_location(keywords: list, localizacao: str, context: str = "") -> tuple:
+    """Remove keywords que citam cidades/UFs diferentes da localização. Retorna (mantidas, removidas).
+
+    Se a localização não for reconhecida (ex: um bairro), nada é removido.
+    Lugares citados em `context` (ramo/oferta) nunca contam como outra cidade.
+    """
+    gazetteer = get_gazetteer() if LOCATION_FILTER_ENABLED else None
+    if not gazetteer or not localizacao:
+        return list(keywords), []
+
+    client_places = gazetteer.find_places(localizacao, literal=True)
+    if not client_places:
+        return list(keywords), []
+
+    allowed_names = set(client_places) | set(gazetteer.find_places(context))
+    allowed_ufs = set()
+    for name in client_places:
+        allowed_ufs |= gazetteer.places[name]["cities"] | gazetteer.places[name]["states"]
+    # Localização em nível de estado ("Paraná", "SP"): qualquer cidade da UF é permitida.
+    # "São Paulo" é a cidade: o estado homônimo não libera os outros municípios de SP
+    state_level = not any(gazetteer.places[name]["cities"]
+                          and (not gazetteer.places[name]["states"] or name in STATE_NAMED_CAPITALS)
+                          for name in client_places)
+
+    kept, dropped = [], []
+    for keyword in keywords:
+        places = gazetteer.find_places(keyword)
+        # Citar a própria cidade (ou o ramo/oferta) mantém a keyword ("clínica sorriso curitiba")
+        if allowed_names.intersection(places):
+            kept.append(keyword)
+            continue
+        for name in places:
+            place = gazetteer.places[name]
+            if place["states"] & allowed_ufs or (state_level and place["cities"] & allowed_ufs):
+                continue
+            dropped.append(keyword)
+            break
+        else:
+            kept.append(keyword)
+
+    return kept, dropped
+
+
+# =============================================================================
+# PROVEDORES DE IA - OpenAI/Anthropic, Roteamento por Tarefa e Hedge
+# =============================================================================
+# Cada tarefa (saída estruturada: ad_groups, assets, keywords) segue uma rota
+# "provedor:modelo". Depois de "|" vêm os alvos alternativos usados no hedge.
+# Os clientes leem OPENAI_API_KEY/OPENAI_BASE_URL e ANTHROPIC_API_KEY/ANTHROPIC_BASE_URL.
+# LLM_ROUTE: rota padrão (ex: "openai:gpt-4o-mini|anthropic:claude-3-5-haiku-latest")
+# LLM_ROUTES: rotas por tarefa, separadas por vírgula (ex: "assets=anthropic:claude-3-5-haiku-latest")
+# LLM_HEDGE_ENABLED: se o alvo da vez não responder (primeiro token) dentro do seu
+#   LLM_HEDGE_QUANTILE (p95) de latência, dispara a mesma chamada no próximo alvo;
+#   vence quem responder primeiro e o perdedor é cancelado. Um erro antes do
+#   primeiro token dispara o próximo alvo na hora (failover)
+# LLM_HEDGE_DELAY: espera (segundos) antes do hedge enquanto o alvo tem menos de LLM_HEDGE_MIN_SAMPLES amostras
+# LLM_HEDGE_MIN_DELAY: espera mínima antes do hedge (evita dobrar o custo quando o provedor está rápido)
+# LLM_LATENCY_WINDOW: amostras de tempo até o primeiro token guardadas por alvo
+LLM_ROUTE = os.getenv("LLM_ROUTE", "openai:gpt-4o-mini")
+LLM_ROUTES = os.getenv("LLM_ROUTES", "")
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "2"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.3"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+
+# LLM_MAX_CONCURRENCY: chamadas simultâneas à IA por processo (somando os provedores)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+# Último item gerado pelos streams dos provedores
+LLMUsage = namedtuple("LLMUsage", "prompt_tokens completion_tokens")
+
+
+def _llm_client(client, timeout: float | None, max_retries: int | None):
+    """Cliente do SDK com o timeout (sem retentativas) e/ou o limite de retentativas da chamada."""
+    options = {} if timeout is None else {"timeout": timeout, "max_retries": 0}
+    if max_retries is not None:
+        options["max_retries"] = max_retries
+    return client.with_options(**options) if options else client
+
+
+class OpenAIProvider:
+    """Chat Completions da OpenAI (ou de uma API compatível em OPENAI_BASE_URL)."""
+
+    name = "openai"
+
+    def __init__(self):
+        api_key = os.getenv("OPENAI_API_KEY")
+        self.configured = bool(api_key)
+        # Sem API key o cliente nem é criado: a rota responde "não configurada"
+        self.client = OpenAI(api_key=api_key) if api_key else None
+        self.async_client = AsyncOpenAI(api_key=api_key) if api_key else None
+
+    @staticmethod
+    def _params(model: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float) -> dict:
+        return {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": True,
+            "stream_options": {"include_usage": True}
+        }
+
+    def open(self, model: str, *prompt, timeout: float | None = None, max_retries: int | None = None):
+        return _llm_client(self.client, timeout, max_retries).chat.completions.create(**self._params(model, *prompt))
+
+    async def aopen(self, model: str, *prompt, timeout: float | None = None, max_retries: int | None = None):
+        llm = _llm_client(self.async_client, timeout, max_retries)
+        return await llm.chat.completions.create(**self._params(model, *prompt))
+
+    @staticmethod
+    def read(chunk, usage: dict) -> str:
+        """Texto do chunk; o último chunk traz o uso de tokens."""
+        if getattr(chunk, "usage", None):
+            usage["prompt_tokens"] = chunk.usage.prompt_tokens or 0
+            usage["completion_tokens"] = chunk.usage.completion_tokens or 0
+        if not chunk.choices:
+            return ""
+        return chunk.choices[0].delta.content or ""
+
+
+class AnthropicProvider:
+    """Messages API da Anthropic (ou de uma API compatível em ANTHROPIC_BASE_URL)."""
+
+    name = "anthropic"
+
+    def __init__(self):
+        api_key = os.getenv("ANTHROPIC_API_KEY")
+        self.configured = bool(api_key)
+        self.client = Anthropic(api_key=api_key) if api_key else None
+        self.async_client = AsyncAnthropic(api_key=api_key) if api_key else None
+
+    @staticmethod
+    def _params(model: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float) -> dict:
+        return {
+            "model": model,
+            "system": system_prompt,
+            "messages": [{"role": "user", "content": user_prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": True
+        }
+
+    def open(self, model: str, *prompt, timeout: float | None = None, max_retries: int | None = None):
+        return _llm_client(self.client, timeout, max_retries).messages.create(**self._params(model, *prompt))
+
+    async def aopen(self, model: str, *prompt, timeout: float | None = None, max_retries: int | None = None):
+        llm = _llm_client(self.async_client, timeout, max_retries)
+        return await llm.messages.create(**self._params(model, *prompt))
+
+    @staticmethod
+    def read(event, usage: dict) -> str:
+        """Texto do evento; message_start e message_delta trazem o uso de tokens."""
+        if event.type == "content_block_delta" and event.delta.type == "text_delta":
+            return event.delta.text
+        if event.type == "message_start":
+            usage["prompt_tokens"] = event.message.usage.input_tokens or 0
+        elif event.type == "message_delta":
+            usage["completion_tokens"] = event.usage.output_tokens or 0
+        return ""
+
+
+LLM_PROVIDERS = {provider.name: provider for provider in (OpenAIProvider(), AnthropicProvider())}
+
+# Timeouts dos SDKs e do httpx (um alvo que não respondeu a tempo)
+LLM_TIMEOUT_ERRORS = (TimeoutError, httpx.TimeoutException, APITimeoutError, AnthropicTimeoutError)
+
+
+class LLMTarget(namedtuple("LLMTarget", "provider model")):
+    """Um modelo em um provedor ("openai:gpt-4o-mini")."""
+
+    @property
+    def key(self) -> str:
+        return f"{self.provider.name}:{self.model}"
+
+    @property
+    def cache_model(self) -> str:
+        """Modelo na chave do cache da IA (na OpenAI, só o nome: mantém as chaves antigas válidas)."""
+        return self.model if self.provider.name == "openai" else self.key
+
+
+def parse_llm_route(spec: str) -> list:
+    """Converte "openai:gpt-4o-mini|anthropic:claude-..." em alvos [LLMTarget, ...].
+
+    Alvos inválidos são ignorados; alternativas sem API key também (o primeiro
+    alvo fica mesmo sem key, para a rota responder "não configurada").
+    """
+    targets = []
+    for part in spec.split("|"):
+        name, _, model = part.strip().partition(":")
+        provider = LLM_PROVIDERS.get(name.strip().lower())
+        if provider is None or not model.strip():
+            print(f"[IA] Alvo inválido na rota '{spec}': '{part.strip()}' (use provedor:modelo)")
+            continue
+        if targets and not provider.configured:
+            print(f"[IA] Alternativa {provider.name}:{model.strip()} ignorada: provedor sem API key")
+            continue
+        targets.append(LLMTarget(provider, model.strip()))
+    return targets
+
+
+llm_default_route = parse_llm_route(LLM_ROUTE) or parse_llm_route("openai:gpt-4o-mini")
+llm_task_routes = {}
+for _entry in filter(None, (item.strip() for item in LLM_ROUTES.split(","))):
+    _task, _sep, _spec = _entry.partition("=")
+    if not _sep:
+        print(f"[IA] Rota inválida em LLM_ROUTES: '{_entry}' (use tarefa=provedor:modelo)")
+        continue
+    _targets = parse_llm_route(_spec)
+    if _targets:
+        llm_task_routes[_task.strip()] = _targets
+
+
+def llm_route(task: str) -> list:
+    """Alvos da tarefa em ordem de preferência (o primeiro é o principal)."""
+    return llm_task_routes.get(task, llm_default_route)
+
+
+def llm_configured() -> bool:
+    """Todas as rotas têm o provedor principal com API key."""
+    routes = [llm_default_route, *llm_task_routes.values()]
+    return all(route[0].provider.configured for route in routes)
+
+
+class LatencyTracker:
+    """Janela com as últimas latências (tempo até o primeiro token) de cada alvo."""
+
+    def __init__(self, window: int):
+        self.window = max(1, window)
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def observe(self, target: LLMTarget, seconds: float):
+        with self._lock:
+            self._samples.setdefault(target.key, deque(maxlen=self.window)).append(seconds)
+        metrics.observe("llm_first_token_seconds", seconds, provider=target.provider.name, model=target.model)
+
+    def quantile(self, target: LLMTarget, q: float, min_samples: int = 1) -> float | None:
+        """Quantil `q` das amostras do alvo (None com menos de `min_samples`)."""
+        with self._lock:
+            samples = sorted(self._samples.get(target.key, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = list(self._samples)
+        result = {}
+        for key in keys:
+            with self._lock:
+                samples = sorted(self._samples[key])
+            result[key] = {
+                "samples": len(samples),
+                "p50": round(samples[len(samples) // 2], 3),
+                "p95": round(samples[min(len(samples) - 1, int(0.95 * len(samples)))], 3)
+            }
+        return result
+
+
+llm_latency = LatencyTracker(LLM_LATENCY_WINDOW)
+
+
+def hedge_delay(target: LLMTarget) -> float:
+    """Espera antes de disparar o próximo alvo: o p95 (LLM_HEDGE_QUANTILE) do tempo até o primeiro token."""
+    observed = llm_latency.quantile(target, LLM_HEDGE_QUANTILE, LLM_HEDGE_MIN_SAMPLES)
+    return max(LLM_HEDGE_MIN_DELAY, LLM_HEDGE_DELAY if observed is None else observed)
+
+
+def _target_text_stream(target: LLMTarget, prompt: tuple, timeout: float | None = None,
+                        max_retries: int | None = None):
+    """Gera o texto da resposta de um alvo e, por último, o LLMUsage (se o provedor informar)."""
+    started = time.monotonic()
+    stream = target.provider.open(target.model, *prompt, timeout=timeout, max_retries=max_retries)
+    usage = {}
+    first = True
+    try:
+        for event in stream:
+            text = target.provider.read(event, usage)
+            if text:
+                if first:
+                    llm_latency.observe(target, time.monotonic() - started)
+                    first = False
+                yield text
+    finally:
+        stream.close()
+    if usage:
+        yield LLMUsage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+
+
+async def _target_text_astream(target: LLMTarget, prompt: tuple, timeout: float | None = None,
+                               max_retries: int | None = None, observe: bool = True):
+    """Versão assíncrona de _target_text_stream (com `observe=False`, a latência não é registrada)."""
+    started = time.monotonic()
+    first = observe
+    stream = await target.provider.aopen(target.model, *prompt, timeout=timeout, max_retries=max_retries)
+    usage = {}
+    try:
+        async for event in stream:
+            text = target.provider.read(event, usage)
+            if text:
+                if first:
+                    llm_latency.observe(target, time.monotonic() - started)
+                    first = False
+                yield text
+    finally:
+        await stream.close()
+    if usage:
+        yield LLMUsage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+
+
+class HedgedCall:
+    """Estado de uma chamada com hedge: alvos disparados, falhas e o vencedor.
+
+    O primeiro evento de cada tentativa (texto, fim ou erro) passa por settle();
+    depois que há vencedor, só os eventos dele são repassados.
+    """
+
+    def __init__(self, targets: list, output_name: str):
+        self.targets = targets
+        self.output_name = output_name
+        self.launched = []
+        self.errors = {}
+        self.winner = None
+
+    def launch(self) -> int:
+        """Registra o disparo do próximo alvo e retorna o seu índice."""
+        index = len(self.launched)
+        self.launched.append(time.monotonic())
+        if index:
+            reason = "failover" if len(self.errors) == index else "hedge"
+            print(f"[IA] {reason}: disparando {self.targets[index].key} ({self.output_name})")
+        return index
+
+    def next_launch_in(self) -> float | None:
+        """Segundos até disparar o próximo alvo (None = nenhum a disparar)."""
+        if self.winner is not None or len(self.launched) >= len(self.targets):
+            return None
+        # Todas as tentativas em andamento falharam: failover imediato
+        if len(self.errors) == len(self.launched):
+            return 0
+        last = len(self.launched) - 1
+        return max(0.0, self.launched[last] + hedge_delay(self.targets[last]) - time.monotonic())
+
+    def settle(self, index: int, event) -> bool:
+        """Trata o primeiro evento de uma tentativa. True quando ela vence; levanta o erro se todas falharam."""
+        if isinstance(event, Exception):
+            self.errors[index] = event
+            if len(self.errors) == len(self.targets):
+                metrics.inc("llm_hedge_total", output=self.output_name, result="failed")
+                raise self.errors[0]
+            return False
+        self.winner = index
+        if len(self.launched) == 1:
+            result = "not_needed"
+        elif self.errors:
+            result = "failover"
+        else:
+            result = "primary_won" if index == 0 else "hedge_won"
+        metrics.inc("llm_hedge_total", output=self.output_name, result=result)
+        return True
+
+
+def _hedged_text_stream(targets: list, output_name: str, prompt: tuple, timeout: float | None = None):
+    """Versão síncrona de _hedged_text_astream: as tentativas rodam no event loop compartilhado.
+
+    Lá o perdedor é cancelado de verdade (inclusive esperando a resposta em open),
+    o que fecha a conexão dele; uma thread bloqueada no SDK síncrono não teria como parar.
+    """
+    events = queue.Queue()
+
+    async def pump():
+        try:
+            async with aclosing(_hedged_text_astream(targets, output_name, prompt, timeout)) as stream:
+                async for event in stream:
+                    events.put((event, None))
+            events.put((None, None))
+        except Exception as exc:
+            events.put((None, exc))
+
+    future = submit_async(pump())
+    try:
+        while True:
+            event, error = events.get()
+            if error is not None:
+                raise error
+            if event is None:
+                return
+            yield event
+    finally:
+        # Cancela a task (e as tentativas em andamento) se a leitura parou antes do fim
+        future.cancel()
+
+
+async def _hedged_text_astream(targets: list, output_name: str, prompt: tuple, timeout: float | None = None):
+    """Gera o stream do alvo que responder primeiro, disparando os alternativos conforme HedgedCall.
+
+    Cada tentativa é uma task com tempo limite (o prazo ou LLM_CALL_TIMEOUT) e o perdedor é
+    cancelado na hora. A principal usa a vaga e a reserva da chamada; as alternativas pegam
+    as suas na fila justa, e o uso de quem perdeu também é contabilizado para o tenant.
+    Só o tempo até o primeiro token do vencedor entra no LatencyTracker: o de um perdedor
+    cancelado seria só um limite inferior e puxaria o p95 (e o disparo do hedge) para baixo.
+    """
+    call = HedgedCall(targets, output_name)
+    events = asyncio.Queue()
+    tasks = []
+    first_token = {}
+    attempt_timeout = min(timeout, LLM_CALL_TIMEOUT) if timeout is not None else LLM_CALL_TIMEOUT
+
+    async def attempt(index: int):
+        sent, failed, chars, usage = False, False, 0, None
+        try:
+            async with llm_hedge_slot_async(output_name, prompt) if index else nullcontext():
+                sent = True
+                started = time.monotonic()
+                async with aclosing(_target_text_astream(targets[index], prompt, attempt_timeout,
+                                                         max_retries=0, observe=False)) as stream:
+                    async for event in stream:
+                        if isinstance(event, LLMUsage):
+                            usage = event
+                        else:
+                            first_token.setdefault(index, time.monotonic() - started)
+                            chars += len(event)
+                        events.put_nowait((index, event))
+            events.put_nowait((index, None))
+        except Exception as exc:
+            failed = True
+            events.put_nowait((index, exc))
+        finally:
+            # O uso do vencedor entra pela chamada; o de quem perdeu (ou foi cancelado) entra aqui
+            if sent and not failed and call.winner != index:
+                await asyncio.to_thread(charge_llm_attempt, usage or LLMUsage(llm_prompt_tokens(prompt), chars // 4))
+
+    def launch():
+        tasks.append(asyncio.ensure_future(attempt(call.launch())))
+
+    launch()
+    try:
+        while True:
+            try:
+                index, event = await asyncio.wait_for(events.get(), timeout=call.next_launch_in())
+            except asyncio.TimeoutError:
+                launch()
+                continue
+            if call.winner is None:
+                if not call.settle(index, event):
+                    continue
+                for other, task in enumerate(tasks):
+                    if other != index:
+                        task.cancel()
+                if index in first_token:
+                    llm_latency.observe(targets[index], first_token[index])
+            elif index != call.winner:
+                continue
+            if isinstance(event, Exception):
+                raise event
+            if event is None:
+                return
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def llm_text_stream(task: str, prompt: tuple, timeout: float | None = None):
+    """Gera o texto da resposta da rota de `task` (com hedge, se ativo) e, por último, o LLMUsage.
+
+    `prompt` é (system_prompt, user_prompt, max_tokens, temperature).
+    """
+    targets = llm_route(task)
+    if LLM_HEDGE_ENABLED and len(targets) > 1:
+        return _hedged_text_stream(targets, task, prompt, timeout)
+    return _target_text_stream(targets[0], prompt, timeout)
+
+
+def llm_text_astream(task: str, prompt: tuple, timeout: float | None = None):
+    """Versão assíncrona de llm_text_stream."""
+    targets = llm_route(task)
+    if LLM_HEDGE_ENABLED and len(targets) > 1:
+        return _hedged_text_astream(targets, task, prompt, timeout)
+    return _target_text_astream(targets[0], prompt, timeout)
+
+
+# =============================================================================
+# ESCALONADOR DA IA - Fila Justa por Tenant e Orçamento de Tokens
+# =============================================================================
+# As vagas de chamada à IA (LLM_MAX_CONCURRENCY por worker) são distribuídas por
+# fila justa ponderada entre os tenants: o dono da API key do header X-API-Key
+# (LLM_TENANT_API_KEYS) ou, sem uma key válida, o IP de origem ("ip:<endereço>").
+# Campos da requisição (ex: "cliente") nunca definem o tenant. A fatia de cada
+# tenant é proporcional ao seu peso e medida em tokens estimados. Chamadas
+# interativas passam na frente das de batch/jobs, que nunca ocupam mais que
+# LLM_BATCH_MAX_SHARE das vagas.
+# As vagas e a fila justa são de cada processo: com N workers, até N x
+# LLM_MAX_CONCURRENCY chamadas simultâneas, e a justiça vale dentro de cada worker
+# (o balanceamento do gunicorn espalha os tenants entre eles). Para respeitar o limite
+# de concorrência do provedor, use LLM_MAX_CONCURRENCY = limite / WEB_CONCURRENCY.
+# Já o orçamento de tokens por minuto e a contabilidade de uso (campo "usage" das
+# respostas) ficam no SQLite e valem para todos os workers do gunicorn.
+# LLM_BATCH_MAX_SHARE: fração das vagas que as chamadas de batch/jobs podem ocupar
+# LLM_TENANT_API_KEYS: API keys aceitas, "tenant=key" separados por vírgula
+# LLM_TENANT_WEIGHTS: pesos na fila justa, "tenant=peso" separados por vírgula (padrão 1)
+# LLM_TENANT_TOKENS_PER_MIN: orçamento de tokens por minuto de cada tenant (0 = sem limite)
+# LLM_TENANT_BUDGETS: orçamentos específicos, "tenant=tokens_por_minuto" separados por vírgula
+# LLM_BUDGET_MAX_WAIT: espera máxima (segundos) por orçamento; acima disso a resposta é 429
+# LLM_HEDGE_BUDGET_WAIT: espera máxima (segundos) por orçamento de uma tentativa de hedge;
+#   sem orçamento nesse tempo, o hedge não dispara (llm_scheduler_rejected_total{reason="budget"})
+# LLM_USAGE_RETENTION: segundos que o uso por minuto fica guardado (GET /llm/usage)
+LLM_BATCH_MAX_SHARE = float(os.getenv("LLM_BATCH_MAX_SHARE", "0.75"))
+LLM_TENANT_API_KEYS = os.getenv("LLM_TENANT_API_KEYS", "")
+LLM_TENANT_WEIGHTS = os.getenv("LLM_TENANT_WEIGHTS", "")
+LLM_TENANT_TOKENS_PER_MIN = float(os.getenv("LLM_TENANT_TOKENS_PER_MIN", "0"))
+LLM_TENANT_BUDGETS = os.getenv("LLM_TENANT_BUDGETS", "")
+LLM_BUDGET_MAX_WAIT = float(os.getenv("LLM_BUDGET_MAX_WAIT", "10"))
+LLM_HEDGE_BUDGET_WAIT = float(os.getenv("LLM_HEDGE_BUDGET_WAIT", "0"))
+LLM_USAGE_RETENTION = float(os.getenv("LLM_USAGE_RETENTION", "604800"))
+
+# Filas em ordem de prioridade
+LLM_LANES = ("interactive", "batch")
+LLMTenant = namedtuple("LLMTenant", "name lane")
+current_llm_tenant = contextvars.ContextVar("current_llm_tenant", default=None)
+# Chamadas fora de uma requisição (warm-up, scripts)
+LLM_SYSTEM_TENANT = LLMTenant("sistema", "batch")
+
+
+class LLMBudgetExceeded(Exception):
+    """Tenant sem orçamento de tokens para chamar a IA agora (a resposta é 429 com Retry-After)."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def budget_exceeded_response(e: LLMBudgetExceeded):
+    """Resposta 429 com Retry-After para um tenant sem orçamento de tokens."""
+    response = jsonify({"success": False, "error": str(e)})
+    response.headers["Retry-After"] = str(int(e.retry_after) + 1)
+    return response, 429
+
+
+def tenant_name(name: str | None) -> str:
+    """Nome normalizado de um tenant (minúsculas, espaços simples)."""
+    return " ".join(str(name or "").lower().split())[:80] or "anonimo"
+
+
+def _api_key_hash(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def _parse_tenant_api_keys(spec: str) -> dict:
+    """"agencia x=chave1,cliente y=chave2" -> {sha256(chave): tenant}."""
+    keys = {}
+    for entry in filter(None, (item.strip() for item in spec.split(","))):
+        name, _, api_key = entry.partition("=")
+        if not name.strip() or not api_key.strip():
+            print("[IA] Entrada inválida em LLM_TENANT_API_KEYS (use tenant=key)")
+            continue
+        keys[_api_key_hash(api_key.strip())] = tenant_name(name)
+    return keys
+
+
+llm_tenant_api_keys = _parse_tenant_api_keys(LLM_TENANT_API_KEYS)
+
+
+def request_tenant_name(api_key: str | None, remote_addr: str | None) -> str:
+    """Tenant autenticado pela API key (LLM_TENANT_API_KEYS) ou, sem uma key válida, o IP de origem."""
+    tenant = llm_tenant_api_keys.get(_api_key_hash(api_key)) if api_key else None
+    return tenant or f"ip:{remote_addr or 'desconhecido'}"
+
+
+def derive_llm_tenant(lane: str) -> LLMTenant:
+    """Tenant de um trabalho iniciado pela requisição atual (registro de batch, job), na fila `lane`."""
+    current = current_llm_tenant.get() or LLM_SYSTEM_TENANT
+    return LLMTenant(current.name, lane)
+
+
+@contextmanager
+def llm_tenant_scope(tenant: LLMTenant):
+    """Define o tenant das chamadas à IA feitas no bloco (e nas threads criadas com with_trace)."""
+    token = current_llm_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        current_llm_tenant.reset(token)
+
+
+def _parse_tenant_values(spec: str, variable: str) -> dict:
+    """"agencia x=2,ip:203.0.113.7=0.5" -> {tenant: valor} (entradas inválidas são ignoradas)."""
+    values = {}
+    for entry in filter(None, (item.strip() for item in spec.split(","))):
+        name, _, value = entry.rpartition("=")
+        try:
+            values[tenant_name(name)] = float(value)
+        except ValueError:
+            print(f"[IA] Entrada inválida em {variable}: '{entry}' (use tenant=valor)")
+    return values
+
+
+class _LLMTicket:
+    """Pedido de vaga na fila: aguardando, concedido ou desistido (timeout)."""
+
+    __slots__ = ("tenant", "start", "notify", "state")
+
+    def __init__(self, tenant: LLMTenant, notify):
+        self.tenant = tenant
+        self.notify = notify
+        self.start = 0.0
+        self.state = "waiting"
+
+
+class FairLLMScheduler:
+    """Vagas de chamada à IA distribuídas por fila justa ponderada (start-time fair queueing).
+
+    Cada pedido recebe a etiqueta max(tempo virtual da fila, fim do último pedido do
+    tenant) e avança o tenant em custo/peso; a vaga livre vai para a menor etiqueta.
+    A fila interativa tem prioridade e a de batch ocupa no máximo `batch_limit` vagas.
+    Serve tanto as threads (acquire) quanto o event loop assíncrono (acquire_async).
+    """
+
+    def __init__(self, slots: int, batch_share: float, weights: dict):
+        self.slots = max(1, slots)
+        self.batch_limit = max(1, min(self.slots, round(self.slots * batch_share)))
+        self.weights = weights
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._queues = {lane: [] for lane in LLM_LANES}
+        self._virtual = dict.fromkeys(LLM_LANES, 0.0)
+        self._running = dict.fromkeys(LLM_LANES, 0)
+        self._finish = {}
+
+    def _enqueue(self, tenant: LLMTenant, cost: float, notify) -> _LLMTicket:
+        ticket = _LLMTicket(tenant, notify)
+        key = (tenant.lane, tenant.name)
+        with self._lock:
+            ticket.start = max(self._virtual[tenant.lane], self._finish.get(key, 0.0))
+            self._finish[key] = ticket.start + cost / max(0.01, self.weights.get(tenant.name, 1.0))
+            heapq.heappush(self._queues[tenant.lane], (ticket.start, next(self._seq), ticket))
+            if len(self._finish) > 10000:
+                # Tenants que ficaram para trás do tempo virtual recomeçam dele
+                self._finish = {k: tag for k, tag in self._finish.items() if tag > self._virtual[k[0]]}
+            self._dispatch()
+        return ticket
+
+    def _pop(self, lane: str) -> _LLMTicket | None:
+        queue_ = self._queues[lane]
+        while queue_:
+            _, _, ticket = heapq.heappop(queue_)
+            if ticket.state == "waiting":
+                return ticket
+        return None
+
+    def _dispatch(self):
+        """Concede as vagas livres (chamado com o lock)."""
+        while sum(self._running.values()) < self.slots:
+            ticket = self._pop("interactive")
+            if ticket is None and self._running["batch"] < self.batch_limit:
+                ticket = self._pop("batch")
+            if ticket is None:
+                return
+            lane = ticket.tenant.lane
+            ticket.state = "granted"
+            self._running[lane] += 1
+            self._virtual[lane] = ticket.start
+            ticket.notify()
+
+    def _give_up(self, ticket: _LLMTicket) -> bool:
+        """Desiste do pedido; False se a vaga já tinha sido concedida (e deve ser usada ou devolvida)."""
+        with self._lock:
+            if ticket.state == "granted":
+                return False
+            ticket.state = "cancelled"
+            return True
+
+    def _observe(self, ticket: _LLMTicket, started: float, granted: bool):
+        lane = ticket.tenant.lane
+        metrics.observe("llm_queue_wait_seconds", time.monotonic() - started, lane=lane)
+        if not granted:
+            metrics.inc("llm_scheduler_rejected_total", lane=lane, reason="queue_timeout")
+
+    def acquire(self, tenant: LLMTenant, cost: float, timeout: float | None = None) -> _LLMTicket | None:
+        """Espera uma vaga por até `timeout` segundos. Retorna o ticket (devolva com release) ou None."""
+        granted = threading.Event()
+        started = time.monotonic()
+        ticket = self._enqueue(tenant, cost, granted.set)
+        if not granted.wait(timeout) and self._give_up(ticket):
+            self._observe(ticket, started, granted=False)
+            return None
+        self._observe(ticket, started, granted=True)
+        return ticket
+
+    async def acquire_async(self, tenant: LLMTenant, cost: float, timeout: float | None = None) -> _LLMTicket | None:
+        """Versão assíncrona de acquire (a vaga é avisada ao event loop com call_soon_threadsafe)."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        started = time.monotonic()
+        ticket = self._enqueue(tenant, cost, notify)
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), timeout)
+        except asyncio.TimeoutError:
+            if self._give_up(ticket):
+                self._observe(ticket, started, granted=False)
+                return None
+        except asyncio.CancelledError:
+            if not self._give_up(ticket):
+                self.release(ticket)
+            raise
+        self._observe(ticket, started, granted=True)
+        return ticket
+
+    def release(self, ticket: _LLMTicket):
+        with self._lock:
+            self._running[ticket.tenant.lane] -= 1
+            self._dispatch()
+
+    def stats(self) -> dict:
+        with self._lock:
+            waiting = {lane: [entry[2].tenant.name for entry in self._queues[lane] if entry[2].state == "waiting"]
+                       for lane in LLM_LANES}
+            return {
+                "slots": self.slots,
+                "batch_limit": self.batch_limit,
+                "running": dict(self._running),
+                "queued": {lane: len(names) for lane, names in waiting.items()},
+                "queued_tenants": len({name for names in waiting.values() for name in names})
+            }
+
+
+_llm_ledger_ready = False
+
+
+def llm_ledger_db() -> sqlite3.Connection:
+    """Banco compartilhado do orçamento e do uso de tokens por tenant."""
+    global _llm_ledger_ready
+    conn = get_sqlite("llm_ledger")
+    if not _llm_ledger_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_budgets (
+                tenant TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_usage (
+                tenant TEXT NOT NULL,
+                minute INTEGER NOT NULL,
+                lane TEXT NOT NULL,
+                calls INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (tenant, minute, lane)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_minute ON llm_usage (minute)")
+        conn.commit()
+        _llm_ledger_ready = True
+    return conn
+
+
+class TenantTokenLedger:
+    """Orçamento de tokens por minuto (token bucket por tenant) e contabilidade de uso, no SQLite.
+
+    A chamada reserva a estimativa (prompt + max_tokens) e, ao terminar, o uso real
+    informado pelo provedor substitui a reserva. Sem uso informado, a reserva fica se a
+    chamada terminou e é devolvida se ela falhou.
+    """
+
+    # A cada N registros de uso, remove os minutos mais antigos que LLM_USAGE_RETENTION
+    PURGE_INTERVAL = 500
+
+    def __init__(self, default_per_min: float, budgets: dict):
+        self.default_per_min = default_per_min
+        self.budgets = budgets
+        self._writes = 0
+
+    def limit(self, tenant: str) -> float:
+        """Tokens por minuto do tenant (0 = sem limite)."""
+        return self.budgets.get(tenant, self.default_per_min)
+
+    def _try_reserve(self, tenant: str, amount: float) -> float:
+        """Reserva `amount` tokens. Retorna 0 se conseguiu, senão os segundos até haver orçamento."""
+        per_min = self.limit(tenant)
+        if per_min <= 0:
+            return 0.0
+        rate = per_min / 60
+        # Uma chamada maior que o orçamento inteiro espera o bucket encher
+        amount = min(amount, per_min)
+        conn = llm_ledger_db()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM llm_budgets WHERE tenant = ?", (tenant,)).fetchone()
+            tokens = per_min if not row else min(per_min, row[0] + (now - row[1]) * rate)
+            wait_time = 0.0
+            if tokens >= amount:
+                tokens -= amount
+            else:
+                wait_time = (amount - tokens) / rate
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_budgets (tenant, tokens, updated_at) VALUES (?, ?, ?)",
+                (tenant, tokens, now)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return wait_time
+
+    def reserve(self, tenant: str, amount: float, timeout: float) -> float:
+        """Espera até `timeout` segundos pelo orçamento. Retorna 0 se reservou, senão o Retry-After.
+
+        Se a espera necessária passa de `timeout`, desiste na hora (sem dormir à toa).
+        """
+        expires_at = time.monotonic() + timeout
+        while True:
+            wait_time = self._try_reserve(tenant, amount)
+            if wait_time == 0:
+                return 0.0
+            if wait_time > expires_at - time.monotonic():
+                return wait_time
+            time.sleep(wait_time)
+
+    async def reserve_async(self, tenant: str, amount: float, timeout: float) -> float:
+        """Versão assíncrona de reserve (o SQLite é acessado em uma thread, sem travar o event loop)."""
+        expires_at = time.monotonic() + timeout
+        while True:
+            wait_time = await asyncio.to_thread(self._try_reserve, tenant, amount)
+            if wait_time == 0:
+                return 0.0
+            if wait_time > expires_at - time.monotonic():
+                return wait_time
+            await asyncio.sleep(wait_time)
+
+    def settle(self, tenant: LLMTenant, reserved: float, usage=None):
+        """Troca a reserva pelo uso real (LLMUsage) e o contabiliza no minuto atual."""
+        conn = llm_ledger_db()
+        per_min = self.limit(tenant.name)
+        if usage and per_min > 0:
+            refund = min(reserved, per_min) - (usage.prompt_tokens + usage.completion_tokens)
+            conn.execute("UPDATE llm_budgets SET tokens = MIN(?, tokens + ?) WHERE tenant = ?",
+                         (per_min, refund, tenant.name))
+        minute = int(time.time() // 60) * 60
+        conn.execute("""
+            INSERT INTO llm_usage (tenant, minute, lane, calls, prompt_tokens, completion_tokens)
+            VALUES (?, ?, ?, 1, ?, ?)
+            ON CONFLICT (tenant, minute, lane) DO UPDATE SET
+                calls = calls + 1,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens
+        """, (tenant.name, minute, tenant.lane, usage.prompt_tokens if usage else 0,
+              usage.completion_tokens if usage else 0))
+        self._writes += 1
+        if self._writes % self.PURGE_INTERVAL == 0:
+            conn.execute("DELETE FROM llm_usage WHERE minute < ?", (time.time() - LLM_USAGE_RETENTION,))
+        conn.commit()
+
+    def release(self, tenant: str, reserved: float):
+        """Devolve uma reserva que não chegou a ser usada."""
+        per_min = self.limit(tenant)
+        if per_min > 0:
+            conn = llm_ledger_db()
+            conn.execute("UPDATE llm_budgets SET tokens = MIN(?, tokens + ?) WHERE tenant = ?",
+                         (per_min, min(reserved, per_min), tenant))
+            conn.commit()
+
+    def summary(self, minutes: int, tenant: str | None = None) -> list:
+        """Uso por tenant nos últimos `minutes` minutos (mais tokens primeiro)."""
+        query = ("SELECT tenant, lane, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens) "
+                 "FROM llm_usage WHERE minute >= ?")
+        args = [int(time.time() // 60 - minutes + 1) * 60]
+        if tenant:
+            query += " AND tenant = ?"
+            args.append(tenant)
+        tenants = {}
+        for name, lane, calls, prompt_tokens, completion_tokens in llm_ledger_db().execute(
+                query + " GROUP BY tenant, lane", args):
+            entry = tenants.setdefault(name, {
+                "tenant": name, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "tokens_per_min_limit": self.limit(name) or None, "lanes": {}
+            })
+            entry["calls"] += calls
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["lanes"][lane] = {"calls": calls, "prompt_tokens": prompt_tokens,
+                                    "completion_tokens": completion_tokens}
+        return sorted(tenants.values(), key=lambda item: item["prompt_tokens"] + item["completion_tokens"],
+                      reverse=True)
+
+
+llm_scheduler = FairLLMScheduler(LLM_MAX_CONCURRENCY, LLM_BATCH_MAX_SHARE,
+                                 _parse_tenant_values(LLM_TENANT_WEIGHTS, "LLM_TENANT_WEIGHTS"))
+llm_ledger = TenantTokenLedger(LLM_TENANT_TOKENS_PER_MIN,
+                               _parse_tenant_values(LLM_TENANT_BUDGETS, "LLM_TENANT_BUDGETS"))
+
+
+def llm_prompt_tokens(prompt: tuple) -> int:
+    """Tokens estimados do prompt (~4 caracteres por token)."""
+    system_prompt, user_prompt, _, _ = prompt
+    return (len(system_prompt) + len(user_prompt)) // 4
+
+
+def llm_call_cost(prompt: tuple) -> int:
+    """Tokens estimados de uma chamada: prompt + max_tokens."""
+    return llm_prompt_tokens(prompt) + prompt[2]
+
+
+def _budget_exceeded(tenant: LLMTenant, retry_after: float) -> LLMBudgetExceeded:
+    metrics.inc("llm_scheduler_rejected_total", lane=tenant.lane, reason="budget")
+    print(f"[IA] Orçamento de tokens esgotado para '{tenant.name}' (Retry-After {retry_after:.0f}s)")
+    return LLMBudgetExceeded(f"Limite de uso da IA atingido para este cliente. "
+                             f"Tente novamente em {int(retry_after) + 1}s", retry_after)
+
+
+@contextmanager
+def llm_call_slot(output_name: str, prompt: tuple, collector):
+    """Reserva o orçamento do tenant atual e uma vaga na fila justa (esperas limitadas ao prazo).
+
+    Levanta LLMBudgetExceeded sem orçamento e DeadlineExceeded sem vaga a tempo.
+    Ao sair, devolve a vaga e contabiliza o uso real (collector.usage); se a chamada
+    falhar sem uso informado, a reserva é devolvida.
+    """
+    tenant = current_llm_tenant.get() or LLM_SYSTEM_TENANT
+    cost = llm_call_cost(prompt)
+    retry_after = llm_ledger.reserve(tenant.name, cost, deadline_remaining(LLM_BUDGET_MAX_WAIT))
+    if retry_after:
+        raise _budget_exceeded(tenant, retry_after)
+    ticket = llm_scheduler.acquire(tenant, cost, timeout=deadline_remaining())
+    if ticket is None:
+        llm_ledger.release(tenant.name, cost)
+        record_cut(f"llm.{output_name}", "skipped")
+        raise DeadlineExceeded("Sem vaga para chamar a IA dentro do prazo")
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        llm_scheduler.release(ticket)
+        if failed and not collector.usage:
+            llm_ledger.release(tenant.name, cost)
+        else:
+            llm_ledger.settle(tenant, cost, collector.usage)
+
+
+@asynccontextmanager
+async def llm_call_slot_async(output_name: str, prompt: tuple, collector):
+    """Versão assíncrona de llm_call_slot (o SQLite do orçamento é acessado fora do event loop)."""
+    tenant = current_llm_tenant.get() or LLM_SYSTEM_TENANT
+    cost = llm_call_cost(prompt)
+    retry_after = await llm_ledger.reserve_async(tenant.name, cost, deadline_remaining(LLM_BUDGET_MAX_WAIT))
+    if retry_after:
+        raise _budget_exceeded(tenant, retry_after)
+    ticket = await llm_scheduler.acquire_async(tenant, cost, timeout=deadline_remaining())
+    if ticket is None:
+        await asyncio.to_thread(llm_ledger.release, tenant.name, cost)
+        record_cut(f"llm.{output_name}", "skipped")
+        raise DeadlineExceeded("Sem vaga para chamar a IA dentro do prazo")
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        llm_scheduler.release(ticket)
+        if failed and not collector.usage:
+            await asyncio.to_thread(llm_ledger.release, tenant.name, cost)
+        else:
+            await asyncio.to_thread(llm_ledger.settle, tenant, cost, collector.usage)
+
+
+@asynccontextmanager
+async def llm_hedge_slot_async(output_name: str, prompt: tuple):
+    """Vaga e reserva de uma tentativa alternativa de hedge (sem orçamento em LLM_HEDGE_BUDGET_WAIT, ela não dispara).
+
+    A reserva só limita o disparo e é devolvida ao sair: o uso é contabilizado por charge_llm_attempt.
+    """
+    tenant = current_llm_tenant.get() or LLM_SYSTEM_TENANT
+    cost = llm_call_cost(prompt)
+    retry_after = await llm_ledger.reserve_async(tenant.name, cost, deadline_remaining(LLM_HEDGE_BUDGET_WAIT))
+    if retry_after:
+        raise _budget_exceeded(tenant, retry_after)
+    ticket = await llm_scheduler.acquire_async(tenant, cost, timeout=deadline_remaining())
+    if ticket is None:
+        await asyncio.to_thread(llm_ledger.release, tenant.name, cost)
+        record_cut(f"llm.{output_name}", "skipped")
+        raise DeadlineExceeded("Sem vaga para o hedge dentro do prazo")
+    try:
+        yield
+    finally:
+        llm_scheduler.release(ticket)
+        await asyncio.to_thread(llm_ledger.release, tenant.name, cost)
+
+
+def charge_llm_attempt(usage: LLMUsage):
+    """Contabiliza para o tenant atual o uso de uma tentativa descartada (perdedora de um hedge)."""
+    llm_ledger.settle(current_llm_tenant.get() or LLM_SYSTEM_TENANT, 0, usage)
+
+
+# =============================================================================
+# LLM - Chamadas à IA com Cache de Respostas
+# =============================================================================
+
+# Cache de respostas da IA, endereçado pelo hash de (modelo, prompts, temperatura, max_tokens)
+# LLM_CACHE_DEFAULT_MODE: modo usado quando a requisição não informa "cache"
+#   bypass = sempre chama a IA (e atualiza o cache)
+#   prefer = usa o cache se existir, senão chama a IA
+#   only   = responde apenas do cache (erro 404 se não existir)
+LLM_CACHE_MODES = ("bypass", "prefer", "only")
+LLM_CACHE_DEFAULT_MODE = os.getenv("LLM_CACHE_DEFAULT_MODE", "bypass")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "604800"))
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "500"))
+LLM_CACHE_DISK_ITEMS = int(os.getenv("LLM_CACHE_DISK_ITEMS", "20000"))
+
+llm_cache = TieredCache(
+    "llm",
+    ttl=LLM_CACHE_TTL,
+    max_memory_items=LLM_CACHE_MEMORY_ITEMS,
+    max_disk_items=LLM_CACHE_DISK_ITEMS,
+)
+
+
+class LLMCacheMiss(Exception):
+    """Resposta não encontrada no cache quando a requisição exige cache="only"."""
+
+
+# Falhas do provedor (HTTP, conexão, timeout) ou da resposta (JSON inválido)
+LLM_FALLBACK_ERRORS = (OpenAIError, AnthropicError, httpx.HTTPError, TimeoutError, ValueError)
+
+
+def llm_cache_key(model: str, system_prompt: str, user_prompt: str, temperature: float, max_tokens: int) -> str:
+    """Gera a chave de cache (sha256) para uma chamada à IA."""
+    payload = json.dumps([model, system_prompt, user_prompt, temperature, max_tokens], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class JSONStreamParser:
+    """Parser incremental de JSON: devolve cada item de uma coleção assim que ele fecha.
+
+    Coleções são o array raiz ([{...}, {...}]) ou os arrays no primeiro nível de um
+    objeto raiz ({"titulos": [...]}). Texto fora do JSON (como ```json) é ignorado e
+    um item malformado é descartado sem invalidar os demais.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_key = None
+        self._key = None
+        self._item_start = None
+        self.finished = False
+        self.malformed = 0
+
+    @property
+    def buffer(self) -> str:
+        return self._buffer
+
+    def _at_collection(self) -> bool:
+        return self._stack == ["["] or self._stack == ["{", "["]
+
+    def _emit(self, items: list, end: int):
+        text = self._buffer[self._item_start:end].strip()
+        self._item_start = None
+        try:
+            items.append((self._key, json.loads(text)))
+        except json.JSONDecodeError:
+            self.malformed += 1
+
+    def feed(self, chunk: str) -> list:
+        """Adiciona um trecho da resposta e retorna os itens completos como (chave, valor).
+
+        A chave é o campo do objeto raiz ("titulos") ou None quando a raiz é um array.
+        """
+        self._buffer += chunk
+        items = []
+
+        while self._pos < len(self._buffer) and not self.finished:
+            char = self._buffer[self._pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._item_start is not None and self._item_start == self._string_start:
+                        self._emit(items, self._pos + 1)
+                    elif self._stack == ["{"]:
+                        self._last_key = self._buffer[self._string_start:self._pos + 1]
+            elif not self._stack:
+                if char in "[{":
+                    self._stack.append(char)
+            else:
+                if self._at_collection() and self._item_start is None and char not in " \t\r\n,]":
+                    self._item_start = self._pos
+
+                if char == '"':
+                    self._in_string = True
+                    self._string_start = self._pos
+                elif char == ":" and self._stack == ["{"] and self._last_key:
+                    try:
+                        self._key = json.loads(self._last_key)
+                    except json.JSONDecodeError:
+                        self._key = None
+                elif char == "," and self._at_collection() and self._item_start is not None:
+                    # Fim de um item escalar (número, true, null...)
+                    self._emit(items, self._pos)
+                elif char in "[{":
+                    self._stack.append(char)
+                elif char in "]}":
+                    if self._at_collection() and self._item_start is not None:
+                        self._emit(items, self._pos)
+                    self._stack.pop()
+                    if self._at_collection() and self._item_start is not None:
+                        self._emit(items, self._pos + 1)
+                    if not self._stack:
+                        self.finished = True
+
+            self._pos += 1
+
+        return items
+
+
+# Schemas da resposta da IA: cada item é validado individualmente
+NonEmptyStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
+
+class WinningAd(BaseModel):
+    titulo: NonEmptyStr
+    descricao: NonEmptyStr
+    cta: str = ""
+
+
+class AdGroup(BaseModel):
+    termo_real: NonEmptyStr
+    intencao: str = "Meio de Funil"
+    anuncio_vencedor: WinningAd
+    por_que_funciona: str = ""
+
+
+class StructuredOutput:
+    """Formato esperado da resposta da IA.
+
+    `item_model`: a resposta é um array de objetos desse modelo.
+    `fields`: a resposta é um objeto cujos campos são listas de itens do tipo indicado.
+    `name` identifica a saída nas métricas.
+    """
+
+    def __init__(self, name: str, item_model=None, fields: dict | None = None):
+        self.name = name
+        self.fields = fields
+        if fields is None:
+            self._adapters = {None: TypeAdapter(item_model)}
+        else:
+            self._adapters = {key: TypeAdapter(item_type) for key, item_type in fields.items()}
+
+    def empty(self):
+        return [] if self.fields is None else {key: [] for key in self.fields}
+
+    def validate(self, key, value) -> tuple:
+        """Retorna (válido, item) para um item da coleção `key`."""
+        adapter = self._adapters.get(key)
+        if adapter is None:
+            return False, None
+        try:
+            item = adapter.validate_python(value)
+        except ValidationError:
+            return False, None
+        return True, item.model_dump() if isinstance(item, BaseModel) else item
+
+    def add(self, result, key, item):
+        if self.fields is None:
+            result.append(item)
+        else:
+            result[key].append(item)
+
+    def count(self, result) -> int:
+        return len(result) if self.fields is None else sum(len(items) for items in result.values())
+
+
+AD_GROUPS_OUTPUT = StructuredOutput("ad_groups", item_model=AdGroup)
+ASSETS_OUTPUT = StructuredOutput("assets", fields={"titulos": NonEmptyStr, "descricoes": NonEmptyStr})
+KEYWORDS_OUTPUT = StructuredOutput("keywords", fields={"keywords": NonEmptyStr})
+
+
+class StructuredCollector:
+    """Junta os itens válidos de uma resposta em streaming, descartando apenas os inválidos."""
+
+    def __init__(self, output: StructuredOutput):
+        self.output = output
+        self.parser = JSONStreamParser()
+        self.result = output.empty()
+        self.rejected = 0
+        self.parse_seconds = 0.0
+        self.usage = None
+        # Leitura interrompida pelo prazo da requisição
+        self.cut_short = False
+
+    def feed(self, chunk: str) -> list:
+        """Processa um trecho da resposta e retorna os novos itens válidos como (chave, item)."""
+        started = time.perf_counter()
+        accepted = []
+        for key, value in self.parser.feed(chunk):
+            valid, item = self.output.validate(key, value)
+            if not valid:
+                self.rejected += 1
+                continue
+            self.output.add(self.result, key, item)
+            accepted.append((key, item))
+        self.parse_seconds += time.perf_counter() - started
+        return accepted
+
+    def feed_chunk(self, chunk) -> list:
+        """Processa um item do stream do provedor (texto ou, no último, o LLMUsage)."""
+        if isinstance(chunk, LLMUsage):
+            self.usage = chunk
+            return []
+        return self.feed(chunk)
+
+    @property
+    def complete(self) -> bool:
+        """JSON fechado sem nenhum item descartado (só assim a resposta vai para o cache)."""
+        return self.parser.finished and not self.rejected and not self.parser.malformed
+
+    def finish(self):
+        """Retorna o resultado; levanta json.JSONDecodeError se nenhum item válido foi salvo.
+
+        Também registra nas métricas o tempo de parsing, o uso de tokens e o resultado da chamada.
+        """
+        name = self.output.name
+        record_stage(f"llm_json_parse.{name}", self.parse_seconds)
+        if self.usage:
+            metrics.inc("llm_tokens_total", self.usage.prompt_tokens or 0, output=name, kind="prompt")
+            metrics.inc("llm_tokens_total", self.usage.completion_tokens or 0, output=name, kind="completion")
+        result = "ok" if self.complete else "partial" if self.output.count(self.result) else "invalid"
+        metrics.inc("llm_requests_total", output=name, result=result)
+
+        if not self.output.count(self.result):
+            buffer = self.parser.buffer
+            raise json.JSONDecodeError("Nenhum item válido na resposta da IA", buffer, len(buffer))
+        if not self.complete:
+            print(f"[IA] Resposta aproveitada parcialmente: {self.output.count(self.result)} itens válidos, "
+                  f"{self.rejected + self.parser.malformed} descartados")
+        return self.result
+
+
+def _cached_llm_result(cache_key: str, cache_mode: str, output: StructuredOutput) -> tuple:
+    """Consulta o cache conforme `cache_mode`. Retorna (encontrado, valor)."""
+    if cache_mode in ("prefer", "only"):
+        found, cached = llm_cache.get(cache_key)
+        if found:
+            metrics.inc("llm_requests_total", output=output.name, result="cache_hit")
+            return True, cached
+        if cache_mode == "only":
+            raise LLMCacheMiss("Resposta não encontrada no cache (cache=\"only\")")
+    return False, None
+
+
+def _llm_call_budget(output: StructuredOutput) -> float | None:
+    """Tempo disponível para uma chamada à IA no prazo atual (None = sem prazo).
+
+    Com menos de DEADLINE_MIN_LLM_CALL segundos, a chamada é pulada (DeadlineExceeded);
+    com o pipeline cancelado, nem começa (PipelineCancelled).
+    """
+    check_cancelled(current_cancel.get())
+    remaining = deadline_remaining()
+    if remaining is not None and remaining < DEADLINE_MIN_LLM_CALL:
+        record_cut(f"llm.{output.name}", "skipped")
+        raise DeadlineExceeded(f"Sem tempo para chamar a IA ({remaining:.1f}s restantes)")
+    return remaining
+
+
+def _consume_llm_stream(prompt: tuple, collector: StructuredCollector):
+    """Chama a rota da tarefa, alimenta o coletor e gera os itens válidos assim que fecham.
+
+    O stream é lido até o fim para receber o uso de tokens (texto após o JSON é ignorado).
+    Dentro de um prazo, o timeout é o tempo restante e não há retentativas; se ele acabar
+    no meio (ou a IA não responder a tempo), a leitura para e `collector.cut_short` fica True.
+    Com o pipeline cancelado, a leitura para e fecha o stream (PipelineCancelled).
+    """
+    deadline = current_deadline.get()
+    cancel_event = current_cancel.get()
+    stream = llm_text_stream(collector.output.name, prompt, timeout=deadline_remaining())
+    try:
+        with trace_span(f"llm_call.{collector.output.name}"):
+            for chunk in stream:
+                check_cancelled(cancel_event)
+                yield from collector.feed_chunk(chunk)
+                if deadline and deadline.expired():
+                    collector.cut_short = True
+                    break
+    except LLM_TIMEOUT_ERRORS:
+        if deadline is None:
+            raise
+        collector.cut_short = True
+    finally:
+        stream.close()
+
+
+def _deadline_partial_result(collector: StructuredCollector):
+    """Itens já fechados de uma resposta cortada pelo prazo (não vão para o cache nem são compartilhados)."""
+    count = collector.output.count(collector.result)
+    record_cut(f"llm.{collector.output.name}", "partial" if count else "timeout", items=count)
+    if not count:
+        raise DeadlineExceeded("A IA não concluiu nenhum item dentro do prazo da requisição")
+    return collector.finish()
+
+
+def request_llm_json(system_prompt: str, user_prompt: str, max_tokens: int, temperature: float,
+                     output: StructuredOutput, cache_mode: str = "bypass"):
+    """Chama a IA (streaming) e retorna a resposta validada por `output`, consultando o cache conforme `cache_mode`.
+
+    Itens inválidos são descartados e os válidos aproveitados; levanta json.JSONDecodeError
+    apenas se nenhum item for válido e LLMCacheMiss se `cache_mode` for "only" e não houver cache.
+    Apenas respostas completas e sem itens descartados são gravadas no cache.
+    Dentro do prazo da requisição, devolve os itens concluídos até ele acabar
+    (DeadlineExceeded se nenhum).
+    """
+    cache_key = llm_cache_key(llm_route(output.name)[0].cache_model, system_prompt, user_prompt,
+                              temperature, max_tokens)
+    found, cached = _cached_llm_result(cache_key, cache_mode, output)
+    if found:
+        return cached
+
+    flight = llm_flights.begin(cache_key, timeout=_llm_call_budget(output))
+    if not flight.leader:
+        return flight.result
+
+    with flight:
+        collector = StructuredCollector(output)
+        prompt = (system_prompt, user_prompt, max_tokens, temperature)
+        with llm_call_slot(output.name, prompt, collector):
+            for _ in _consume_llm_stream(prompt, collector):
+                pass
+
+        if collector.cut_short:
+            return _deadline_partial_result(collector)
+        data = collector.finish()
+        if collector.complete:
+            llm_cache.set(cache_key, data)
+        flight.finish(data)
+    return data
+
+
+# Caminho assíncrono (clientes async dos provedores) para rodar várias chamadas à IA em paralelo
+# LLM_CALL_TIMEOUT: tempo máximo (segundos) de cada chamada assíncrona
+LLM_CALL_TIMEOUT = float(os.getenv("LLM_CALL_TIMEOUT", "60"))
+
+# Chamadas idênticas (mesma chave de cache) em andamento são feitas uma vez só
+llm_flights = SingleFlight("llm", lease_ttl=LLM_CALL_TIMEOUT * 2)
+
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+
+def get_async_loop() -> asyncio.AbstractEventLoop:
+    """Event loop dedicado (thread em segundo plano) compartilhado pelas chamadas assíncronas.
+
+    É criado na primeira chamada, já dentro do worker do gunicorn (após o fork).
+    """
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-async-loop", daemon=True).start()
+            _async_loop = loop
+    return _async_loop
+
+
+def submit_async(coro):
+    """Agenda uma corrotina no event loop compartilhado (com o trace, o prazo, o tenant e o cancelamento atuais).
+
+    Retorna um Future.
+    """
+    trace = current_trace.get()
+    deadline = current_deadline.get()
+    tenant = current_llm_tenant.get()
+    cancel_event = current_cancel.get()
+
+    async def traced():
+        current_trace.set(trace)
+        current_deadline.set(deadline)
+        current_llm_tenant.set(tenant)
+        current_cancel.set(cancel_event)
+        return await coro
+
+    return asyncio.run_coroutine_threadsafe(traced(), get_async_loop())
+
+
+def run_async(coro):
+    """Executa uma corrotina no event loop compartilhado e espera o resultado."""
+    return submit_async(coro).result()
+
+
+async def request_llm_json_async(system_prompt: str, user_prompt: str, max_tokens: int, temperature: float,
+                                 output: StructuredOutput, cache_mode: str = "bypass", timeout: float | None = None):
+    """Versão assíncrona de request_llm_json, com a fila justa compartilhada e tempo limite por chamada.
+
+    O tempo limite (e a espera pela vaga) nunca passa do prazo da requisição.
+    """
+    cache_key = llm_cache_key(llm_route(output.name)[0].cache_model, system_prompt, user_prompt,
+                              temperature, max_tokens)
+    found, cached = _cached_llm_result(cache_key, cache_mode, output)
+    if found:
+        return cached
+
+    flight = await llm_flights.begin_async(cache_key, timeout=_llm_call_budget(output))
+    if not flight.leader:
+        return flight.result
+
+    collector = StructuredCollector(output)
+    prompt = (system_prompt, user_prompt, max_tokens, temperature)
+
+    async def consume():
+        cancel_event = current_cancel.get()
+        with trace_span(f"llm_call.{output.name}"):
+            async with aclosing(llm_text_astream(output.name, prompt)) as stream:
+                async for chunk in stream:
+                    check_cancelled(cancel_event)
+                    collector.feed_chunk(chunk)
+
+    with flight:
+        call_timeout = timeout or LLM_CALL_TIMEOUT
+        async with llm_call_slot_async(output.name, prompt, collector):
+            try:
+                # O prazo da requisição encurta o tempo limite da chamada
+                limit = deadline_remaining(call_timeout)
+                await asyncio.wait_for(consume(), timeout=limit)
+            except asyncio.TimeoutError:
+                if limit >= call_timeout:
+                    metrics.inc("llm_requests_total", output=output.name, result="timeout")
+                    raise TimeoutError(f"A IA não respondeu em {call_timeout:g}s")
+                collector.cut_short = True
+
+        if collector.cut_short:
+            return _deadline_partial_result(collector)
+        data = collector.finish()
+        if collector.complete:
+            llm_cache.set(cache_key, data)
+        flight.finish(data)
+    return data
+
+
+def stream_llm_json_array(system_prompt: str, user_prompt: str, max_tokens: int, temperature: float,
+                          output: StructuredOutput, cache_mode: str = "bypass"):
+    """Chama a IA em modo streaming e gera cada item validado do array JSON assim que ele fica completo.
+
+    Usa a mesma chave de cache de request_llm_json: respostas em cache são
+    entregues de uma vez e a resposta completa é gravada ao final do stream.
+    """
+    cache_key = llm_cache_key(llm_route(output.name)[0].cache_model, system_prompt, user_prompt,
+                              temperature, max_tokens)
+    found, cached = _cached_llm_result(cache_key, cache_mode, output)
+    if found:
+        yield from cached
+        return
+
+    # Quem pega carona em uma chamada idêntica recebe os itens de uma vez, ao final
+    flight = llm_flights.begin(cache_key, timeout=_llm_call_budget(output))
+    if not flight.leader:
+        yield from flight.result
+        return
+
+    with flight:
+        collector = StructuredCollector(output)
+        prompt = (system_prompt, user_prompt, max_tokens, temperature)
+        with llm_call_slot(output.name, prompt, collector):
+            for _, item in _consume_llm_stream(prompt, collector):
+                yield item
+
+        if collector.cut_short:
+            _deadline_partial_result(collector)
+            return
+        collector.finish()
+        if collector.complete:
+            llm_cache.set(cache_key, collector.result)
+        flight.finish(collector.result)
+
+
+def get_cache_mode(data: dict) -> str | None:
+    """Lê o campo "cache" da requisição. Retorna None se o valor for inválido."""
+    cache_mode = str(data.get("cache") or LLM_CACHE_DEFAULT_MODE).strip().lower()
+    return cache_mode if cache_mode in LLM_CACHE_MODES else None
+
+
 # =============================================================================
 # AD-INTELLIGENCE - Análise e Modelagem de Anúncios
 # =============================================================================
@@ -185,8 +3655,8 @@ REQUISITOS TÉCNICOS:
 - Sem markdown, sem ```json, apenas o array JSON puro."""
 
 
-def analyze_and_model_ads(keywords: list, oferta: str, cliente: str, nicho: str, localizacao: str = "") -> list:
-    """Analisa palavras-chave reais e modela anúncios vencedores usando GPT-4o."""
+def build_ads_prompt(keywords: list, oferta: str, cliente: str, nicho: str, localizacao: str = "") -> str:
+    """Monta o prompt do usuário para a modelagem de anúncios."""
 
     # Limita a lista de keywords para não estourar o contexto
     keywords_sample = keywords[:50] if len(keywords) > 50 else keywords
@@ -194,7 +3664,7 @@ def analyze_and_model_ads(keywords: list, oferta: str, cliente: str, nicho: str,
 
     localizacao_info = f"\n- LOCALIZAÇÃO: {localizacao}" if localizacao else ""
 
-    user_prompt = f"""DADOS DO CLIENTE:
+    return f"""DADOS DO CLIENTE:
 - OFERTA: {oferta}
 - NOME/EMPRESA: {cliente}
 - NICHO/PÚBLICO: {nicho}{localizacao_info}
@@ -208,47 +3678,74 @@ Analise essas palavras-chave reais, identifique as com maior intenção de compr
 
 Retorne APENAS o JSON."""
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_AD_INTELLIGENCE},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=3000,
-            temperature=0.7
-        )
 
-        response_text = response.choices[0].message.content.strip()
+def validate_ad(ad: dict) -> dict:
+    """Valida e limpa um grupo de anúncio retornado pela IA."""
+    return {
+        "termo_real": ad.get("termo_real", "")[:100],
+        "intencao": ad.get("intencao", "Meio de Funil"),
+        "anuncio_vencedor": {
+            "titulo": ad.get("anuncio_vencedor", {}).get("titulo", "")[:40],
+            "descricao": ad.get("anuncio_vencedor", {}).get("descricao", "")[:500],
+            "cta": ad.get("anuncio_vencedor", {}).get("cta", "")[:25]
+        },
+        "por_que_funciona": ad.get("por_que_funciona", "")[:300]
+    }
+
 
-        # Remove marcadores markdown se presentes
-        if response_text.startswith("```json"):
-            response_text = response_text[7:]
-        if response_text.startswith("```"):
-            response_text = response_text[3:]
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
+def analyze_and_model_ads(keywords: list, oferta: str, cliente: str, nicho: str, localizacao: str = "",
+                          cache_mode: str = "bypass") -> list:
+    """Analisa palavras-chave reais e modela anúncios vencedores usando GPT-4o."""
 
-        response_text = response_text.strip()
-        ads_data = json.loads(response_text)
+    user_prompt = build_ads_prompt(keywords, oferta, cliente, nicho, localizacao)
+
+    try:
+        ads_data = request_llm_json(SYSTEM_PROMPT_AD_INTELLIGENCE, user_prompt, max_tokens=3000, temperature=0.7,
+                                    output=AD_GROUPS_OUTPUT, cache_mode=cache_mode)
 
         # Valida e limpa os dados
-        validated_ads = []
-        for ad in ads_data:
-            validated_ad = {
-                "termo_real": ad.get("termo_real", "")[:100],
-                "intencao": ad.get("intencao", "Meio de Funil"),
-                "anuncio_vencedor": {
-                    "titulo": ad.get("anuncio_vencedor", {}).get("titulo", "")[:40],
-                    "descricao": ad.get("anuncio_vencedor", {}).get("descricao", "")[:500],
-                    "cta": ad.get("anuncio_vencedor", {}).get("cta", "")[:25]
-                },
-                "por_que_funciona": ad.get("por_que_funciona", "")[:300]
-            }
-            validated_ads.append(validated_ad)
+        return [validate_ad(ad) for ad in ads_data]
+
+    except (LLMCacheMiss, DeadlineExceeded, LLMBudgetExceeded):
+        raise
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Erro ao processar resposta da IA: {str(e)}")
+    except Exception as e:
+        raise Exception(f"Erro na comunicação com a API: {str(e)}")
 
-        return validated_ads
 
+async def analyze_and_model_ads_async(keywords: list, oferta: str, cliente: str, nicho: str, localizacao: str = "",
+                                    cache_mode: str = "bypass") -> list:
+    """Versão assíncrona de analyze_and_model_ads."""
+
+    user_prompt = build_ads_prompt(keywords, oferta, cliente, nicho, localizacao)
+
+    try:
+        ads_data = await request_llm_json_async(SYSTEM_PROMPT_AD_INTELLIGENCE, user_prompt, max_tokens=3000,
+                                                temperature=0.7, output=AD_GROUPS_OUTPUT, cache_mode=cache_mode)
+        return [validate_ad(ad) for ad in ads_data]
+
+    except (LLMCacheMiss, DeadlineExceeded, LLMBudgetExceeded):
+        raise
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Erro ao processar resposta da IA: {str(e)}")
+    except Exception as e:
+        raise Exception(f"Erro na comunicação com a API: {str(e)}")
+
+
+def stream_analyze_and_model_ads(keywords: list, oferta: str, cliente: str, nicho: str, localizacao: str = "",
+                                 cache_mode: str = "bypass"):
+    """Versão em streaming de analyze_and_model_ads: gera cada anúncio assim que é concluído."""
+
+    user_prompt = build_ads_prompt(keywords, oferta, cliente, nicho, localizacao)
+
+    try:
+        for ad in stream_llm_json_array(SYSTEM_PROMPT_AD_INTELLIGENCE, user_prompt, max_tokens=3000, temperature=0.7,
+                                        output=AD_GROUPS_OUTPUT, cache_mode=cache_mode):
+            yield validate_ad(ad)
+
+    except (LLMCacheMiss, DeadlineExceeded, LLMBudgetExceeded):
+        raise
     except json.JSONDecodeError as e:
         raise ValueError(f"Erro ao processar resposta da IA: {str(e)}")
     except Exception as e:
@@ -285,8 +3782,12 @@ ESTRUTURA DE RESPOSTA (JSON PURO):
 Retorne APENAS o JSON bruto, sem markdown, sem explicações."""
 
 
-def generate_ai_keywords(ramo: str, localizacao: str, oferta: str, nicho: str) -> list:
-    """Gera keywords usando IA quando o scraper falha."""
+def generate_ai_keywords(ramo: str, localizacao: str, oferta: str, nicho: str, cache_mode: str = "bypass") -> list:
+    """Gera keywords usando IA quando o scraper falha.
+
+    Erros do provedor ou resposta inválida caem nas keywords genéricas; prazo
+    (DeadlineExceeded), orçamento (LLMBudgetExceeded) e cache="only" são repassados.
+    """
 
     user_prompt = f"""Gere 20 palavras-chave de alto volume para:
 
@@ -300,32 +3801,15 @@ Inclua variações com e sem a localização. Foque em termos que um potencial c
 Retorne APENAS o JSON."""
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_KEYWORDS_FALLBACK},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=1000,
-            temperature=0.7
-        )
-
-        response_text = response.choices[0].message.content.strip()
-
-        # Remove marcadores markdown se presentes
-        if response_text.startswith("```json"):
-            response_text = response_text[7:]
-        if response_text.startswith("```"):
-            response_text = response_text[3:]
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
-
-        response_text = response_text.strip()
-        data = json.loads(response_text)
+        data = request_llm_json(SYSTEM_PROMPT_KEYWORDS_FALLBACK, user_prompt, max_tokens=1000, temperature=0.7,
+                                output=KEYWORDS_OUTPUT, cache_mode=cache_mode)
 
         return data.get("keywords", [])
 
-    except Exception as e:
+    except (LLMCacheMiss, DeadlineExceeded, LLMBudgetExceeded):
+        # Prazo e orçamento esgotados não são falha da IA: quem chamou decide
+        raise
+    except LLM_FALLBACK_ERRORS as e:
         print(f"Erro ao gerar keywords com IA: {e}")
         # Fallback final: retorna keywords genéricas baseadas nos inputs
         return [
@@ -390,15 +3874,15 @@ REQUISITOS TÉCNICOS:
 - RESPEITE RIGOROSAMENTE os limites de caracteres"""
 
 
-def generate_responsive_assets(oferta: str, localizacao: str, ramo: str, keywords: list | None = None) -> dict:
-    """Gera 15 títulos e 4 descrições para Anúncios Responsivos do Google."""
+def build_assets_prompt(oferta: str, localizacao: str, ramo: str, keywords: list | None = None) -> str:
+    """Monta o prompt do usuário para os ativos do Anúncio Responsivo."""
 
     keywords_info = ""
     if keywords and len(keywords) > 0:
         top_keywords = keywords[:10]
         keywords_info = f"\n\nPALAVRAS-CHAVE REAIS (use como base):\n" + "\n".join([f"- {kw}" for kw in top_keywords])
 
-    user_prompt = f"""Gere ativos para Anúncio Responsivo de Pesquisa:
+    return f"""Gere ativos para Anúncio Responsivo de Pesquisa:
 
 OFERTA: {oferta}
 LOCALIZAÇÃO: {localizacao}
@@ -410,49 +3894,1737 @@ Gere:
 
 Retorne APENAS o JSON."""
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_ASSETS},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=2000,
-            temperature=0.8
-        )
 
-        response_text = response.choices[0].message.content.strip()
+# Limites do Google para Anúncios Responsivos de Pesquisa
+RSA_TITLE_COUNT = 15
+RSA_TITLE_MAX = 30
+RSA_DESCRIPTION_COUNT = 4
+RSA_DESCRIPTION_MAX = 90
+# Cobertura exigida pelo SYSTEM_PROMPT_ASSETS
+RSA_MIN_KEYWORD_TITLES = 5
+RSA_MIN_LOCATION_TITLES = 3
+# Rodadas de reparo pedindo à IA apenas os ativos que faltam (0 = só reparo local)
+RSA_REPAIR_ROUNDS = int(os.getenv("RSA_REPAIR_ROUNDS", "1"))
+
+# Palavras que não podem terminar um ativo encurtado ("Dentista em" -> "Dentista")
+DANGLING_WORDS = {"a", "o", "as", "os", "e", "ou", "de", "da", "do", "das", "dos", "em", "no", "na", "nos",
+                  "nas", "com", "para", "pra", "por", "sem", "seu", "sua", "seus", "suas", "um", "uma", "que",
+                  "ao", "à", "mais", "até"}
+
+
+def shorten_at_word_boundary(text: str, limit: int) -> str:
+    """Encurta o texto no limite de caracteres sem cortar palavras. Retorna "" se não sobrar texto útil."""
+    text = " ".join(str(text).split())
+    if len(text) <= limit:
+        return text
+
+    words = []
+    for word in text.split(" "):
+        if len(" ".join(words + [word])) > limit:
+            break
+        words.append(word)
+
+    while words and (words[-1].lower().strip(",;:-–") in DANGLING_WORDS or not words[-1].strip(",;:-–")):
+        words.pop()
+    shortened = " ".join(words).rstrip(",;:-– ")
+
+    # Menos da metade do texto útil: melhor pedir um ativo novo
+    return shortened if len(shortened) >= limit // 2 else ""
+
+
+def clean_asset(text, limit: int, is_title: bool) -> str:
+    """Normaliza um ativo: espaços, pontuação repetida e limite de caracteres."""
+    if not isinstance(text, str):
+        return ""
+    text = text.strip().strip('"').strip()
+    if is_title:
+        # O Google reprova exclamação em títulos
+        text = text.replace("!", "")
+    while "!!" in text or "??" in text:
+        text = text.replace("!!", "!").replace("??", "?")
+    return shorten_at_word_boundary(text, limit)
+
+
+def main_keyword_text(keywords: list | None, localizacao: str, ramo: str) -> str:
+    """Palavra-chave principal sem a localização ("dentista em curitiba" -> "dentista")."""
+    if not keywords:
+        return ramo.strip()
+    location_tokens = set(normalize_keyword(localizacao).split())
+    words = [word for word in str(keywords[0]).split() if normalize_keyword(word) not in location_tokens]
+    while words and words[-1].lower() in DANGLING_WORDS:
+        words.pop()
+    return " ".join(words) or ramo.strip()
+
+
+def _contains_terms(text: str, terms: str) -> bool:
+    normalized = f" {normalize_keyword(text)} "
+    return bool(terms) and f" {terms} " in normalized
+
+
+def repair_assets(assets_data: dict, keywords: list | None, localizacao: str, ramo: str,
+                  current: dict | None = None, reserve_for_llm: bool = True) -> tuple:
+    """Valida e repara localmente os ativos RSA.
+
+    Encurta no limite de palavra, remove duplicados e garante a cobertura mínima de
+    palavra-chave e localização (com modelos locais quando couberem no limite).
+    Retorna (ativos, pendências) — pendências é o que só a IA consegue completar.
+    `current` são ativos já aprovados em uma rodada anterior (os novos entram depois deles).
+    Sem `reserve_for_llm`, nenhum título é descartado para abrir vaga a um reparo pela IA.
+    """
+    keyword_text = main_keyword_text(keywords, localizacao, ramo)
+    main_keyword = normalize_keyword(keyword_text)
+    location = normalize_keyword(localizacao)
+    has_keyword = lambda title: _contains_terms(title, main_keyword)
+    has_location = lambda title: _contains_terms(title, location)
+
+    titles = list((current or {}).get("titulos", []))
+    descriptions = list((current or {}).get("descricoes", []))
+    seen = {normalize_keyword(text) for text in titles + descriptions}
+    report = dict((current or {}).get("validacao") or {"encurtados": 0, "descartados": 0, "gerados_localmente": 0})
+
+    def collect(raw_items, target: list, limit: int, count: int, is_title: bool):
+        for raw in raw_items if isinstance(raw_items, list) else []:
+            text = clean_asset(raw, limit, is_title)
+            if isinstance(raw, str) and text and text != " ".join(raw.split()):
+                report["encurtados"] += 1
+            key = normalize_keyword(text)
+            if not key or key in seen or len(target) >= count:
+                report["descartados"] += 1
+                continue
+            seen.add(key)
+            target.append(text)
+
+    collect(assets_data.get("titulos"), titles, RSA_TITLE_MAX, RSA_TITLE_COUNT, True)
+    collect(assets_data.get("descricoes"), descriptions, RSA_DESCRIPTION_MAX, RSA_DESCRIPTION_COUNT, False)
+
+    def coverage_gap(check, minimum):
+        return max(0, minimum - sum(1 for title in titles if check(title)))
+
+    def drop_uncovered_title():
+        # Sai o último título que não cobre keyword nem localização
+        for i in range(len(titles) - 1, -1, -1):
+            if not has_keyword(titles[i]) and not has_location(titles[i]):
+                seen.discard(normalize_keyword(titles.pop(i)))
+                report["descartados"] += 1
+                return True
+        return False
+
+    def make_room():
+        return len(titles) < RSA_TITLE_COUNT or drop_uncovered_title()
+
+    # Cobertura por modelos locais (só entram se couberem inteiros no limite)
+    keyword_text = keyword_text[:1].upper() + keyword_text[1:]
+    location_text = localizacao.strip()
+    templates = [
+        (f"{keyword_text} em {location_text}", True),
+        (f"{keyword_text} {location_text}", True),
+        (f"{keyword_text} de Confiança", False),
+        (f"Atendimento em {location_text}", True),
+        (f"{keyword_text} Perto de Você", False),
+        (f"{keyword_text} com Garantia", False),
+    ]
+    for template, is_location in templates:
+        gap = coverage_gap(has_location, RSA_MIN_LOCATION_TITLES) if is_location \
+            else coverage_gap(has_keyword, RSA_MIN_KEYWORD_TITLES)
+        key = normalize_keyword(template)
+        if gap and len(template) <= RSA_TITLE_MAX and key not in seen and make_room():
+            seen.add(key)
+            titles.append(template)
+            report["gerados_localmente"] += 1
+
+    keyword_gap = coverage_gap(has_keyword, RSA_MIN_KEYWORD_TITLES)
+    location_gap = coverage_gap(has_location, RSA_MIN_LOCATION_TITLES)
+    # Abre vagas para a IA completar a cobertura que os modelos locais não resolveram
+    while reserve_for_llm and RSA_TITLE_COUNT - len(titles) < keyword_gap + location_gap and drop_uncovered_title():
+        pass
+
+    pending = {
+        "titulos": RSA_TITLE_COUNT - len(titles),
+        "descricoes": RSA_DESCRIPTION_COUNT - len(descriptions),
+        "titulos_com_keyword": keyword_gap,
+        "titulos_com_localizacao": location_gap
+    }
+
+    # Fixação (pinning): posição 1 com a keyword e posição 2 com a localização,
+    # só quando há ao menos 2 opções por posição (fixar 1 título só engessa o anúncio)
+    keyword_titles = [title for title in titles if has_keyword(title)][:3]
+    location_titles = [title for title in titles if has_location(title) and title not in keyword_titles][:3]
+    pinning = {}
+    if len(keyword_titles) >= 2:
+        pinning["titulo_1"] = keyword_titles
+    if len(location_titles) >= 2:
+        pinning["titulo_2"] = location_titles
+
+    return {
+        "titulos": titles,
+        "descricoes": descriptions,
+        "fixacao": pinning,
+        "validacao": report
+    }, pending
+
+
+# Rascunho sem IA: modelos de títulos/descrições por gatilho do SYSTEM_PROMPT_ASSETS.
+# {keyword} = palavra-chave principal, {oferta} e {local} = dados do pedido.
+# Modelos que passam do limite com os dados do cliente são ignorados (nunca cortados).
+# ASSETS_DRAFT_FALLBACK: devolve o rascunho quando a chamada à IA falha (erro ou timeout)
+ASSETS_DRAFT_FALLBACK = os.getenv("ASSETS_DRAFT_FALLBACK", "true").lower() == "true"
+
+DRAFT_COVERAGE_TITLES = [
+    "{keyword} em {local}",
+    "{oferta} em {local}",
+    "{keyword} {local}",
+    "{keyword} de Confiança",
+    "{keyword} Perto de Você",
+    "{keyword} com Garantia",
+    "Atendimento em {local}",
+    "{keyword}",
+    "{oferta}",
+    "{keyword} Perto",
+    "{keyword} Agora",
+    "{keyword} Hoje",
+    "{local} e Região",
+    "Aqui em {local}",
+    "{local}",
+]
+DRAFT_TITLE_TRIGGERS = {
+    "beneficio": ["{oferta} com Garantia", "Preço Justo e Qualidade", "Atendimento Personalizado",
+                  "{keyword} Sem Complicação", "Condições Especiais"],
+    "urgencia": ["Agende Hoje Mesmo", "Atendimento no Mesmo Dia", "Vagas Limitadas", "Horários Esta Semana"],
+    "prova_social": ["Clientes Satisfeitos", "Referência em {local}", "Bem Avaliado em {local}",
+                     "Profissionais Experientes"],
+    "curiosidade": ["Quanto Custa {oferta}?", "Veja Como Funciona", "Conheça Nossos Diferenciais"],
+    "cta": ["Peça Orçamento Grátis", "Fale Conosco Agora", "Agende Sua Avaliação", "Chame no WhatsApp",
+            "Solicite um Orçamento"],
+}
+DRAFT_DESCRIPTION_TRIGGERS = {
+    "beneficio": [
+        "{oferta} em {local} com atendimento de qualidade e preço justo. Peça seu orçamento!",
+        "{oferta} com atendimento personalizado e preço justo. Peça seu orçamento!",
+        "Atendimento de qualidade, preço justo e profissionais de confiança. Peça seu orçamento!",
+    ],
+    "urgencia": [
+        "{Keyword} em {local} com atendimento rápido. Agende hoje e garanta seu horário!",
+        "Agende hoje e garanta seu horário com atendimento rápido. Vagas limitadas. Ligue já!",
+    ],
+    "prova_social": [
+        "Clientes satisfeitos em {local}. {oferta} com profissionais experientes. Fale conosco!",
+        "Clientes satisfeitos e profissionais experientes. Conheça nosso trabalho. Fale conosco!",
+    ],
+    "localizacao": [
+        "Procurando {keyword} em {local}? Atendimento perto de você. Entre em contato agora!",
+        "Atendimento perto de você em {local}. Tire suas dúvidas e agende. Entre em contato!",
+        "Atendimento perto de você. Tire suas dúvidas e agende sem compromisso. Entre em contato!",
+    ],
+}
 
-        # Remove marcadores markdown se presentes
-        if response_text.startswith("```json"):
-            response_text = response_text[7:]
-        if response_text.startswith("```"):
-            response_text = response_text[3:]
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
+# Conectivos que ficam minúsculos no meio de um título ("Dentista em Curitiba")
+TITLE_CASE_LOWER = {"a", "o", "as", "os", "e", "ou", "de", "da", "do", "das", "dos", "em", "no", "na", "nos",
+                    "nas", "com", "para", "por", "sem", "ao", "à"}
+
+
+def title_case(text: str) -> str:
+    """Capitaliza as palavras de um título, mantendo conectivos minúsculos e siglas/nomes já capitalizados."""
+    words = " ".join(str(text).split()).split(" ")
+    return " ".join(
+        word if word[:1].isupper() or (i and word.lower() in TITLE_CASE_LOWER) else word[:1].upper() + word[1:]
+        for i, word in enumerate(words) if word
+    )
+
+
+def _fill_templates(templates: list, values: dict, limit: int) -> list:
+    filled = []
+    for template in templates:
+        text = " ".join(template.format(**values).split())
+        if text and "{" not in text and len(text) <= limit:
+            filled.append(text)
+    return filled
+
+
+def _rotated(items: list, seed: int) -> list:
+    # Clientes diferentes começam em modelos diferentes de cada gatilho
+    if not items:
+        return items
+    start = seed % len(items)
+    return items[start:] + items[:start]
+
+
+def draft_responsive_assets(oferta: str, localizacao: str, ramo: str, keywords: list | None = None) -> dict:
+    """Rascunho completo de ativos RSA sem chamar a IA (modelos locais por gatilho + CTA).
+
+    Usa a palavra-chave principal, as buscas reais mais curtas, a oferta e a
+    localização; passa pelo mesmo reparo/validação dos ativos da IA.
+    """
+    started = time.perf_counter()
+    keyword = main_keyword_text(keywords, localizacao, ramo)
+    local = localizacao.strip()
+    oferta = " ".join(oferta.split())
+    seed = zlib.crc32(normalize_keyword(f"{oferta} {local}").encode("utf-8"))
+
+    title_values = {"keyword": title_case(keyword), "oferta": title_case(oferta), "local": local}
+    description_values = {"keyword": keyword, "Keyword": keyword[:1].upper() + keyword[1:],
+                          "oferta": oferta, "local": local}
+
+    # 1) Buscas reais que cabem num título e modelos de cobertura, só até atingir o
+    #    mínimo de títulos com keyword/localização (o resto fica para completar no fim)
+    main_keyword, location = normalize_keyword(keyword), normalize_keyword(local)
+    coverage = [title_case(kw) for kw in (keywords or [])[:20] if len(str(kw)) <= RSA_TITLE_MAX][:3]
+    coverage += _fill_templates(DRAFT_COVERAGE_TITLES, title_values, RSA_TITLE_MAX)
+    titles, extra_titles = [], []
+    keyword_titles = location_titles = 0
+    for title in dict.fromkeys(coverage):
+        with_keyword = _contains_terms(title, main_keyword)
+        with_location = _contains_terms(title, location)
+        if (with_keyword and keyword_titles < RSA_MIN_KEYWORD_TITLES) or \
+                (with_location and location_titles < RSA_MIN_LOCATION_TITLES):
+            titles.append(title)
+            keyword_titles += with_keyword
+            location_titles += with_location
+        else:
+            extra_titles.append(title)
+    # 2) Um modelo de cada gatilho por vez, até acabar
+    groups = [_rotated(_fill_templates(templates, title_values, RSA_TITLE_MAX), seed)
+              for templates in DRAFT_TITLE_TRIGGERS.values()]
+    for position in range(max(len(group) for group in groups)):
+        titles += [group[position] for group in groups if position < len(group)]
+    titles += extra_titles
+
+    # Uma descrição por gatilho (benefício, urgência, prova social, localização)
+    descriptions = []
+    for templates in DRAFT_DESCRIPTION_TRIGGERS.values():
+        descriptions += _fill_templates(templates, description_values, RSA_DESCRIPTION_MAX)[:1]
+    descriptions += [text for templates in DRAFT_DESCRIPTION_TRIGGERS.values()
+                     for text in _fill_templates(templates, description_values, RSA_DESCRIPTION_MAX)]
+
+    assets, pending = repair_assets({"titulos": titles, "descricoes": descriptions}, keywords, localizacao, ramo,
+                                    reserve_for_llm=False)
+    assets["validacao"].update(rodadas_reparo=0, pendentes=pending, origem="rascunho_local",
+                               ms=round((time.perf_counter() - started) * 1000, 2))
+    return assets
+
+
+def has_pending_assets(pending: dict) -> bool:
+    return pending["titulos"] > 0 or pending["descricoes"] > 0
+
+
+def build_assets_repair_prompt(assets: dict, pending: dict, oferta: str, localizacao: str, ramo: str,
+                               keywords: list | None = None) -> str:
+    """Prompt de reparo: pede à IA só os ativos que faltam, sem repetir os já aprovados."""
+    main_keyword = main_keyword_text(keywords, localizacao, ramo)
+    existing = "\n".join(f"- {text}" for text in assets["titulos"] + assets["descricoes"]) or "- (nenhum)"
+
+    rules = []
+    if pending["titulos"]:
+        rules.append(f"- {pending['titulos']} TÍTULOS (máximo {RSA_TITLE_MAX} caracteres cada)")
+        if pending["titulos_com_keyword"]:
+            rules.append(f"  * {pending['titulos_com_keyword']} deles com a palavra-chave \"{main_keyword}\"")
+        if pending["titulos_com_localizacao"]:
+            rules.append(f"  * {pending['titulos_com_localizacao']} deles com a localização \"{localizacao}\"")
+    if pending["descricoes"]:
+        rules.append(f"- {pending['descricoes']} DESCRIÇÕES (máximo {RSA_DESCRIPTION_MAX} caracteres cada)")
+
+    return f"""Complete os ativos de um Anúncio Responsivo de Pesquisa:
 
-        response_text = response_text.strip()
-        assets_data = json.loads(response_text)
+OFERTA: {oferta}
+LOCALIZAÇÃO: {localizacao}
+RAMO: {ramo}
 
-        # Valida e trunca os ativos
-        validated_titles = []
-        for titulo in assets_data.get("titulos", [])[:15]:
-            validated_titles.append(titulo[:30])
+ATIVOS JÁ APROVADOS (não repita):
+{existing}
 
-        validated_descriptions = []
-        for desc in assets_data.get("descricoes", [])[:4]:
-            validated_descriptions.append(desc[:90])
+Gere APENAS:
+{chr(10).join(rules)}
+
+Retorne APENAS o JSON com "titulos" e "descricoes" (lista vazia no que não foi pedido)."""
+
+
+def _repair_max_tokens(pending: dict) -> int:
+    return 200 + 30 * pending["titulos"] + 80 * pending["descricoes"]
 
-        return {
-            "titulos": validated_titles,
-            "descricoes": validated_descriptions
-        }
 
+def generate_responsive_assets(oferta: str, localizacao: str, ramo: str, keywords: list | None = None,
+                               cache_mode: str = "bypass") -> dict:
+    """Gera 15 títulos e 4 descrições para Anúncios Responsivos do Google."""
+
+    user_prompt = build_assets_prompt(oferta, localizacao, ramo, keywords)
+
+    try:
+        assets_data = request_llm_json(SYSTEM_PROMPT_ASSETS, user_prompt, max_tokens=2000, temperature=0.8,
+                                       output=ASSETS_OUTPUT, cache_mode=cache_mode)
+    except (LLMCacheMiss, DeadlineExceeded, LLMBudgetExceeded):
+        raise
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Erro ao processar resposta da IA: {str(e)}")
+    except Exception as e:
+        raise Exception(f"Erro na comunicação com a API: {str(e)}")
+
+    assets, pending = repair_assets(assets_data, keywords, localizacao, ramo)
+    rounds = 0
+    while has_pending_assets(pending) and rounds < RSA_REPAIR_ROUNDS:
+        rounds += 1
+        print(f"[Ativos] Reparo {rounds}: pedindo {pending['titulos']} títulos e {pending['descricoes']} descrições")
+        repair_prompt = build_assets_repair_prompt(assets, pending, oferta, localizacao, ramo, keywords)
+        try:
+            repair_data = request_llm_json(SYSTEM_PROMPT_ASSETS, repair_prompt, max_tokens=_repair_max_tokens(pending),
+                                           temperature=0.8, output=ASSETS_OUTPUT, cache_mode=cache_mode)
+        except Exception as e:
+            # O reparo é melhor esforço: os ativos já aprovados continuam válidos
+            print(f"[Ativos] Reparo falhou: {e}")
+            break
+        assets, pending = repair_assets(repair_data, keywords, localizacao, ramo, current=assets)
+
+    assets["validacao"]["rodadas_reparo"] = rounds
+    assets["validacao"]["pendentes"] = pending
+    assets["validacao"]["origem"] = "ia"
+    return assets
+
+
+async def generate_responsive_assets_async(oferta: str, localizacao: str, ramo: str, keywords: list | None = None,
+                                           cache_mode: str = "bypass") -> dict:
+    """Versão assíncrona de generate_responsive_assets."""
+
+    user_prompt = build_assets_prompt(oferta, localizacao, ramo, keywords)
+
+    try:
+        assets_data = await request_llm_json_async(SYSTEM_PROMPT_ASSETS, user_prompt, max_tokens=2000, temperature=0.8,
+                                                   output=ASSETS_OUTPUT, cache_mode=cache_mode)
+    except (LLMCacheMiss, DeadlineExceeded, LLMBudgetExceeded):
+        raise
     except json.JSONDecodeError as e:
         raise ValueError(f"Erro ao processar resposta da IA: {str(e)}")
     except Exception as e:
         raise Exception(f"Erro na comunicação com a API: {str(e)}")
 
+    assets, pending = repair_assets(assets_data, keywords, localizacao, ramo)
+    rounds = 0
+    while has_pending_assets(pending) and rounds < RSA_REPAIR_ROUNDS:
+        rounds += 1
+        print(f"[Ativos] Reparo {rounds}: pedindo {pending['titulos']} títulos e {pending['descricoes']} descrições")
+        repair_prompt = build_assets_repair_prompt(assets, pending, oferta, localizacao, ramo, keywords)
+        try:
+            repair_data = await request_llm_json_async(SYSTEM_PROMPT_ASSETS, repair_prompt,
+                                                       max_tokens=_repair_max_tokens(pending),
+                                                       temperature=0.8, output=ASSETS_OUTPUT,
+                                                       cache_mode=cache_mode)
+        except Exception as e:
+            print(f"[Ativos] Reparo falhou: {e}")
+            break
+        assets, pending = repair_assets(repair_data, keywords, localizacao, ramo, current=assets)
+
+    assets["validacao"]["rodadas_reparo"] = rounds
+    assets["validacao"]["pendentes"] = pending
+    assets["validacao"]["origem"] = "ia"
+    return assets
+
+
+async def generate_ads_and_assets_async(keywords: list, oferta: str, cliente: str, nicho: str, localizacao: str,
+                                        ramo: str, cache_mode: str = "bypass") -> tuple:
+    """Gera anúncios e ativos RSA em paralelo para o mesmo conjunto de keywords.
+
+    Retorna (anúncios, ativos); se só os ativos falharem, o segundo item é a exceção.
+    Se os anúncios não saírem dentro do prazo da requisição, o primeiro item é [].
+    """
+    ads, assets = await asyncio.gather(
+        analyze_and_model_ads_async(keywords, oferta, cliente, nicho, localizacao, cache_mode=cache_mode),
+        generate_responsive_assets_async(oferta, localizacao, ramo, keywords, cache_mode=cache_mode),
+        return_exceptions=True
+    )
+    if isinstance(ads, DeadlineExceeded):
+        print(f"[Pipeline] Ad-Intelligence sem resultado dentro do prazo: {ads}")
+        return [], assets
+    if isinstance(ads, BaseException):
+        raise ads
+    return ads, assets
+
+
+# =============================================================================
+# PIPELINE - Data Hunter + Ad-Intelligence com Cascata de Fallback
+# =============================================================================
+
+PIPELINE_REQUIRED_FIELDS = ("ramo", "localizacao", "oferta", "cliente", "nicho")
+
+# Cascata de fallback
+# CASCADE_MODE: "sequential" (uma tentativa após a outra) ou "speculative"
+#   (tentativas escalonadas em paralelo; vence a de maior prioridade com resultado)
+# CASCADE_HEDGE_DELAY: segundos entre o início de cada tentativa no modo speculative
+CASCADE_MODES = ("sequential", "speculative")
+CASCADE_MODE = os.getenv("CASCADE_MODE", "sequential")
+CASCADE_HEDGE_DELAY = float(os.getenv("CASCADE_HEDGE_DELAY", "1.5"))
+
+# Estágios em ordem de prioridade -> fallback_mode correspondente
+CASCADE_STAGES = ("scraper_localizacao", "scraper_nacional", "ia_prediction")
+CASCADE_FALLBACK_MODES = {
+    "scraper_localizacao": None,
+    "scraper_nacional": "sem_localizacao",
+    "ia_prediction": "ia_prediction"
+}
+
+
+class PipelineCancelled(Exception):
+    """Pipeline interrompido: o cliente do stream desconectou ou o job foi cancelado."""
+
+
+class CancelSignal:
+    """Sinal de cancelamento que vale se qualquer um dos eventos estiver sinalizado.
+
+    Os estágios da cascata só leem `is_set()`: assim o cancelamento do pipeline os
+    interrompe sem que a cascata sinalize (e cancele) o pipeline inteiro.
+    """
+
+    def __init__(self, *events):
+        self.events = [event for event in events if event is not None]
+
+    def is_set(self) -> bool:
+        return any(event.is_set() for event in self.events)
+
+
+def check_cancelled(cancel_event):
+    """Levanta PipelineCancelled se o pipeline foi cancelado."""
+    if cancel_event is not None and cancel_event.is_set():
+        raise PipelineCancelled()
+
+
+# Cancelamento do pipeline/job atual, checado pelas chamadas à IA (a cada chunk do stream)
+current_cancel = contextvars.ContextVar("current_cancel", default=None)
+
+
+@contextmanager
+def cancel_scope(cancel_event):
+    """Define o cancelamento das chamadas à IA feitas no bloco (e nas threads criadas com with_trace)."""
+    token = current_cancel.set(cancel_event)
+    try:
+        yield cancel_event
+    finally:
+        current_cancel.reset(token)
+
+
+def parse_flag(value) -> bool:
+    """Booleano vindo de JSON ou de CSV ("true", "1", "sim")."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "sim", "yes")
+    return bool(value)
+
+
+def parse_pipeline_request(data: dict | None) -> tuple:
+    """Valida os dados do pipeline. Retorna (parâmetros, mensagem de erro)."""
+    if not data:
+        return None, "Nenhum dado enviado na requisição"
+
+    params = {field: str(data.get(field) or "").strip() for field in PIPELINE_REQUIRED_FIELDS}
+    for field in PIPELINE_REQUIRED_FIELDS:
+        if not params[field]:
+            return None, f"O campo '{field}' é obrigatório"
+
+    params["cache_mode"] = get_cache_mode(data)
+    if params["cache_mode"] is None:
+        return None, "O campo 'cache' deve ser 'bypass', 'prefer' ou 'only'"
+
+    params["cascade_mode"] = str(data.get("cascade") or CASCADE_MODE).strip().lower()
+    if params["cascade_mode"] not in CASCADE_MODES:
+        return None, "O campo 'cascade' deve ser 'sequential' ou 'speculative'"
+
+    # "assets": true gera também os ativos RSA, em paralelo aos anúncios
+    params["include_assets"] = parse_flag(data.get("assets"))
+
+    # "reuse": true devolve a execução equivalente recente do histórico, sem varrer nem chamar a IA
+    params["reuse"] = parse_flag(data.get("reuse"))
+
+    # "deadline": prazo total em segundos (sem o campo, vale PIPELINE_DEADLINE)
+    params["deadline"], error = parse_deadline(data.get("deadline"))
+    if error:
+        return None, error
+
+    return params, None
+
+
+def _run_cascade_sequential(stage_runners: dict, emit, cancel_event=None) -> tuple:
+    """Executa os estágios um após o outro até algum retornar keywords."""
+    report = {}
+
+    for stage in CASCADE_STAGES:
+        check_cancelled(cancel_event)
+        # Com o circuit breaker aberto (Google bloqueando), pula direto para a IA
+        if stage == "scraper_nacional" and scraper_breaker.is_open():
+            print(f"[Pipeline] Scraper bloqueado (circuit breaker aberto): pulando para a IA")
+            report[stage] = {"status": "skipped", "ms": None}
+            continue
+        if deadline_expired():
+            record_cut(f"cascade.{stage}", "skipped")
+            report[stage] = {"status": "skipped", "ms": None}
+            continue
+
+        emit("stage", {"stage": stage, "fallback_mode": CASCADE_FALLBACK_MODES[stage]})
+        started = time.monotonic()
+        try:
+            keywords = stage_runners[stage](cancel_event)
+        except DeadlineExceeded as e:
+            # Sem tempo para o estágio (o corte já está no relatório do prazo)
+            print(f"[Pipeline] Estágio {stage} sem resultado dentro do prazo: {e}")
+            report[stage] = {"status": "timeout", "ms": int((time.monotonic() - started) * 1000)}
+            continue
+        elapsed_ms = int((time.monotonic() - started) * 1000)
+
+        if keywords:
+            report[stage] = {"status": "won", "ms": elapsed_ms}
+            return keywords, stage, report
+        report[stage] = {"status": "empty", "ms": elapsed_ms}
+
+    return [], None, report
+
+
+def _run_cascade_speculative(stage_runners: dict, emit, hedge_delay: float, pipeline_cancel=None) -> tuple:
+    """Dispara os estágios escalonados por `hedge_delay` e fica com o de maior prioridade que retornar keywords.
+
+    Um estágio só vence quando todos os de maior prioridade terminaram vazios;
+    os demais são cancelados (a chamada à IA em andamento é descartada). Depois
+    do prazo, nenhum estágio novo é lançado. `pipeline_cancel` interrompe todos.
+    """
+    cancel_event = threading.Event()
+    stage_cancel = CancelSignal(cancel_event, pipeline_cancel)
+    executor = ThreadPoolExecutor(max_workers=len(CASCADE_STAGES), thread_name_prefix="cascade")
+    started_at = time.monotonic()
+    running = {}
+    started = {}
+    results = {}
+    report = {}
+
+    def launch(stage):
+        emit("stage", {"stage": stage, "fallback_mode": CASCADE_FALLBACK_MODES[stage]})
+        started[stage] = time.monotonic()
+        running[executor.submit(with_trace(stage_runners[stage]), stage_cancel)] = stage
+
+    try:
+        launch(CASCADE_STAGES[0])
+        while True:
+            check_cancelled(pipeline_cancel)
+            # Vencedor: primeiro estágio (por prioridade) com keywords, com os anteriores vazios
+            for stage in CASCADE_STAGES:
+                if stage not in results:
+                    break
+                if isinstance(results[stage], Exception):
+                    raise results[stage]
+                if results[stage]:
+                    report[stage]["status"] = "won"
+                    return results[stage], stage, report
+
+            next_index = len(started)
+            if next_index < len(CASCADE_STAGES) and deadline_expired():
+                # Sem tempo para novos estágios; os em andamento também seguem o prazo
+                # e devolvem o parcial logo em seguida
+                for stage in CASCADE_STAGES[next_index:]:
+                    record_cut(f"cascade.{stage}", "skipped")
+                    started[stage] = time.monotonic()
+                    results[stage] = []
+                    report[stage] = {"status": "skipped", "ms": None}
+                continue
+            if next_index < len(CASCADE_STAGES):
+                # Se tudo que foi lançado já terminou vazio, lança o próximo sem esperar o hedge
+                launch_at = started_at + next_index * hedge_delay
+                if not running or time.monotonic() >= launch_at:
+                    launch(CASCADE_STAGES[next_index])
+                    continue
+                timeout = launch_at - time.monotonic()
+            elif not running:
+                return [], None, report
+            else:
+                timeout = None
+
+            if pipeline_cancel is not None:
+                # Acorda periodicamente para checar o cancelamento do pipeline
+                timeout = 0.5 if timeout is None else min(timeout, 0.5)
+            if not deadline_expired():
+                # Acorda no fim do prazo para pular os estágios que faltam; depois
+                # dele, só espera os em andamento (que seguem o prazo por conta própria)
+                timeout = deadline_remaining(timeout)
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                elapsed_ms = int((time.monotonic() - started[stage]) * 1000)
+                try:
+                    results[stage] = future.result() or []
+                    report[stage] = {"status": "done" if results[stage] else "empty", "ms": elapsed_ms}
+                except (PipelineCancelled, LLMCacheMiss, LLMBudgetExceeded) as e:
+                    results[stage] = e
+                    report[stage] = {"status": "error", "ms": elapsed_ms}
+                except DeadlineExceeded as e:
+                    print(f"[Pipeline] Estágio {stage} sem resultado dentro do prazo: {e}")
+                    results[stage] = []
+                    report[stage] = {"status": "timeout", "ms": elapsed_ms}
+                except Exception as e:
+                    print(f"[Pipeline] Estágio {stage} falhou: {e}")
+                    results[stage] = []
+                    report[stage] = {"status": "error", "ms": elapsed_ms}
+    finally:
+        cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        for stage in CASCADE_STAGES:
+            if stage in started and stage not in report:
+                report[stage] = {"status": "cancelled", "ms": int((time.monotonic() - started[stage]) * 1000)}
+
+
+def find_keywords_with_fallback(ramo: str, localizacao: str, oferta: str, nicho: str,
+                                cache_mode: str = "bypass", on_event=None, scraper=None,
+                                cascade_mode: str | None = None, probe_results: dict | None = None,
+                                cancel_event=None) -> tuple:
+    """Executa a cascata de fallback do Data Hunter. Retorna (keywords, fallback_mode, relatório).
+
+    fallback_mode: None, "sem_localizacao" ou "ia_prediction".
+    `scraper` substitui scrape_keywords (ex: varreduras compartilhadas do batch).
+    O relatório traz o modo, o estágio vencedor e o status/tempo de cada estágio.
+    `probe_results`, se for um dict, recebe as sondagens do estágio vencedor.
+    `cancel_event` interrompe a cascata (PipelineCancelled).
+    """
+    emit = on_event or (lambda event, payload: None)
+    scraper = scraper or scrape_keywords
+    cascade_mode = cascade_mode or CASCADE_MODE
+
+    def on_batch(stage):
+        found = []
+
+        def handler(query, new_keywords):
+            found.extend(new_keywords)
+            emit("keywords", {"stage": stage, "query": query, "keywords": new_keywords, "total": len(found)})
+        return handler
+
+    stage_probes = {}
+
+    def scraper_localizacao(cancel_event):
+        # Tentativa 1: Scraper com Ramo + Localização
+        print(f"[Pipeline] Tentativa 1: Scraper com '{ramo}' em '{localizacao}'")
+        return scraper(ramo, localizacao, on_batch=on_batch("scraper_localizacao"), cancel_event=cancel_event,
+                       probe_results=stage_probes.setdefault("scraper_localizacao", {}))
+
+    def scraper_nacional(cancel_event):
+        # Tentativa 2: Scraper apenas com Ramo (sem localização)
+        print(f"[Pipeline] Tentativa 2: Scraper apenas com '{ramo}'")
+        return scraper(ramo, "", on_batch=on_batch("scraper_nacional"), cancel_event=cancel_event,
+                       probe_results=stage_probes.setdefault("scraper_nacional", {}))
+
+    def ia_prediction(cancel_event):
+        # Tentativa 3: IA como backup final
+        print(f"[Pipeline] Tentativa 3: Gerando keywords com IA")
+        return generate_ai_keywords(ramo, localizacao, oferta, nicho, cache_mode=cache_mode)
+
+    stage_runners = {
+        "scraper_localizacao": scraper_localizacao,
+        "scraper_nacional": scraper_nacional,
+        "ia_prediction": ia_prediction
+    }
+
+    if cascade_mode == "speculative":
+        keywords, winner, stages = _run_cascade_speculative(stage_runners, emit, CASCADE_HEDGE_DELAY, cancel_event)
+    else:
+        keywords, winner, stages = _run_cascade_sequential(stage_runners, emit, cancel_event)
+    check_cancelled(cancel_event)
+
+    for stage, stage_report in stages.items():
+        metrics.inc("cascade_stage_total", stage=stage, status=stage_report["status"])
+        if stage_report["ms"] is not None:
+            record_stage(f"cascade.{stage}", stage_report["ms"] / 1000)
+
+    fallback_mode = CASCADE_FALLBACK_MODES[winner] if winner else "ia_prediction"
+    if probe_results is not None and winner in stage_probes:
+        probe_results.update(stage_probes[winner])
+
+    # Se ainda assim não tiver keywords, usa fallback hardcoded
+    if not keywords:
+        keywords = [
+            f"{ramo} em {localizacao}",
+            f"{oferta}",
+            f"melhor {ramo}",
+            f"{ramo} preço",
+            f"contratar {ramo}"
+        ]
+
+    report = {"mode": cascade_mode, "winner": winner, "stages": stages}
+    return keywords, fallback_mode, report
+
+
+def run_full_pipeline(ramo: str, localizacao: str, oferta: str, cliente: str, nicho: str,
+                      cache_mode: str = "bypass", on_event=None, scraper=None,
+                      cascade_mode: str | None = None, include_assets: bool = False, reuse: bool = False,
+                      deadline: float | None = None, cancel_event=None) -> dict:
+    """Executa Data Hunter + Ad-Intelligence e retorna o bloco "data" da resposta.
+
+    Com `on_event(evento, payload)`, o progresso é publicado incrementalmente
+    e os anúncios são gerados em streaming, um evento "ad" por anúncio.
+    Com `include_assets`, os ativos RSA são gerados em paralelo aos anúncios.
+    Com `reuse`, uma execução equivalente recente do histórico é devolvida direto.
+    `deadline` (segundos, padrão PIPELINE_DEADLINE) limita a execução inteira; as
+    etapas encurtadas pelo prazo aparecem em "deadline.cut_short".
+    Com `cancel_event` sinalizado, varreduras e chamadas à IA param no próximo
+    ponto de checagem e a execução termina com PipelineCancelled.
+    """
+    if reuse and HISTORY_ENABLED:
+        previous = find_reusable_run(ramo, localizacao, oferta, cliente, nicho, include_assets)
+        if previous:
+            print(f"[Pipeline] Reaproveitando a execução {previous['history']['id']} do histórico "
+                  f"({previous['history']['age_seconds']:.0f}s atrás)")
+            metrics.inc("history_reuse_total", result="hit")
+            if on_event:
+                replay_history_events(previous, on_event)
+            return previous
+        metrics.inc("history_reuse_total", result="miss")
+
+    with deadline_scope(make_deadline(deadline)) as request_deadline, cancel_scope(cancel_event):
+        response_data = _run_pipeline_stages(ramo, localizacao, oferta, cliente, nicho, cache_mode, on_event,
+                                             scraper, cascade_mode, include_assets, cancel_event)
+    if request_deadline:
+        response_data["deadline"] = request_deadline.report()
+
+    # Resultado encurtado pelo prazo não entra no histórico (não seria reaproveitado com "reuse")
+    if HISTORY_ENABLED and not (request_deadline and request_deadline.cuts):
+        # Falha ao gravar o histórico não derruba o pipeline
+        try:
+            run_id = record_history_run("pipeline", ramo, localizacao, oferta, cliente, nicho, response_data,
+                                        response_data["keywords"]["ranked"], response_data["ads"],
+                                        response_data.get("assets"))
+            response_data["history"] = {"id": run_id, "reused": False}
+        except sqlite3.Error as e:
+            print(f"[Pipeline] Erro ao gravar o histórico: {e}")
+
+    return response_data
+
+
+def _run_pipeline_stages(ramo: str, localizacao: str, oferta: str, cliente: str, nicho: str, cache_mode: str,
+                         on_event, scraper, cascade_mode: str | None, include_assets: bool,
+                         cancel_event=None) -> dict:
+    """Cascata de keywords + Ad-Intelligence (e ativos RSA) dentro do prazo atual."""
+    request_deadline = current_deadline.get()
+
+    # =============================================
+    # CASCATA DE FALLBACK
+    # =============================================
+    # A cascata usa só parte do prazo: o restante fica para a Ad-Intelligence
+    probe_results = {}
+    with deadline_scope(request_deadline.within(DEADLINE_KEYWORDS_SHARE) if request_deadline else None):
+        keywords, fallback_mode, cascade_report = find_keywords_with_fallback(
+            ramo, localizacao, oferta, nicho, cache_mode=cache_mode,
+            on_event=on_event, scraper=scraper, cascade_mode=cascade_mode, probe_results=probe_results,
+            cancel_event=cancel_event
+        )
+
+    # Keywords de outras cidades/UFs saem antes do prompt (se sobrar nada, mantém todas)
+    with trace_span("location_filter"):
+        local_keywords, dropped_keywords = filter_keywords_by_location(keywords, localizacao, f"{ramo} {oferta}")
+    if dropped_keywords:
+        print(f"[Pipeline] Filtro de localização: {len(dropped_keywords)} keywords de outras cidades removidas")
+
+    # Keywords deduplicadas e ranqueadas: só elas vão para os prompts da IA
+    with trace_span("keyword_rank"):
+        ranked_keywords = rank_keywords(local_keywords or keywords, probe_results)
+
+    keywords_data = {
+        "ramo": ramo,
+        "localizacao": localizacao,
+        "total": len(keywords),
+        "list": keywords,
+        "source": "google_autocomplete" if fallback_mode is None else fallback_mode,
+        "ranked": ranked_keywords,
+        "location_filter": {
+            "dropped": len(dropped_keywords),
+            "dropped_keywords": dropped_keywords[:20]
+        }
+    }
+
+    # =============================================
+    # PROCESSAMENTO DOS ANÚNCIOS
+    # =============================================
+
+    # Step 2: Ad-Intelligence (com localização) + ativos RSA em paralelo, se pedidos
+    assets = None
+    if on_event:
+        on_event("keywords_done", keywords_data)
+        assets_future = None
+        if include_assets:
+            assets_future = submit_async(
+                generate_responsive_assets_async(oferta, localizacao, ramo, ranked_keywords, cache_mode=cache_mode)
+            )
+        ads = []
+        ads_done = False
+        try:
+            for ad in stream_analyze_and_model_ads(ranked_keywords, oferta, cliente, nicho, localizacao,
+                                                   cache_mode=cache_mode):
+                # Cancelado: sair do loop fecha o stream da IA
+                check_cancelled(cancel_event)
+                on_event("ad", {"index": len(ads), "ad": ad})
+                ads.append(ad)
+            ads_done = True
+        except DeadlineExceeded as e:
+            # Fica com os anúncios entregues até o fim do prazo
+            print(f"[Pipeline] Ad-Intelligence encerrada pelo prazo com {len(ads)} anúncios: {e}")
+            ads_done = True
+        finally:
+            # Anúncios falharam (ou cancelados): os ativos não seriam entregues, para de gastar com eles
+            if assets_future and not ads_done:
+                assets_future.cancel()
+        if assets_future:
+            try:
+                assets = assets_future.result(timeout=deadline_remaining())
+            except Exception as e:
+                if not assets_future.done():
+                    assets_future.cancel()
+                    record_cut("assets", "timeout")
+                    e = DeadlineExceeded("Ativos RSA não concluídos dentro do prazo da requisição")
+                assets = e
+    elif include_assets:
+        ads, assets = run_async(generate_ads_and_assets_async(
+            ranked_keywords, oferta, cliente, nicho, localizacao, ramo, cache_mode=cache_mode
+        ))
+    else:
+        try:
+            ads = analyze_and_model_ads(ranked_keywords, oferta, cliente, nicho, localizacao, cache_mode=cache_mode)
+        except DeadlineExceeded as e:
+            print(f"[Pipeline] Ad-Intelligence sem resultado dentro do prazo: {e}")
+            ads = []
+
+    # Monta resposta com info de fallback
+    response_data = {
+        "keywords": keywords_data,
+        "ads": ads,
+        "fallback_used": fallback_mode,
+        "cascade": cascade_report
+    }
+
+    if include_assets:
+        if isinstance(assets, BaseException):
+            response_data["assets"] = None
+            response_data["assets_error"] = str(assets)
+            if ASSETS_DRAFT_FALLBACK and not isinstance(assets, LLMCacheMiss):
+                print(f"[Pipeline] Ativos RSA da IA falharam ({assets}): usando o rascunho local")
+                response_data["assets"] = draft_responsive_assets(oferta, localizacao, ramo, ranked_keywords)
+        else:
+            response_data["assets"] = assets
+        if on_event:
+            on_event("assets", {"assets": response_data["assets"], "error": response_data.get("assets_error")})
+
+    # Adiciona mensagem explicativa se usou fallback
+    if fallback_mode == "sem_localizacao":
+        response_data["fallback_message"] = f"Busca expandida: resultados para '{ramo}' em todo o Brasil"
+    elif fallback_mode == "ia_prediction":
+        response_data["fallback_message"] = "Palavras-chave geradas por IA (Previsão de Alto Volume)"
+
+    return response_data
+
+
+def sse_event(event: str, payload) -> str:
+    """Formata um evento Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+# =============================================================================
+# HISTÓRICO - Campanhas Geradas (SQLite + Busca FTS5)
+# =============================================================================
+
+# Cada resultado do pipeline (síncrono, stream, jobs e batch) e de /generate_assets
+# é gravado com um índice FTS5 sobre keywords, títulos, descrições, cliente e nicho.
+# HISTORY_ENABLED: grava os resultados e habilita os endpoints /history
+# HISTORY_REUSE_MAX_AGE: idade máxima (segundos) de uma execução reaproveitada com "reuse": true
+# HISTORY_PAGE_SIZE / HISTORY_MAX_PAGE_SIZE: itens por página na listagem e na busca
+# HISTORY_MAX_AGE: execuções mais antigas que isso (segundos) são removidas; 0 = sem limite
+# HISTORY_MAX_ROWS: máximo de execuções guardadas (as mais antigas saem primeiro); 0 = sem limite
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "true").lower() == "true"
+HISTORY_REUSE_MAX_AGE = float(os.getenv("HISTORY_REUSE_MAX_AGE", "604800"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "100"))
+HISTORY_MAX_AGE = float(os.getenv("HISTORY_MAX_AGE", "7776000"))
+HISTORY_MAX_ROWS = int(os.getenv("HISTORY_MAX_ROWS", "50000"))
+
+# A cada N gravações (por processo), aplica HISTORY_MAX_AGE e HISTORY_MAX_ROWS
+HISTORY_PURGE_INTERVAL = 100
+
+HISTORY_KINDS = ("pipeline", "assets")
+HISTORY_SORTS = ("relevance", "recent")
+HISTORY_SUMMARY_FIELDS = ("id", "kind", "created_at", "cliente", "nicho", "ramo", "localizacao", "oferta",
+                          "total_keywords", "total_ads", "has_assets")
+
+_history_db_ready = False
+_history_writes = itertools.count(1)
+
+
+def history_db() -> sqlite3.Connection:
+    """Retorna a conexão com o banco do histórico, criando as tabelas se necessário."""
+    global _history_db_ready
+    conn = get_sqlite("history")
+    if not _history_db_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history_runs (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                kind TEXT NOT NULL,
+                request_key TEXT NOT NULL,
+                cliente TEXT NOT NULL,
+                nicho TEXT NOT NULL,
+                ramo TEXT NOT NULL,
+                localizacao TEXT NOT NULL,
+                oferta TEXT NOT NULL,
+                cliente_key TEXT NOT NULL,
+                nicho_key TEXT NOT NULL,
+                total_keywords INTEGER NOT NULL,
+                total_ads INTEGER NOT NULL,
+                has_assets INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_request ON history_runs (request_key, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_cliente ON history_runs (cliente_key, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_nicho ON history_runs (nicho_key, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_created ON history_runs (created_at)")
+        # rowid do FTS = seq da execução (join direto, sem coluna extra)
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                keywords, titulos, descricoes, cliente, nicho,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+        conn.commit()
+        _history_db_ready = True
+    return conn
+
+
+def history_request_key(ramo: str, localizacao: str, oferta: str, cliente: str, nicho: str) -> str:
+    """Identifica pedidos equivalentes (sem diferença de caixa, acentos ou pontuação)."""
+    raw = "\x1f".join(normalize_keyword(value) for value in (ramo, localizacao, oferta, cliente, nicho))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _history_ad_texts(ads: list, assets: dict | None) -> tuple:
+    """Títulos e descrições de uma execução (anúncios modelados + ativos RSA)."""
+    titulos, descricoes = [], []
+    for ad in ads or []:
+        winning = ad.get("anuncio_vencedor") or {}
+        titulos.append(str(winning.get("titulo") or ""))
+        descricoes.append(str(winning.get("descricao") or ""))
+    if isinstance(assets, dict):
+        titulos.extend(assets.get("titulos") or [])
+        descricoes.extend(assets.get("descricoes") or [])
+    return [t for t in titulos if t], [d for d in descricoes if d]
+
+
+def record_history_run(kind: str, ramo: str, localizacao: str, oferta: str, cliente: str, nicho: str,
+                       result: dict, keywords: list, ads: list | None = None, assets: dict | None = None) -> str:
+    """Grava uma execução no histórico e no índice de busca. Retorna o id."""
+    run_id = uuid.uuid4().hex
+    titulos, descricoes = _history_ad_texts(ads, assets)
+    conn = history_db()
+    cursor = conn.execute("""
+        INSERT INTO history_runs (id, kind, request_key, cliente, nicho, ramo, localizacao, oferta,
+                                  cliente_key, nicho_key, total_keywords, total_ads, has_assets, result, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (run_id, kind, history_request_key(ramo, localizacao, oferta, cliente, nicho), cliente, nicho, ramo,
+          localizacao, oferta, normalize_keyword(cliente), normalize_keyword(nicho), len(keywords), len(ads or []),
+          int(isinstance(assets, dict)), json.dumps(result, ensure_ascii=False), time.time()))
+    conn.execute(
+        "INSERT INTO history_fts (rowid, keywords, titulos, descricoes, cliente, nicho) VALUES (?, ?, ?, ?, ?, ?)",
+        (cursor.lastrowid, "\n".join(keywords), "\n".join(titulos), "\n".join(descricoes), cliente, nicho)
+    )
+    conn.commit()
+    if next(_history_writes) % HISTORY_PURGE_INTERVAL == 0:
+        purge_history()
+    return run_id
+
+
+def purge_history(max_age: float | None = None, max_rows: int | None = None) -> int:
+    """Remove (com o índice de busca) as execuções além de HISTORY_MAX_AGE ou HISTORY_MAX_ROWS."""
+    max_age = HISTORY_MAX_AGE if max_age is None else max_age
+    max_rows = HISTORY_MAX_ROWS if max_rows is None else max_rows
+    conn = history_db()
+    oldest_kept = 0
+    if max_rows > 0:
+        row = conn.execute("SELECT seq FROM history_runs ORDER BY seq DESC LIMIT 1 OFFSET ?", (max_rows,)).fetchone()
+        oldest_kept = row[0] + 1 if row else 0
+    cutoff = time.time() - max_age if max_age > 0 else 0
+    expired = "SELECT seq FROM history_runs WHERE seq < ? OR created_at < ?"
+    conn.execute(f"DELETE FROM history_fts WHERE rowid IN ({expired})", (oldest_kept, cutoff))
+    removed = conn.execute(f"DELETE FROM history_runs WHERE seq IN ({expired})", (oldest_kept, cutoff)).rowcount
+    conn.commit()
+    if removed:
+        print(f"[Histórico] {removed} execuções antigas removidas")
+    return removed
+
+
+def record_assets_history(ramo: str, localizacao: str, oferta: str, cliente: str, nicho: str,
+                          assets: dict, keywords: list) -> str | None:
+    """Grava uma geração de ativos RSA no histórico (None se desativado ou se a gravação falhar)."""
+    if not HISTORY_ENABLED:
+        return None
+    try:
+        return record_history_run("assets", ramo, localizacao, oferta, cliente, nicho, assets, keywords, assets=assets)
+    except sqlite3.Error as e:
+        print(f"[Assets] Erro ao gravar o histórico: {e}")
+        return None
+
+
+def _history_summary(row) -> dict:
+    summary = dict(zip(HISTORY_SUMMARY_FIELDS, row))
+    summary["has_assets"] = bool(summary["has_assets"])
+    return summary
+
+
+def find_reusable_run(ramo: str, localizacao: str, oferta: str, cliente: str, nicho: str,
+                      include_assets: bool = False, max_age: float | None = None) -> dict | None:
+    """Resultado da execução equivalente mais recente do pipeline (None se não houver uma recente)."""
+    max_age = HISTORY_REUSE_MAX_AGE if max_age is None else max_age
+    row = history_db().execute("""
+        SELECT id, result, created_at FROM history_runs
+        WHERE request_key = ? AND kind = 'pipeline' AND created_at >= ? AND (has_assets = 1 OR ? = 0)
+        ORDER BY created_at DESC LIMIT 1
+    """, (history_request_key(ramo, localizacao, oferta, cliente, nicho), time.time() - max_age,
+          int(include_assets))).fetchone()
+    if not row:
+        return None
+    result = json.loads(row[1])
+    result["history"] = {"id": row[0], "reused": True, "created_at": row[2],
+                         "age_seconds": round(time.time() - row[2], 1)}
+    return result
+
+
+def _history_filters(cliente: str | None, nicho: str | None, kind: str | None) -> tuple:
+    clauses, args = [], []
+    if cliente:
+        clauses.append("r.cliente_key = ?")
+        args.append(normalize_keyword(cliente))
+    if nicho:
+        clauses.append("r.nicho_key = ?")
+        args.append(normalize_keyword(nicho))
+    if kind:
+        clauses.append("r.kind = ?")
+        args.append(kind)
+    return clauses, args
+
+
+def list_history_runs(cliente: str | None = None, nicho: str | None = None, kind: str | None = None,
+                      limit: int = HISTORY_PAGE_SIZE, offset: int = 0) -> dict:
+    """Execuções mais recentes primeiro, filtradas por cliente, nicho e tipo."""
+    clauses, args = _history_filters(cliente, nicho, kind)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    conn = history_db()
+    total = conn.execute(f"SELECT COUNT(*) FROM history_runs r {where}", args).fetchone()[0]
+    columns = ", ".join(f"r.{field}" for field in HISTORY_SUMMARY_FIELDS)
+    rows = conn.execute(
+        f"SELECT {columns} FROM history_runs r {where} ORDER BY r.created_at DESC LIMIT ? OFFSET ?",
+        (*args, limit, offset)
+    ).fetchall()
+    return {"total": total, "limit": limit, "offset": offset, "runs": [_history_summary(row) for row in rows]}
+
+
+def history_match_query(text: str) -> str:
+    """Converte o texto livre numa consulta FTS5 segura: todos os termos, por prefixo."""
+    return " ".join(f'"{term}"*' for term in normalize_keyword(text).split())
+
+
+def search_history(text: str, cliente: str | None = None, nicho: str | None = None, kind: str | None = None,
+                   limit: int = HISTORY_PAGE_SIZE, offset: int = 0, sort: str = "relevance") -> dict:
+    """Busca textual (keywords, títulos, descrições, cliente, nicho).
+
+    sort="relevance" ordena por BM25; sort="recent" percorre o índice do mais
+    novo para o mais antigo e para no limite (mais rápido para termos comuns).
+    """
+    match = history_match_query(text)
+    if not match:
+        raise ValueError("Informe termos para a busca")
+    if sort not in HISTORY_SORTS:
+        raise ValueError("O campo 'sort' deve ser 'relevance' ou 'recent'")
+    clauses, args = _history_filters(cliente, nicho, kind)
+    where = "".join(f" AND {clause}" for clause in clauses)
+    order = "history_fts.rank" if sort == "relevance" else "history_fts.rowid DESC"
+    columns = ", ".join(f"r.{field}" for field in HISTORY_SUMMARY_FIELDS)
+    conn = history_db()
+    # Sem filtros, a contagem sai só do índice FTS (sem join)
+    join = " JOIN history_runs r ON r.seq = history_fts.rowid" if clauses else ""
+    total = conn.execute(f"SELECT COUNT(*) FROM history_fts{join} WHERE history_fts MATCH ?{where}",
+                         (match, *args)).fetchone()[0]
+    rows = conn.execute(f"""
+        SELECT {columns}, snippet(history_fts, -1, '[', ']', '…', 12)
+        FROM history_fts JOIN history_runs r ON r.seq = history_fts.rowid
+        WHERE history_fts MATCH ?{where}
+        ORDER BY {order} LIMIT ? OFFSET ?
+    """, (match, *args, limit, offset)).fetchall()
+    runs = []
+    for row in rows:
+        summary = _history_summary(row[:len(HISTORY_SUMMARY_FIELDS)])
+        summary["snippet"] = row[-1]
+        runs.append(summary)
+    return {"query": text, "sort": sort, "total": total, "limit": limit, "offset": offset, "runs": runs}
+
+
+def get_history_run(run_id: str) -> dict | None:
+    """Execução completa (resumo + resultado gravado)."""
+    columns = ", ".join(f"r.{field}" for field in HISTORY_SUMMARY_FIELDS)
+    row = history_db().execute(f"SELECT {columns}, r.result FROM history_runs r WHERE r.id = ?",
+                               (run_id,)).fetchone()
+    if not row:
+        return None
+    run = _history_summary(row[:-1])
+    run["result"] = json.loads(row[-1])
+    return run
+
+
+def replay_history_events(result: dict, on_event):
+    """Publica uma execução reaproveitada com os mesmos eventos do pipeline em streaming."""
+    on_event("keywords_done", result["keywords"])
+    for index, ad in enumerate(result.get("ads") or []):
+        on_event("ad", {"index": index, "ad": ad})
+    if "assets" in result:
+        on_event("assets", {"assets": result["assets"], "error": result.get("assets_error")})
+
+
+# =============================================================================
+# JOBS - Fila Assíncrona de Pipelines
+# =============================================================================
+
+# JOBS_MAX_WORKERS: pipelines executados ao mesmo tempo por processo
+# JOBS_MAX_PENDING: limite de jobs na fila + em execução (acima disso responde 503)
+# JOBS_RESULT_TTL: segundos que o resultado de um job fica disponível após terminar
+# JOBS_LEASE_TTL: segundos sem renovação após os quais um job na fila/em execução é
+#   considerado órfão (o worker que o recebeu reiniciou ou caiu) e é retomado por outro
+# JOBS_MAX_ATTEMPTS: execuções iniciadas de um job antes de ele falhar de vez ao ser retomado
+# JOBS_CANCEL_POLL_INTERVAL: segundos entre as checagens de cancelamento dos jobs em execução
+#   (o cancelamento pode chegar por outro worker; a checagem é uma consulta por processo)
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", "4"))
+JOBS_MAX_PENDING = int(os.getenv("JOBS_MAX_PENDING", "50"))
+JOBS_RESULT_TTL = float(os.getenv("JOBS_RESULT_TTL", "3600"))
+JOBS_LEASE_TTL = float(os.getenv("JOBS_LEASE_TTL", "60"))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "2"))
+JOBS_CANCEL_POLL_INTERVAL = float(os.getenv("JOBS_CANCEL_POLL_INTERVAL", "1"))
+
+JOB_FINAL_STATUSES = ("done", "failed", "cancelled")
+
+_jobs_executor = ThreadPoolExecutor(max_workers=max(1, JOBS_MAX_WORKERS), thread_name_prefix="job")
+_jobs_db_ready = False
+# Dono dos leases dos jobs deste processo (o pid muda a cada worker do gunicorn)
+_jobs_boot_id = uuid.uuid4().hex
+_jobs_heartbeat_pid = None
+_jobs_heartbeat_lock = threading.Lock()
+# Jobs em execução neste processo: job_id -> threading.Event sinalizado ao pedir o cancelamento
+_job_cancel_events = {}
+_job_cancel_lock = threading.Lock()
+
+
+def jobs_db() -> sqlite3.Connection:
+    """Retorna a conexão com o banco de jobs, criando a tabela se necessário."""
+    global _jobs_db_ready
+    conn = get_sqlite("jobs")
+    if not _jobs_db_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                progress TEXT,
+                result TEXT,
+                error TEXT,
+                error_status INTEGER,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                expires_at REAL
+            )
+        """)
+        # Bancos criados antes dos leases ganham as colunas (lease nulo = órfão, retomado)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (("owner", "TEXT"), ("lease_expires_at", "REAL"),
+                                   ("attempts", "INTEGER NOT NULL DEFAULT 0")):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs (expires_at)")
+        conn.commit()
+        _jobs_db_ready = True
+    return conn
+
+
+def jobs_owner() -> str:
+    """Identificador deste processo nos leases dos jobs."""
+    return f"{os.getpid()}:{_jobs_boot_id}"
+
+
+def _update_job(job_id: str, **fields):
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    conn = jobs_db()
+    conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+    conn.commit()
+
+
+def _finish_job(job_id: str, status: str, **fields):
+    now = time.time()
+    _update_job(job_id, status=status, finished_at=now, expires_at=now + JOBS_RESULT_TTL, **fields)
+
+
+def _signal_cancelled_jobs():
+    """Sinaliza os jobs em execução neste processo cujo cancelamento foi pedido (em qualquer worker)."""
+    with _job_cancel_lock:
+        running = dict(_job_cancel_events)
+    if not running:
+        return
+    placeholders = ", ".join("?" * len(running))
+    rows = jobs_db().execute(f"SELECT id FROM jobs WHERE cancel_requested = 1 AND id IN ({placeholders})",
+                             tuple(running)).fetchall()
+    for (job_id,) in rows:
+        running[job_id].set()
+
+
+def _run_pipeline_job(job_id: str, params: dict, cancel_event: threading.Event) -> dict:
+    """Executa o pipeline completo registrando o progresso; `cancel_event` interrompe varreduras e chamadas à IA."""
+    progress = {"stage": None, "keywords": 0, "ads": 0}
+
+    def on_event(event, payload):
+        check_cancelled(cancel_event)
+        if event == "stage":
+            progress["stage"] = payload["stage"]
+        elif event == "keywords":
+            progress["keywords"] = payload["total"]
+        elif event == "keywords_done":
+            progress["stage"] = "ad_intelligence"
+            progress["keywords"] = payload["total"]
+        elif event == "ad":
+            progress["ads"] = payload["index"] + 1
+        else:
+            return
+        _update_job(job_id, progress=json.dumps(progress, ensure_ascii=False))
+
+    return run_full_pipeline(**params, on_event=on_event, cancel_event=cancel_event)
+
+
+def _run_assets_job(job_id: str, params: dict, cancel_event: threading.Event) -> dict:
+    """Gera os ativos RSA com a IA (refinamento do rascunho devolvido por /generate_assets)."""
+    _update_job(job_id, progress=json.dumps({"stage": "assets"}))
+    with cancel_scope(cancel_event):
+        assets = generate_responsive_assets(params["oferta"], params["localizacao"], params["ramo"],
+                                            params["keywords"], cache_mode=params.get("cache_mode", "prefer"))
+    check_cancelled(cancel_event)
+    history_id = record_assets_history(params["ramo"], params["localizacao"], params["oferta"],
+                                       params.get("cliente", ""), params.get("nicho", ""), assets, params["keywords"])
+    if history_id:
+        assets["history_id"] = history_id
+    return assets
+
+
+# Tipos de job suportados: kind -> função(job_id, params, cancel_event) que retorna o resultado
+JOB_HANDLERS = {
+    "full_pipeline": _run_pipeline_job,
+    "assets": _run_assets_job,
+}
+
+
+def _execute_job(job_id: str):
+    row = jobs_db().execute("SELECT kind, params, cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if not row:
+        return
+    kind, params, cancel_requested = row
+    if cancel_requested:
+        _finish_job(job_id, "cancelled")
+        return
+
+    conn = jobs_db()
+    conn.execute("UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                 (time.time(), job_id))
+    conn.commit()
+    print(f"[Jobs] Executando job {job_id} ({kind})")
+    trace = RequestTrace(job_id)
+    current_trace.set(trace)
+    params = json.loads(params)
+    current_llm_tenant.set(LLMTenant(params.pop("llm_tenant", None) or LLM_SYSTEM_TENANT.name, "batch"))
+    cancel_event = threading.Event()
+    with _job_cancel_lock:
+        _job_cancel_events[job_id] = cancel_event
+    try:
+        result = JOB_HANDLERS[kind](job_id, params, cancel_event)
+        _finish_job(job_id, "done", result=json.dumps(result, ensure_ascii=False))
+    except PipelineCancelled:
+        print(f"[Jobs] Job {job_id} cancelado")
+        _finish_job(job_id, "cancelled")
+    except LLMCacheMiss as e:
+        _finish_job(job_id, "failed", error=str(e), error_status=404)
+    except LLMBudgetExceeded as e:
+        _finish_job(job_id, "failed", error=str(e), error_status=429)
+    except ValueError as e:
+        _finish_job(job_id, "failed", error=str(e), error_status=422)
+    except Exception as e:
+        _finish_job(job_id, "failed", error=str(e), error_status=500)
+    finally:
+        with _job_cancel_lock:
+            _job_cancel_events.pop(job_id, None)
+        current_trace.set(None)
+        current_llm_tenant.set(None)
+        if TRACE_LOG:
+            print(f"[Trace {job_id}] job {kind} em {(time.monotonic() - trace.started) * 1000:.0f}ms | {trace.summary()}")
+        metrics.flush()
+
+
+def purge_expired_jobs() -> int:
+    """Remove jobs finalizados cujo resultado expirou."""
+    conn = jobs_db()
+    removed = conn.execute("DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),)).rowcount
+    conn.commit()
+    return removed
+
+
+def reclaim_stale_jobs() -> int:
+    """Retoma os jobs órfãos (lease vencido): voltam para a fila deste processo ou, depois de
+    JOBS_MAX_ATTEMPTS execuções iniciadas, falham. Retorna quantos voltaram para a fila.
+    """
+    now = time.time()
+    conn = jobs_db()
+    stale = ("status IN ('queued', 'running') AND (lease_expires_at IS NULL OR lease_expires_at < ?)")
+    rows = conn.execute(f"SELECT id, attempts FROM jobs WHERE {stale}", (now,)).fetchall()
+    reclaimed = 0
+    for job_id, attempts in rows:
+        if attempts >= JOBS_MAX_ATTEMPTS:
+            conn.execute(
+                f"UPDATE jobs SET status = 'failed', error = ?, error_status = 500, finished_at = ?, expires_at = ?, "
+                f"owner = NULL WHERE id = ? AND {stale}",
+                ("Job interrompido pelo reinício do servidor", now, now + JOBS_RESULT_TTL, job_id, now)
+            )
+            conn.commit()
+            print(f"[Jobs] Job {job_id} interrompido {attempts}x: marcado como falho")
+            continue
+        # O UPDATE condicional garante que só um worker retoma cada job
+        claimed = conn.execute(f"UPDATE jobs SET status = 'queued', owner = ?, lease_expires_at = ? "
+                               f"WHERE id = ? AND {stale}",
+                               (jobs_owner(), now + JOBS_LEASE_TTL, job_id, now)).rowcount == 1
+        conn.commit()
+        if claimed:
+            print(f"[Jobs] Job órfão {job_id} retomado")
+            ensure_jobs_heartbeat()
+            _jobs_executor.submit(_execute_job, job_id)
+            reclaimed += 1
+    return reclaimed
+
+
+def _jobs_heartbeat():
+    """Renova os leases dos jobs deste processo e retoma os órfãos (na partida e a cada JOBS_LEASE_TTL / 3 segundos).
+
+    A cada JOBS_CANCEL_POLL_INTERVAL, sinaliza os jobs em execução com cancelamento pedido.
+    """
+    interval = JOBS_LEASE_TTL / 3
+    renew_at = 0.0
+    while True:
+        try:
+            if time.monotonic() >= renew_at:
+                renew_at = time.monotonic() + interval
+                conn = jobs_db()
+                conn.execute("UPDATE jobs SET lease_expires_at = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                             (time.time() + JOBS_LEASE_TTL, jobs_owner()))
+                conn.commit()
+                reclaim_stale_jobs()
+            _signal_cancelled_jobs()
+        except sqlite3.Error as e:
+            print(f"[Jobs] Erro ao renovar os leases: {e}")
+        time.sleep(min(interval, JOBS_CANCEL_POLL_INTERVAL))
+
+
+def ensure_jobs_heartbeat():
+    """Inicia a renovação dos leases neste processo (já dentro do worker do gunicorn, após o fork)."""
+    global _jobs_heartbeat_pid
+    with _jobs_heartbeat_lock:
+        if _jobs_heartbeat_pid != os.getpid():
+            threading.Thread(target=_jobs_heartbeat, name="jobs-heartbeat", daemon=True).start()
+            _jobs_heartbeat_pid = os.getpid()
+
+
+def count_pending_jobs() -> int:
+    """Quantidade de jobs na fila ou em execução (todos os workers)."""
+    return jobs_db().execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+
+def submit_job(kind: str, params: dict) -> str:
+    """Registra um job (com o lease deste processo) e agenda sua execução no pool local. Retorna o id do job."""
+    job_id = uuid.uuid4().hex
+    # As chamadas à IA do job são cobradas de quem o enviou (API key ou IP), na fila de batch
+    params = {**params, "llm_tenant": derive_llm_tenant("batch").name}
+    conn = jobs_db()
+    now = time.time()
+    conn.execute(
+        "INSERT INTO jobs (id, kind, status, params, created_at, owner, lease_expires_at) "
+        "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+        (job_id, kind, json.dumps(params, ensure_ascii=False), now, jobs_owner(), now + JOBS_LEASE_TTL)
+    )
+    conn.commit()
+    ensure_jobs_heartbeat()
+    _jobs_executor.submit(_execute_job, job_id)
+    return job_id
+
+
+def get_job(job_id: str) -> dict | None:
+    """Retorna o estado público de um job (None se não existir ou tiver expirado)."""
+    row = jobs_db().execute(
+        "SELECT id, kind, status, progress, result, error, error_status, created_at, started_at, finished_at, expires_at "
+        "FROM jobs WHERE id = ?", (job_id,)
+    ).fetchone()
+    if not row or (row[10] is not None and row[10] < time.time()):
+        return None
+
+    job = {
+        "job_id": row[0],
+        "kind": row[1],
+        "status": row[2],
+        "progress": json.loads(row[3]) if row[3] else None,
+        "created_at": row[7],
+        "started_at": row[8],
+        "finished_at": row[9],
+        "expires_at": row[10]
+    }
+    if row[4] is not None:
+        job["result"] = json.loads(row[4])
+    if row[5] is not None:
+        job["error"] = row[5]
+        job["error_status"] = row[6]
+    return job
+
+
+def cancel_job(job_id: str) -> dict | None:
+    """Solicita o cancelamento de um job. Jobs ainda na fila são cancelados na hora; em execução
+    neste processo, são sinalizados na hora (nos outros workers, pelo heartbeat).
+    """
+    conn = jobs_db()
+    conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN ('queued', 'running')", (job_id,))
+    conn.commit()
+    with _job_cancel_lock:
+        cancel_event = _job_cancel_events.get(job_id)
+    if cancel_event:
+        cancel_event.set()
+    now = time.time()
+    conn.execute(
+        "UPDATE jobs SET status = 'cancelled', finished_at = ?, expires_at = ? WHERE id = ? AND status = 'queued'",
+        (now, now + JOBS_RESULT_TTL, job_id)
+    )
+    conn.commit()
+    return get_job(job_id)
+
+
+# =============================================================================
+# BATCH - Pipeline para Vários Clientes/Nichos em uma Chamada
+# =============================================================================
+
+# BATCH_MAX_RECORDS: registros aceitos por chamada
+# BATCH_MAX_CONCURRENCY: registros processados ao mesmo tempo em um batch
+# BATCH_MAX_SWEEPS: varreduras A-Z simultâneas (somando todos os batches do processo)
+BATCH_MAX_RECORDS = int(os.getenv("BATCH_MAX_RECORDS", "200"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_MAX_SWEEPS = int(os.getenv("BATCH_MAX_SWEEPS", "3"))
+
+batch_sweep_slots = threading.BoundedSemaphore(max(1, BATCH_MAX_SWEEPS))
+
+
+class SharedSweeps:
+    """Memoiza varreduras A-Z dentro de um batch: nichos repetidos reusam a mesma varredura.
+
+    Quem inicia a varredura recebe o progresso ao vivo em `on_batch` e pode cancelá-la
+    com `cancel_event`; quem reusa recebe as sondagens reproduzidas ao final e para de
+    esperar quando o próprio `cancel_event` é sinalizado. Uma varredura cancelada não é
+    memoizada: quem a esperava faz a sua.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sweeps = {}
+
+    def __call__(self, ramo: str, localizacao: str = "", on_batch=None, cancel_event=None,
+                 probe_results: dict | None = None) -> list:
+        key = sweep_key(ramo, localizacao)
+        while True:
+            with self._lock:
+                future = self._sweeps.get(key)
+                owner = future is None
+                if owner:
+                    future = self._sweeps[key] = Future()
+
+            if owner:
+                return self._sweep(key, future, ramo, localizacao, on_batch, cancel_event, probe_results)
+
+            try:
+                keywords, probes = self._wait(future, cancel_event)
+            except TimeoutError:
+                record_cut("autocomplete_sweep", "timeout")
+                return []
+            except PipelineCancelled:
+                if cancel_event is not None and cancel_event.is_set():
+                    return []
+                # A varredura de outro registro foi cancelada: refaz
+                continue
+            break
+
+        # Reproduz as sondagens para quem acompanha o progresso (SSE)
+        if on_batch:
+            seen = set()
+            for query, suggestions in probes.items():
+                new_suggestions = [s for s in dict.fromkeys(suggestions) if s not in seen]
+                seen.update(new_suggestions)
+                if new_suggestions:
+                    on_batch(query, new_suggestions)
+        if probe_results is not None:
+            probe_results.update(probes)
+        return list(keywords)
+
+    def _sweep(self, key: tuple, future: Future, ramo: str, localizacao: str, on_batch, cancel_event,
+               probe_results: dict | None) -> list:
+        probes = {}
+        try:
+            with batch_sweep_slots:
+                keywords = scrape_keywords(ramo, localizacao, on_batch=on_batch, cancel_event=cancel_event,
+                                           probe_results=probes)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        if probe_results is not None:
+            probe_results.update(probes)
+        if cancel_event is not None and cancel_event.is_set():
+            with self._lock:
+                self._sweeps.pop(key, None)
+            future.set_exception(PipelineCancelled())
+        else:
+            future.set_result((keywords, probes))
+        return keywords
+
+    @staticmethod
+    def _wait(future: Future, cancel_event) -> tuple:
+        """Espera a varredura de outro registro (dentro do prazo), verificando o próprio cancelamento."""
+        while True:
+            check_cancelled(cancel_event)
+            remaining = deadline_remaining()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError()
+            if wait([future], timeout=0.5 if remaining is None else min(0.5, remaining)).done:
+                return future.result()
+
+    @property
+    def total(self) -> int:
+        return len(self._sweeps)
+
+
+def parse_batch_records(req) -> tuple:
+    """Lê os registros do batch (JSON ou CSV). Retorna (registros, cache padrão, erro)."""
+    upload = req.files.get("file")
+    if upload or (req.mimetype or "").startswith("text/csv"):
+        raw = upload.read() if upload else req.get_data()
+        text = raw.decode("utf-8-sig", errors="replace")
+        try:
+            dialect = csv.Sniffer().sniff(text[:2048], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        records = [dict(row) for row in csv.DictReader(io.StringIO(text), dialect=dialect)]
+        default_cache = req.form.get("cache") or req.args.get("cache")
+    else:
+        data = req.get_json(silent=True)
+        if isinstance(data, dict):
+            records, default_cache = data.get("records"), data.get("cache")
+        else:
+            records, default_cache = data, None
+        if not isinstance(records, list):
+            return None, None, "Envie uma lista 'records' em JSON ou um arquivo CSV"
+
+    if not records:
+        return None, None, "Nenhum registro enviado"
+    if len(records) > BATCH_MAX_RECORDS:
+        return None, None, f"Máximo de {BATCH_MAX_RECORDS} registros por batch"
+    return records, default_cache, None
+
+
+def _run_batch_record(index: int, record, default_cache, sweeps: SharedSweeps) -> dict:
+    if not isinstance(record, dict):
+        return {"index": index, "success": False, "error": "Registro inválido", "status": 400}
+    if default_cache and not record.get("cache"):
+        record = {**record, "cache": default_cache}
+
+    params, error = parse_pipeline_request(record)
+    if error:
+        return {"index": index, "success": False, "error": error, "status": 400}
+
+    result = {"index": index, "cliente": params["cliente"], "nicho": params["nicho"]}
+    try:
+        # Os registros são cobrados do tenant de quem enviou o batch (API key ou IP), na fila de batch
+        with llm_tenant_scope(derive_llm_tenant("batch")):
+            result.update(success=True, data=run_full_pipeline(**params, scraper=sweeps))
+    except LLMCacheMiss as e:
+        result.update(success=False, error=str(e), status=404)
+    except LLMBudgetExceeded as e:
+        result.update(success=False, error=str(e), status=429)
+    except ValueError as e:
+        result.update(success=False, error=str(e), status=422)
+    except Exception as e:
+        result.update(success=False, error=str(e), status=500)
+    return result
+
+
+def run_batch_pipeline(records: list, default_cache: str | None = None):
+    """Processa os registros em paralelo e gera cada resultado assim que fica pronto."""
+    started = time.monotonic()
+    sweeps = SharedSweeps()
+    succeeded = 0
+
+    executor = ThreadPoolExecutor(max_workers=max(1, BATCH_MAX_CONCURRENCY), thread_name_prefix="batch")
+    try:
+        futures = [executor.submit(with_trace(_run_batch_record), i, record, default_cache, sweeps)
+                   for i, record in enumerate(records)]
+        for future in as_completed(futures):
+            result = future.result()
+            succeeded += int(result["success"])
+            yield result
+    finally:
+        # Se o cliente desconectar, os registros ainda não iniciados são descartados
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    yield {
+        "done": True,
+        "total": len(records),
+        "succeeded": succeeded,
+        "failed": len(records) - succeeded,
+        "unique_sweeps": sweeps.total,
+        "elapsed_ms": int((time.monotonic() - started) * 1000)
+    }
+
+
+# =============================================================================
+# CONTROLE DE CARGA - Backpressure por Worker
+# =============================================================================
+
+# SERVER_MAX_IN_FLIGHT: requisições pesadas (scraper/IA) simultâneas por worker;
+#   acima disso a resposta é 503 com Retry-After, em vez de enfileirar no gunicorn
+#   (o gunicorn.conf.py ajusta o padrão ao número de threads)
+# SERVER_RETRY_AFTER: segundos sugeridos no header Retry-After
+SERVER_MAX_IN_FLIGHT = int(os.getenv("SERVER_MAX_IN_FLIGHT", "32"))
+SERVER_RETRY_AFTER = int(os.getenv("SERVER_RETRY_AFTER", "5"))
+
+# Endpoints que ocupam uma thread por segundos (scraper e/ou IA)
+HEAVY_ENDPOINTS = {
+    "generate_assets", "hunt_keywords", "generate_winning_ads",
+    "full_pipeline", "full_pipeline_stream", "batch_pipeline"
+}
+# Rotas que chamam a IA (direto ou por jobs): só elas identificam o tenant
+LLM_ENDPOINTS = HEAVY_ENDPOINTS | {"create_job"}
+
+
+class AdmissionControl:
+    """Limita as requisições pesadas em andamento no worker (sem fila: as excedentes são recusadas)."""
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._in_flight >= self.limit:
+                self._rejected += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"limit": self.limit, "in_flight": self._in_flight, "rejected": self._rejected}
+
+
+admission = AdmissionControl(SERVER_MAX_IN_FLIGHT)
+
 
 # =============================================================================
 # ENDPOINTS
@@ -460,13 +5632,12 @@ Retorne APENAS o JSON."""
 
 @app.route("/generate_assets", methods=["POST"])
 def generate_assets():
-    """Endpoint para gerar ativos massivos para Google Ads Responsivo."""
+    """Endpoint para gerar ativos massivos para Google Ads Responsivo.
 
-    if not os.getenv("OPENAI_API_KEY"):
-        return jsonify({
-            "success": False,
-            "error": "API Key da OpenAI não configurada. Verifique o arquivo .env"
-        }), 500
+    Com "draft": true, devolve na hora o rascunho local (sem IA); com "refine": true,
+    agenda também um job que gera os ativos com a IA (acompanhe em refine.status_url).
+    A chamada à IA respeita o prazo "deadline" (segundos, padrão PIPELINE_DEADLINE).
+    """
 
     data = request.get_json()
 
@@ -479,7 +5650,11 @@ def generate_assets():
     oferta = data.get("oferta", "").strip()
     localizacao = data.get("localizacao", "").strip()
     ramo = data.get("ramo", "").strip()
-    keywords = data.get("keywords", [])
+    keywords = data.get("keywords") or []
+    cliente = str(data.get("cliente") or "").strip()
+    nicho = str(data.get("nicho") or "").strip()
+    draft = parse_flag(data.get("draft"))
+    refine = draft and parse_flag(data.get("refine"))
 
     if not oferta:
         return jsonify({"success": False, "error": "O campo 'oferta' é obrigatório"}), 400
@@ -487,15 +5662,72 @@ def generate_assets():
         return jsonify({"success": False, "error": "O campo 'localizacao' é obrigatório"}), 400
     if not ramo:
         return jsonify({"success": False, "error": "O campo 'ramo' é obrigatório"}), 400
+    if not isinstance(keywords, list):
+        return jsonify({"success": False, "error": "O campo 'keywords' deve ser uma lista"}), 400
+    keywords = [str(keyword) for keyword in keywords if keyword]
 
-    try:
-        assets = generate_responsive_assets(oferta, localizacao, ramo, keywords)
+    # O rascunho local não depende da IA
+    if (not draft or refine) and not llm_configured():
+        return jsonify({
+            "success": False,
+            "error": "API Key da IA não configurada. Verifique o arquivo .env (OPENAI_API_KEY / ANTHROPIC_API_KEY)"
+        }), 500
+
+    cache_mode = get_cache_mode(data)
+    if cache_mode is None:
+        return jsonify({"success": False, "error": "O campo 'cache' deve ser 'bypass', 'prefer' ou 'only'"}), 400
+    deadline, error = parse_deadline(data.get("deadline"))
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
+    local_keywords, _ = filter_keywords_by_location(keywords, localizacao, f"{ramo} {oferta}")
+    ranked_keywords = rank_keywords(local_keywords or keywords)
+
+    if draft:
+        assets = draft_responsive_assets(oferta, localizacao, ramo, ranked_keywords)
+        if refine:
+            purge_expired_jobs()
+            reclaim_stale_jobs()
+            if count_pending_jobs() >= JOBS_MAX_PENDING:
+                response = jsonify({"success": False, "error": "Fila de jobs cheia. Tente novamente em instantes"})
+                response.headers["Retry-After"] = "30"
+                return response, 503
+            job_id = submit_job("assets", {
+                "oferta": oferta, "localizacao": localizacao, "ramo": ramo, "keywords": ranked_keywords,
+                "cache_mode": cache_mode, "cliente": cliente, "nicho": nicho
+            })
+            assets["refine"] = {"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}
         return jsonify({"success": True, "data": assets})
 
-    except ValueError as e:
-        return jsonify({"success": False, "error": str(e)}), 422
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+    with deadline_scope(make_deadline(deadline)) as assets_deadline:
+        try:
+            assets = generate_responsive_assets(oferta, localizacao, ramo, ranked_keywords, cache_mode=cache_mode)
+            # Ativos encurtados pelo prazo não entram no histórico
+            if not (assets_deadline and assets_deadline.cuts):
+                history_id = record_assets_history(ramo, localizacao, oferta, cliente, nicho, assets,
+                                                   ranked_keywords)
+                if history_id:
+                    assets["history_id"] = history_id
+
+        except LLMCacheMiss as e:
+            return jsonify({"success": False, "error": str(e)}), 404
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 422
+        except Exception as e:
+            if not ASSETS_DRAFT_FALLBACK:
+                if isinstance(e, LLMBudgetExceeded):
+                    return budget_exceeded_response(e)
+                if isinstance(e, DeadlineExceeded):
+                    return deadline_exceeded_response(e, assets_deadline)
+                return jsonify({"success": False, "error": str(e)}), 500
+            print(f"[Assets] IA indisponível ({e}): usando o rascunho local")
+            assets = draft_responsive_assets(oferta, localizacao, ramo, ranked_keywords)
+            assets["fallback_used"] = "rascunho_local"
+            assets["fallback_message"] = "IA indisponível no momento: ativos gerados por modelos locais (rascunho)"
+
+    if assets_deadline:
+        assets["deadline"] = assets_deadline.report()
+    return jsonify({"success": True, "data": assets})
 
 
 @app.route("/hunt_keywords", methods=["POST"])
@@ -511,16 +5743,18 @@ def hunt_keywords():
         }), 400
 
     ramo = data.get("ramo", "").strip()
+    localizacao = str(data.get("localizacao") or "").strip()
 
     if not ramo:
         return jsonify({"success": False, "error": "O campo 'ramo' é obrigatório"}), 400
 
     try:
-        keywords = scrape_autocomplete_az(ramo)
+        keywords = scrape_keywords(ramo, localizacao)
         return jsonify({
             "success": True,
             "data": {
                 "ramo": ramo,
+                "localizacao": localizacao,
                 "total": len(keywords),
                 "keywords": keywords
             }
@@ -532,12 +5766,15 @@ def hunt_keywords():
 
 @app.route("/generate_winning_ads", methods=["POST"])
 def generate_winning_ads():
-    """Endpoint Ad-Intelligence: Análise + Modelagem de anúncios vencedores."""
+    """Endpoint Ad-Intelligence: Análise + Modelagem de anúncios vencedores.
+
+    A chamada à IA respeita o prazo "deadline" (segundos, padrão PIPELINE_DEADLINE).
+    """
 
-    if not os.getenv("OPENAI_API_KEY"):
+    if not llm_configured():
         return jsonify({
             "success": False,
-            "error": "API Key da OpenAI não configurada. Verifique o arquivo .env"
+            "error": "API Key da IA não configurada. Verifique o arquivo .env (OPENAI_API_KEY / ANTHROPIC_API_KEY)"
         }), 500
 
     data = request.get_json()
@@ -562,127 +5799,362 @@ def generate_winning_ads():
     if not nicho:
         return jsonify({"success": False, "error": "O campo 'nicho' é obrigatório"}), 400
 
+    cache_mode = get_cache_mode(data)
+    if cache_mode is None:
+        return jsonify({"success": False, "error": "O campo 'cache' deve ser 'bypass', 'prefer' ou 'only'"}), 400
+    deadline, error = parse_deadline(data.get("deadline"))
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
+    with deadline_scope(make_deadline(deadline)) as ads_deadline:
+        try:
+            ads = analyze_and_model_ads(rank_keywords(keywords), oferta, cliente, nicho, cache_mode=cache_mode)
+
+        except LLMCacheMiss as e:
+            return jsonify({"success": False, "error": str(e)}), 404
+        except LLMBudgetExceeded as e:
+            return budget_exceeded_response(e)
+        except DeadlineExceeded as e:
+            return deadline_exceeded_response(e, ads_deadline)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 422
+        except Exception as e:
+            return jsonify({"success": False, "error": str(e)}), 500
+
+    response = {"success": True, "data": ads}
+    if ads_deadline:
+        response["deadline"] = ads_deadline.report()
+    return jsonify(response)
+
+
+@app.route("/full_pipeline", methods=["POST"])
+def full_pipeline():
+    """Endpoint completo: Data Hunter + Ad-Intelligence com lógica de cascata."""
+
+    if not llm_configured():
+        return jsonify({
+            "success": False,
+            "error": "API Key da IA não configurada. Verifique o arquivo .env (OPENAI_API_KEY / ANTHROPIC_API_KEY)"
+        }), 500
+
+    params, error = parse_pipeline_request(request.get_json())
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
     try:
-        ads = analyze_and_model_ads(keywords, oferta, cliente, nicho)
-        return jsonify({"success": True, "data": ads})
+        return jsonify({"success": True, "data": run_full_pipeline(**params)})
 
+    except LLMCacheMiss as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except LLMBudgetExceeded as e:
+        return budget_exceeded_response(e)
     except ValueError as e:
         return jsonify({"success": False, "error": str(e)}), 422
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
-@app.route("/full_pipeline", methods=["POST"])
-def full_pipeline():
-    """Endpoint completo: Data Hunter + Ad-Intelligence com lógica de cascata."""
+@app.route("/full_pipeline/stream", methods=["POST"])
+def full_pipeline_stream():
+    """Pipeline completo via Server-Sent Events: keywords, estágios de fallback e anúncios incrementais.
 
-    if not os.getenv("OPENAI_API_KEY"):
+    Eventos: "stage", "keywords", "keywords_done", "ad", "assets", "done" e "error".
+    """
+
+    if not llm_configured():
         return jsonify({
             "success": False,
-            "error": "API Key da OpenAI não configurada. Verifique o arquivo .env"
+            "error": "API Key da IA não configurada. Verifique o arquivo .env (OPENAI_API_KEY / ANTHROPIC_API_KEY)"
         }), 500
 
-    data = request.get_json()
+    params, error = parse_pipeline_request(request.get_json())
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    # A vaga da admissão acompanha o pipeline (não a resposta): é devolvida quando ele termina
+    admitted = g.pop("admitted", False)
+
+    def emit(event, payload):
+        events.put((event, payload))
+
+    def worker():
+        try:
+            emit("done", run_full_pipeline(**params, on_event=emit, cancel_event=cancel_event))
+        except PipelineCancelled:
+            print("[Pipeline] Cliente do stream desconectou: pipeline interrompido")
+        except LLMCacheMiss as e:
+            emit("error", {"error": str(e), "status": 404})
+        except LLMBudgetExceeded as e:
+            emit("error", {"error": str(e), "status": 429, "retry_after": int(e.retry_after) + 1})
+        except ValueError as e:
+            emit("error", {"error": str(e), "status": 422})
+        except Exception as e:
+            emit("error", {"error": str(e), "status": 500})
+        finally:
+            events.put(None)
+            if admitted:
+                admission.release()
+
+    threading.Thread(target=with_trace(worker), name="pipeline-stream", daemon=True).start()
+
+    def generate():
+        try:
+            # Comentário inicial: envia os headers e o primeiro byte imediatamente
+            yield ": pipeline iniciado\n\n"
+            while True:
+                item = events.get()
+                if item is None:
+                    break
+                yield sse_event(*item)
+        finally:
+            # Fim normal ou cliente desconectado (GeneratorExit): o pipeline para no próximo ponto de checagem
+            cancel_event.set()
+
+    response = Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    # Conexão fechada antes do primeiro byte: o gerador nem chega a rodar o finally
+    response.call_on_close(cancel_event.set)
+    return response
 
-    if not data:
+
+@app.route("/batch_pipeline", methods=["POST"])
+def batch_pipeline():
+    """Pipeline completo para vários registros (JSON ou CSV), com resultados em NDJSON."""
+
+    if not llm_configured():
         return jsonify({
             "success": False,
-            "error": "Nenhum dado enviado na requisição"
-        }), 400
+            "error": "API Key da IA não configurada. Verifique o arquivo .env (OPENAI_API_KEY / ANTHROPIC_API_KEY)"
+        }), 500
 
-    ramo = data.get("ramo", "").strip()
-    localizacao = data.get("localizacao", "").strip()
-    oferta = data.get("oferta", "").strip()
-    cliente = data.get("cliente", "").strip()
-    nicho = data.get("nicho", "").strip()
+    records, default_cache, error = parse_batch_records(request)
+    if error:
+        return jsonify({"success": False, "error": error}), 400
 
-    if not ramo:
-        return jsonify({"success": False, "error": "O campo 'ramo' é obrigatório"}), 400
-    if not localizacao:
-        return jsonify({"success": False, "error": "O campo 'localizacao' é obrigatório"}), 400
-    if not oferta:
-        return jsonify({"success": False, "error": "O campo 'oferta' é obrigatório"}), 400
-    if not cliente:
-        return jsonify({"success": False, "error": "O campo 'cliente' é obrigatório"}), 400
-    if not nicho:
-        return jsonify({"success": False, "error": "O campo 'nicho' é obrigatório"}), 400
+    def generate():
+        for line in run_batch_pipeline(records, default_cache):
+            yield json.dumps(line, ensure_ascii=False) + "\n"
 
-    try:
-        keywords = []
-        fallback_mode = None  # None, "sem_localizacao", "ia_prediction"
+    return Response(generate(), mimetype="application/x-ndjson", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
 
-        # =============================================
-        # CASCATA DE FALLBACK
-        # =============================================
 
-        # Tentativa 1: Scraper com Ramo + Localização
-        print(f"[Pipeline] Tentativa 1: Scraper com '{ramo}' em '{localizacao}'")
-        keywords = scrape_autocomplete_az(ramo, localizacao)
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """Enfileira um pipeline completo e retorna o id do job imediatamente."""
 
-        # Tentativa 2: Scraper apenas com Ramo (sem localização)
-        if not keywords:
-            print(f"[Pipeline] Tentativa 2: Scraper apenas com '{ramo}'")
-            fallback_mode = "sem_localizacao"
-            keywords = scrape_autocomplete_az(ramo, "")
+    if not llm_configured():
+        return jsonify({
+            "success": False,
+            "error": "API Key da IA não configurada. Verifique o arquivo .env (OPENAI_API_KEY / ANTHROPIC_API_KEY)"
+        }), 500
 
-        # Tentativa 3: IA como backup final
-        if not keywords:
-            print(f"[Pipeline] Tentativa 3: Gerando keywords com IA")
-            fallback_mode = "ia_prediction"
-            keywords = generate_ai_keywords(ramo, localizacao, oferta, nicho)
-
-        # Se ainda assim não tiver keywords, usa fallback hardcoded
-        if not keywords:
-            keywords = [
-                f"{ramo} em {localizacao}",
-                f"{oferta}",
-                f"melhor {ramo}",
-                f"{ramo} preço",
-                f"contratar {ramo}"
-            ]
-            fallback_mode = "ia_prediction"
-
-        # =============================================
-        # PROCESSAMENTO DOS ANÚNCIOS
-        # =============================================
-
-        # Step 2: Ad-Intelligence (com localização)
-        ads = analyze_and_model_ads(keywords, oferta, cliente, nicho, localizacao)
-
-        # Monta resposta com info de fallback
-        response_data = {
-            "success": True,
-            "data": {
-                "keywords": {
-                    "ramo": ramo,
-                    "localizacao": localizacao,
-                    "total": len(keywords),
-                    "list": keywords,
-                    "source": "google_autocomplete" if fallback_mode is None else fallback_mode
-                },
-                "ads": ads,
-                "fallback_used": fallback_mode
-            }
+    params, error = parse_pipeline_request(request.get_json())
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
+    purge_expired_jobs()
+    reclaim_stale_jobs()
+    if count_pending_jobs() >= JOBS_MAX_PENDING:
+        response = jsonify({"success": False, "error": "Fila de jobs cheia. Tente novamente em instantes"})
+        response.headers["Retry-After"] = "30"
+        return response, 503
+
+    job_id = submit_job("full_pipeline", params)
+    return jsonify({
+        "success": True,
+        "data": {
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/jobs/{job_id}"
         }
+    }), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Retorna status, progresso e (quando pronto) o resultado de um job."""
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "Job não encontrado ou expirado"}), 404
+    return jsonify({"success": True, "data": job})
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def job_cancel(job_id):
+    """Cancela um job na fila ou em execução."""
+    job = cancel_job(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "Job não encontrado ou expirado"}), 404
+    return jsonify({"success": True, "data": job})
+
+
+def _history_query_args() -> tuple:
+    """Lê limit, offset e kind da query string. Retorna (limit, offset, kind, erro)."""
+    kind = request.args.get("kind") or None
+    if kind and kind not in HISTORY_KINDS:
+        return None, None, None, "O campo 'kind' deve ser 'pipeline' ou 'assets'"
+    try:
+        limit = int(request.args.get("limit", HISTORY_PAGE_SIZE))
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return None, None, None, "Os campos 'limit' e 'offset' devem ser números inteiros"
+    if limit < 1 or offset < 0:
+        return None, None, None, "O campo 'limit' deve ser positivo e 'offset' não pode ser negativo"
+    return min(limit, HISTORY_MAX_PAGE_SIZE), offset, kind, None
+
+
+@app.route("/history", methods=["GET"])
+def history_list():
+    """Lista as execuções gravadas (mais recentes primeiro), por cliente, nicho e tipo."""
+    if not HISTORY_ENABLED:
+        return jsonify({"success": False, "error": "Histórico desativado (HISTORY_ENABLED=false)"}), 404
+
+    limit, offset, kind, error = _history_query_args()
+    if error:
+        return jsonify({"success": False, "error": error}), 400
 
-        # Adiciona mensagem explicativa se usou fallback
-        if fallback_mode == "sem_localizacao":
-            response_data["data"]["fallback_message"] = f"Busca expandida: resultados para '{ramo}' em todo o Brasil"
-        elif fallback_mode == "ia_prediction":
-            response_data["data"]["fallback_message"] = "Palavras-chave geradas por IA (Previsão de Alto Volume)"
+    return jsonify({"success": True, "data": list_history_runs(
+        request.args.get("cliente"), request.args.get("nicho"), kind, limit, offset
+    )})
 
-        return jsonify(response_data)
 
+@app.route("/history/search", methods=["GET"])
+def history_search():
+    """Busca textual no histórico (keywords, títulos, descrições, cliente e nicho)."""
+    if not HISTORY_ENABLED:
+        return jsonify({"success": False, "error": "Histórico desativado (HISTORY_ENABLED=false)"}), 404
+
+    limit, offset, kind, error = _history_query_args()
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
+    try:
+        return jsonify({"success": True, "data": search_history(
+            request.args.get("q", ""), request.args.get("cliente"), request.args.get("nicho"), kind, limit, offset,
+            request.args.get("sort") or "relevance"
+        )})
     except ValueError as e:
-        return jsonify({"success": False, "error": str(e)}), 422
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        return jsonify({"success": False, "error": str(e)}), 400
+
+
+@app.route("/history/<run_id>", methods=["GET"])
+def history_run(run_id):
+    """Retorna uma execução do histórico com o resultado completo."""
+    run = get_history_run(run_id) if HISTORY_ENABLED else None
+    if not run:
+        return jsonify({"success": False, "error": "Execução não encontrada no histórico"}), 404
+    return jsonify({"success": True, "data": run})
+
+
+@app.route("/llm/usage", methods=["GET"])
+def llm_usage():
+    """Uso de tokens da IA por tenant (somando os workers), com o orçamento por minuto de cada um."""
+    try:
+        minutes = int(request.args.get("minutes", 60))
+    except ValueError:
+        return jsonify({"success": False, "error": "O campo 'minutes' deve ser um número inteiro"}), 400
+    if minutes < 1:
+        return jsonify({"success": False, "error": "O campo 'minutes' deve ser positivo"}), 400
+    minutes = min(minutes, max(1, int(LLM_USAGE_RETENTION // 60)))
+
+    tenant = request.args.get("tenant")
+    return jsonify({"success": True, "data": {
+        "minutes": minutes,
+        "tenants": llm_ledger.summary(minutes, tenant_name(tenant) if tenant else None)
+    }})
 
 
 # =============================================================================
 # ROTAS GERAIS
 # =============================================================================
 
+@app.before_request
+def start_request_trace():
+    """Abre o trace da requisição com o X-Request-ID recebido (ou um novo)."""
+    g.trace = RequestTrace(new_request_id(request.headers.get("X-Request-ID")))
+    current_trace.set(g.trace)
+
+
+@app.before_request
+def identify_llm_tenant():
+    """Define o tenant das chamadas à IA nas rotas que chamam a IA: a API key válida (X-API-Key) ou o IP.
+
+    /batch_pipeline vai para a fila de batch; as demais rotas são interativas.
+    """
+    if request.endpoint not in LLM_ENDPOINTS:
+        # A thread do worker reaproveita o contexto entre requisições: não herda o tenant anterior
+        current_llm_tenant.set(None)
+        return
+    lane = "batch" if request.endpoint == "batch_pipeline" else "interactive"
+    tenant = request_tenant_name(request.headers.get("X-API-Key"), request.remote_addr)
+    current_llm_tenant.set(LLMTenant(tenant, lane))
+
+
+@app.after_request
+def finish_request_trace(response):
+    """Devolve o request id e os tempos por etapa; a duração total é medida quando a resposta fecha."""
+    trace = g.get("trace")
+    if trace is None:
+        return response
+
+    response.headers["X-Request-ID"] = trace.request_id
+    if not response.is_streamed and trace.server_timing():
+        response.headers["Server-Timing"] = trace.server_timing()
+
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    method = request.method
+    status = response.status_code
+
+    def on_close():
+        # Em respostas em streaming, roda só depois do último byte enviado
+        elapsed = time.monotonic() - trace.started
+        metrics.observe("http_request_duration_seconds", elapsed, endpoint=endpoint, method=method, status=status)
+        if TRACE_LOG and endpoint != "/metrics":
+            print(f"[Trace {trace.request_id}] {method} {endpoint} {status} em {elapsed * 1000:.0f}ms"
+                  + (f" | {trace.summary()}" if trace.summary() else ""))
+        metrics.flush()
+
+    response.call_on_close(on_close)
+    current_trace.set(None)
+    return response
+
+
+@app.before_request
+def admit_request():
+    """Recusa com 503 as requisições pesadas quando o worker já está saturado."""
+    if request.endpoint not in HEAVY_ENDPOINTS:
+        return None
+    if not admission.try_acquire():
+        metrics.inc("requests_rejected_total", endpoint=request.url_rule.rule)
+        response = jsonify({"success": False, "error": "Servidor ocupado. Tente novamente em instantes"})
+        response.headers["Retry-After"] = str(SERVER_RETRY_AFTER)
+        return response, 503
+    g.admitted = True
+    return None
+
+
+@app.after_request
+def release_admission(response):
+    # Libera a vaga só quando a resposta termina (streams SSE/NDJSON inclusive)
+    if g.pop("admitted", False):
+        response.call_on_close(admission.release)
+    return response
+
+
+@app.teardown_request
+def release_admission_on_error(error):
+    # Erro antes do after_request: a vaga ainda não foi devolvida
+    if g.pop("admitted", False):
+        admission.release()
+
+
 @app.route("/health", methods=["GET"])
 def health_check():
     """Endpoint de health check."""
@@ -694,6 +6166,37 @@ def health_check():
     })
 
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    """Endpoint de estatísticas internas (pool HTTP e caches)."""
+    return jsonify({
+        "success": True,
+        "data": {
+            "http_pool": http_pool.stats(),
+            "autocomplete_cache": autocomplete_cache.stats(),
+            "llm_cache": llm_cache.stats(),
+            "scraper": {**scraper_counters, "circuit_breaker": scraper_breaker.stats()},
+            "admission": admission.stats(),
+            "keyword_corpus": keyword_corpus.stats(),
+            "llm": {
+                "routes": {task: [target.key for target in route] for task, route in
+                           {"default": llm_default_route, **llm_task_routes}.items()},
+                "hedge_enabled": LLM_HEDGE_ENABLED,
+                "first_token": llm_latency.stats(),
+                "scheduler": llm_scheduler.stats()
+            }
+        }
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Métricas no formato Prometheus (somadas entre os workers do gunicorn)."""
+    if not METRICS_ENABLED:
+        return jsonify({"success": False, "error": "Métricas desativadas (METRICS_ENABLED=false)"}), 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/")
 def serve_frontend():
     
@@ -710,11 +6213,22 @@ if __name__ == "__main__":
     print("   POST /hunt_keywords        - Data Hunter (Scraper A-Z)")
     print("   POST /generate_winning_ads - Ad-Intelligence (GPT-4o)")
     print("   POST /full_pipeline        - Pipeline Completo")
+    print("   POST /full_pipeline/stream - Pipeline Completo (SSE)")
+    print("   POST /batch_pipeline       - Pipeline em lote (NDJSON)")
+    print("   POST /jobs                 - Pipeline em segundo plano")
+    print("   GET  /jobs/<id>            - Status/resultado do job")
+    print("   GET  /history              - Histórico de campanhas (?cliente=&nicho=)")
+    print("   GET  /history/search?q=    - Busca no histórico (FTS5)")
+    print("   GET  /history/<id>         - Execução completa do histórico")
+    print("   GET  /llm/usage            - Uso de tokens da IA por tenant (?minutes=&tenant=)")
     print("   GET  /health               - Health check")
+    print("   GET  /stats                - Estatísticas internas")
+    print("   GET  /metrics              - Métricas (Prometheus)")
     print("="*60)
     print("🔧 Ferramentas:")
     print("   🔍 Data Hunter     - Scraper Google Autocomplete A-Z")
     print("   🧠 Ad-Intelligence - Modelagem de Anúncios Vencedores")
     print("="*60 + "\n")
 
+    ensure_jobs_heartbeat()
     app.run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,617 @@
+"""
+Benchmark Offline - Gerador de Anúncios
+Mede latência (p50/p95/p99), requisições/s e chamadas externas dos endpoints
+sem depender do Google nem dos provedores de IA (OpenAI e Anthropic): todos são
+substituídos por servidores locais.
+
+Uso:
+    python benchmark.py                                  # todos os cenários
+    python benchmark.py --scenarios hunt_cold,pipeline_warm --concurrency 1,8,32
+    python benchmark.py --output atual.json --baseline base.json
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import httpx
+
+
+# =============================================================================
+# SERVIDORES FALSOS - Google Autocomplete, OpenAI e Anthropic
+# =============================================================================
+
+SUGGESTION_WORDS = [
+    "preço", "perto de mim", "24 horas", "barato", "orçamento", "melhor", "avaliação", "urgente",
+    "particular", "convênio", "como funciona", "quanto custa", "agendar", "online", "delivery", "promoção"
+]
+
+
+class FakeServer:
+    """Servidor HTTP local em thread própria, com contadores de chamadas."""
+
+    def __init__(self, handler_class):
+        self.config = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        handler = type(handler_class.__name__, (handler_class,), {"server_state": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_port
+
+    def count(self, counter: str, amount: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+    def shutdown(self):
+        self._server.shutdown()
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_state = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status: int, payload, headers: dict | None = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def sleep_ms(mean_ms: float, jitter: float = 0.3):
+    if mean_ms > 0:
+        time.sleep(max(0.0, random.gauss(mean_ms, mean_ms * jitter)) / 1000)
+
+
+class AutocompleteHandler(QuietHandler):
+    """Imita o suggestqueries do Google: [query, [sugestões]].
+
+    config: latency_ms, error_rate (HTTP 500), throttle_rate (HTTP 429), empty_rate (sem sugestões).
+    """
+
+    def do_GET(self):
+        state = self.server_state
+        config = state.config
+        query = parse_qs(urlsplit(self.path).query).get("q", [""])[0]
+        state.count("requests")
+        sleep_ms(config.get("latency_ms", 40))
+
+        roll = random.random()
+        if roll < config.get("throttle_rate", 0):
+            state.count("throttled")
+            return self.send_json(429, {"error": "rate limited"}, {"Retry-After": "1"})
+        if roll < config.get("throttle_rate", 0) + config.get("error_rate", 0):
+            state.count("errors")
+            return self.send_json(500, {"error": "internal"})
+        if random.random() < config.get("empty_rate", 0):
+            return self.send_json(200, [query, []])
+
+        # Sugestões determinísticas por query: o mesmo termo sempre gera a mesma lista
+        rng = random.Random(zlib.crc32(query.encode("utf-8")))
+        suggestions = [f"{query} {word}" for word in rng.sample(SUGGESTION_WORDS, 8)]
+        self.send_json(200, [query, suggestions])
+
+
+def fake_llm_content(system_prompt: str, user_prompt: str) -> str:
+    """Resposta plausível (e válida) para cada prompt do app."""
+    if "Anúncios Responsivos" in system_prompt:
+        return json.dumps({
+            "titulos": [f"Título Benchmark {i}" for i in range(1, 16)],
+            "descricoes": [f"Descrição de benchmark número {i} com benefício claro e CTA. Agende já!" for i in range(1, 5)]
+        }, ensure_ascii=False)
+    if "Keyword Research" in system_prompt:
+        return json.dumps({"keywords": [f"palavra chave benchmark {i}" for i in range(1, 21)]}, ensure_ascii=False)
+    return json.dumps([{
+        "termo_real": f"termo benchmark {i}",
+        "intencao": "Fundo de Funil",
+        "anuncio_vencedor": {
+            "titulo": f"Anúncio Benchmark {i}",
+            "descricao": "Descrição do anúncio de benchmark com prova social e urgência.",
+            "cta": "Fale Conosco"
+        },
+        "por_que_funciona": "Combina intenção de compra com localização."
+    } for i in range(1, 6)], ensure_ascii=False)
+
+
+def first_token_ms(state: FakeServer) -> float:
+    """Tempo até o primeiro token; com slow_rate, parte das respostas leva slow_ms (cauda lenta do provedor)."""
+    config = state.config
+    if random.random() < config.get("slow_rate", 0):
+        state.count("slow")
+        return config.get("slow_ms", 5000)
+    return config.get("ttft_ms", 300)
+
+
+class OpenAIHandler(QuietHandler):
+    """Imita POST /v1/chat/completions (com e sem streaming).
+
+    config: ttft_ms (tempo até o primeiro token), token_latency_ms, error_rate (HTTP 500),
+    slow_rate/slow_ms (fração das respostas com primeiro token lento).
+    """
+
+    TOKEN_CHARS = 4
+
+    def do_POST(self):
+        state = self.server_state
+        config = state.config
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        state.count("requests")
+
+        if random.random() < config.get("error_rate", 0):
+            state.count("errors")
+            return self.send_json(500, {"error": {"message": "fake error", "type": "server_error"}})
+
+        messages = body.get("messages", [])
+        system_prompt = messages[0]["content"] if messages else ""
+        user_prompt = messages[-1]["content"] if messages else ""
+        content = fake_llm_content(system_prompt, user_prompt)
+        tokens = [content[i:i + self.TOKEN_CHARS] for i in range(0, len(content), self.TOKEN_CHARS)]
+        usage = {
+            "prompt_tokens": (len(system_prompt) + len(user_prompt)) // self.TOKEN_CHARS,
+            "completion_tokens": len(tokens),
+            "total_tokens": (len(system_prompt) + len(user_prompt)) // self.TOKEN_CHARS + len(tokens)
+        }
+        state.count("completion_tokens", len(tokens))
+        state.count("prompt_tokens", usage["prompt_tokens"])
+
+        sleep_ms(first_token_ms(state))
+        token_latency = config.get("token_latency_ms", 2) / 1000
+
+        if not body.get("stream"):
+            time.sleep(token_latency * len(tokens))
+            return self.send_json(200, {
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def send(payload):
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                 "model": body.get("model", "fake")}
+        try:
+            for token in tokens:
+                send({**chunk, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+                time.sleep(token_latency)
+            send({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send({**chunk, "choices": [], "usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            state.count("client_disconnects")
+        self.close_connection = True
+
+
+class AnthropicHandler(QuietHandler):
+    """Imita POST /v1/messages da Anthropic (streaming SSE).
+
+    config: as mesmas do OpenAIHandler (ttft_ms, token_latency_ms, error_rate, slow_rate/slow_ms).
+    """
+
+    TOKEN_CHARS = 4
+
+    def do_POST(self):
+        state = self.server_state
+        config = state.config
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        state.count("requests")
+
+        if random.random() < config.get("error_rate", 0):
+            state.count("errors")
+            return self.send_json(500, {"type": "error", "error": {"type": "api_error", "message": "fake error"}})
+
+        system_prompt = body.get("system", "")
+        messages = body.get("messages", [])
+        user_prompt = messages[-1]["content"] if messages else ""
+        content = fake_llm_content(system_prompt, user_prompt)
+        tokens = [content[i:i + self.TOKEN_CHARS] for i in range(0, len(content), self.TOKEN_CHARS)]
+        input_tokens = (len(system_prompt) + len(user_prompt)) // self.TOKEN_CHARS
+        state.count("completion_tokens", len(tokens))
+        state.count("prompt_tokens", input_tokens)
+
+        sleep_ms(first_token_ms(state))
+        token_latency = config.get("token_latency_ms", 2) / 1000
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def send(payload):
+            self.wfile.write(f"event: {payload['type']}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                             .encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            send({"type": "message_start", "message": {
+                "id": "msg_bench", "type": "message", "role": "assistant", "content": [],
+                "model": body.get("model", "fake"), "stop_reason": None, "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 1}
+            }})
+            send({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+            for token in tokens:
+                send({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token}})
+                time.sleep(token_latency)
+            send({"type": "content_block_stop", "index": 0})
+            send({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                  "usage": {"output_tokens": len(tokens)}})
+            send({"type": "message_stop"})
+        except (BrokenPipeError, ConnectionResetError):
+            state.count("client_disconnects")
+        self.close_connection = True
+
+
+# =============================================================================
+# CENÁRIOS
+# =============================================================================
+
+PIPELINE_BODY = {"ramo": "dentista", "localizacao": "Curitiba", "oferta": "clareamento dental",
+                 "cliente": "Clínica Benchmark", "nicho": "adultos"}
+ASSETS_BODY = {"localizacao": "Curitiba", "ramo": "dentista",
+               "keywords": ["dentista curitiba", "clareamento dental preço"]}
+
+
+def agency_batch(i, nonce):
+    """Batch de uma agência: 10 registros sem cache (ocupa a IA enquanto as interativas são medidas)."""
+    return {"records": [{**PIPELINE_BODY, "ramo": f"dentista {nonce} {i} {n}", "cliente": "Agência Batch",
+                         "cache": "bypass"} for n in range(10)]}
+
+
+@dataclass
+class Scenario:
+    description: str
+    endpoint: str
+    # body(i, nonce) -> JSON da requisição i
+    body: object
+    # Requisições de aquecimento (cache quente) antes da medição
+    warmup: int = 0
+    autocomplete: dict = field(default_factory=dict)
+    openai: dict = field(default_factory=dict)
+    anthropic: dict = field(default_factory=dict)
+    stream: bool = False
+    # Variáveis de ambiente do app neste cenário (somadas às de --env)
+    env: dict = field(default_factory=dict)
+    # Carga de fundo durante a medição: (endpoint, body(i, nonce), requisições simultâneas)
+    background: tuple | None = None
+
+
+SCENARIOS = {
+    "hunt_cold": Scenario(
+        "Data Hunter com cache frio (ramo novo a cada requisição)",
+        "/hunt_keywords", lambda i, nonce: {"ramo": f"dentista {nonce} {i}"}),
+    "hunt_warm": Scenario(
+        "Data Hunter com cache quente (mesmo ramo)",
+        "/hunt_keywords", lambda i, nonce: {"ramo": f"dentista {nonce}"}, warmup=1),
+    "pipeline_cold": Scenario(
+        "Pipeline completo sem cache",
+        "/full_pipeline", lambda i, nonce: {**PIPELINE_BODY, "ramo": f"dentista {nonce} {i}", "cache": "bypass"}),
+    "pipeline_warm": Scenario(
+        "Pipeline completo com cache quente (cache=prefer)",
+        "/full_pipeline", lambda i, nonce: {**PIPELINE_BODY, "ramo": f"dentista {nonce}", "cache": "prefer"},
+        warmup=1),
+    "pipeline_assets": Scenario(
+        "Pipeline completo com ativos RSA em paralelo",
+        "/full_pipeline",
+        lambda i, nonce: {**PIPELINE_BODY, "ramo": f"dentista {nonce} {i}", "cache": "bypass", "assets": True}),
+    "pipeline_stream": Scenario(
+        "Pipeline completo via SSE (lê o stream até o fim)",
+        "/full_pipeline/stream", lambda i, nonce: {**PIPELINE_BODY, "ramo": f"dentista {nonce} {i}"}, stream=True),
+    "fallback_heavy": Scenario(
+        "Autocomplete sempre vazio: cascata cai até a IA",
+        "/full_pipeline", lambda i, nonce: {**PIPELINE_BODY, "ramo": f"dentista {nonce} {i}", "cache": "bypass"},
+        autocomplete={"empty_rate": 1.0}),
+    "throttled": Scenario(
+        "Google instável: 20% de 429 e 5% de 500",
+        "/hunt_keywords", lambda i, nonce: {"ramo": f"dentista {nonce} {i}"},
+        autocomplete={"throttle_rate": 0.2, "error_rate": 0.05}),
+    "assets": Scenario(
+        "Geração de ativos RSA",
+        "/generate_assets",
+        lambda i, nonce: {**ASSETS_BODY, "oferta": f"clareamento {nonce} {i}"}),
+    "llm_slow_tail": Scenario(
+        "Ativos RSA com 10% das respostas da OpenAI lentas (5s até o primeiro token)",
+        "/generate_assets", lambda i, nonce: {**ASSETS_BODY, "oferta": f"clareamento {nonce} {i}"},
+        openai={"slow_rate": 0.1, "slow_ms": 5000}),
+    "llm_hedged": Scenario(
+        "Mesma cauda lenta, com hedge para a Anthropic após o p95 do primeiro token",
+        "/generate_assets", lambda i, nonce: {**ASSETS_BODY, "oferta": f"clareamento {nonce} {i}"},
+        openai={"slow_rate": 0.1, "slow_ms": 5000},
+        env={"LLM_ROUTE": "openai:gpt-4o-mini|anthropic:claude-benchmark", "LLM_HEDGE_ENABLED": "true",
+             "LLM_HEDGE_DELAY": "1", "LLM_HEDGE_MIN_SAMPLES": "10"}),
+    "mixed_load": Scenario(
+        "Ativos RSA interativos enquanto uma agência roda batches (fila justa, 4 vagas de IA)",
+        "/generate_assets",
+        lambda i, nonce: {**ASSETS_BODY, "oferta": f"clareamento {nonce} {i}", "cliente": "Loja Interativa"},
+        env={"LLM_MAX_CONCURRENCY": "4"}, background=("/batch_pipeline", agency_batch, 2)),
+    "mixed_load_unreserved": Scenario(
+        "Mesma carga mista, sem vagas reservadas às interativas (LLM_BATCH_MAX_SHARE=1)",
+        "/generate_assets",
+        lambda i, nonce: {**ASSETS_BODY, "oferta": f"clareamento {nonce} {i}", "cliente": "Loja Interativa"},
+        env={"LLM_MAX_CONCURRENCY": "4", "LLM_BATCH_MAX_SHARE": "1"}, background=("/batch_pipeline", agency_batch, 2)),
+}
+
+
+# =============================================================================
+# EXECUÇÃO
+# =============================================================================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class AppServer:
+    """Sobe o app (gunicorn) apontando para os servidores falsos, com cache isolado."""
+
+    def __init__(self, autocomplete_port: int, openai_port: int, anthropic_port: int, workers: int,
+                 extra_env: dict, verbose: bool = False):
+        self.port = free_port()
+        self.cache_dir = tempfile.mkdtemp(prefix="bench-cache-")
+        env = {
+            **os.environ,
+            "AUTOCOMPLETE_URL": f"http://127.0.0.1:{autocomplete_port}/complete/search",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+            "OPENAI_API_KEY": "benchmark",
+            # O SDK da Anthropic acrescenta /v1/messages à URL base
+            "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{anthropic_port}",
+            "ANTHROPIC_API_KEY": "benchmark",
+            "CACHE_DIR": self.cache_dir,
+            "TRACE_LOG": "false",
+            **extra_env
+        }
+        command = [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{self.port}",
+                   "--workers", str(workers), "--timeout", "120", "--log-level", "warning"]
+        # Sem --verbose, os logs do app não se misturam ao relatório
+        output = None if verbose else subprocess.DEVNULL
+        self.process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                        stdout=output, stderr=output)
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._wait_ready()
+
+    def _wait_ready(self, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("O app encerrou durante a inicialização")
+            try:
+                if httpx.get(f"{self.url}/health", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("O app não respondeu ao /health a tempo")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def send_request(http: httpx.Client, url: str, body: dict, stream: bool) -> tuple:
+    """Executa uma requisição e retorna (status, latência em ms). Streams são lidos até o fim."""
+    started = time.perf_counter()
+    try:
+        if stream:
+            with http.stream("POST", url, json=body) as response:
+                for _ in response.iter_bytes():
+                    pass
+                status = response.status_code
+        else:
+            status = http.post(url, json=body).status_code
+    except httpx.HTTPError:
+        status = 0
+    return status, (time.perf_counter() - started) * 1000
+
+
+def start_background(app_url: str, scenario: Scenario, nonce: str, stop: threading.Event) -> list:
+    """Dispara a carga de fundo do cenário em loop até `stop`. Retorna as threads."""
+    endpoint, body, concurrency = scenario.background
+
+    def loop(worker: int):
+        with httpx.Client(timeout=300) as http:
+            i = 0
+            while not stop.is_set():
+                send_request(http, f"{app_url}{endpoint}", body(f"{worker}-{i}", nonce), stream=True)
+                i += 1
+
+    threads = [threading.Thread(target=loop, args=(worker,), daemon=True) for worker in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    # Deixa a carga de fundo ocupar a IA antes da medição
+    time.sleep(1)
+    return threads
+
+
+def run_level(app_url: str, scenario: Scenario, concurrency: int, requests: int,
+              fakes: dict, nonce: str) -> dict:
+    """Dispara `requests` requisições com `concurrency` simultâneas e resume o resultado."""
+    url = f"{app_url}{scenario.endpoint}"
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    with httpx.Client(timeout=300, limits=limits) as http:
+        for i in range(scenario.warmup):
+            send_request(http, url, scenario.body(i, nonce), scenario.stream)
+
+        stop = threading.Event()
+        background = start_background(app_url, scenario, nonce, stop) if scenario.background else []
+        before = {name: server.snapshot() for name, server in fakes.items()}
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(
+                lambda i: send_request(http, url, scenario.body(i, nonce), scenario.stream), range(requests)
+            ))
+        elapsed = time.perf_counter() - started
+        after = {name: server.snapshot() for name, server in fakes.items()}
+        stop.set()
+        for thread in background:
+            thread.join()
+
+    latencies = [latency for status, latency in results if 200 <= status < 300]
+    outbound = {
+        name: {counter: value - before[name].get(counter, 0) for counter, value in after[name].items()
+               if value - before[name].get(counter, 0)}
+        for name in fakes
+    }
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": sum(1 for status, _ in results if not 200 <= status < 300),
+        "rps": round(requests / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "outbound": outbound,
+        "outbound_per_request": {
+            name: round(counters.get("requests", 0) / requests, 2) for name, counters in outbound.items()
+        }
+    }
+
+
+def run_benchmark(args) -> dict:
+    autocomplete = FakeServer(AutocompleteHandler)
+    openai = FakeServer(OpenAIHandler)
+    anthropic = FakeServer(AnthropicHandler)
+    fakes = {"autocomplete": autocomplete, "openai": openai, "anthropic": anthropic}
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    report = {"started_at": time.strftime("%Y-%m-%d %H:%M:%S"), "config": vars(args), "scenarios": {}}
+
+    try:
+        for name in args.scenarios:
+            scenario = SCENARIOS[name]
+            autocomplete.config = {"latency_ms": args.autocomplete_latency, **scenario.autocomplete}
+            openai.config = {"ttft_ms": args.openai_ttft, "token_latency_ms": args.openai_token_latency,
+                             **scenario.openai}
+            anthropic.config = {"ttft_ms": args.anthropic_ttft, "token_latency_ms": args.openai_token_latency,
+                                **scenario.anthropic}
+
+            # App novo por cenário: cache, rate limiter e circuit breaker zerados
+            app_server = AppServer(autocomplete.port, openai.port, anthropic.port, args.workers,
+                                   {**scenario.env, **extra_env}, args.verbose)
+            levels = []
+            try:
+                print(f"\n▶ {name}: {scenario.description}")
+                for concurrency in args.concurrency:
+                    level = run_level(app_server.url, scenario, concurrency, args.requests, fakes,
+                                      nonce=uuid.uuid4().hex[:6])
+                    levels.append(level)
+                    print(f"   c={concurrency:<3} p50={level['p50_ms']:>8.1f}ms  p95={level['p95_ms']:>8.1f}ms  "
+                          f"p99={level['p99_ms']:>8.1f}ms  {level['rps']:>7.2f} req/s  erros={level['errors']}  "
+                          f"externas/req={level['outbound_per_request']}")
+            finally:
+                app_server.stop()
+            report["scenarios"][name] = levels
+    finally:
+        autocomplete.shutdown()
+        openai.shutdown()
+        anthropic.shutdown()
+
+    return report
+
+
+def compare_with_baseline(report: dict, baseline: dict):
+    """Imprime a variação de p50/p95/req/s em relação a um relatório anterior."""
+    print("\n" + "=" * 60)
+    print("📊 Comparação com o baseline")
+    print("=" * 60)
+    for name, levels in report["scenarios"].items():
+        base_levels = {level["concurrency"]: level for level in baseline.get("scenarios", {}).get(name, [])}
+        for level in levels:
+            base = base_levels.get(level["concurrency"])
+            if not base:
+                continue
+
+            def delta(metric):
+                if not base[metric]:
+                    return "   n/a"
+                return f"{(level[metric] - base[metric]) / base[metric] * 100:+6.1f}%"
+
+            print(f"   {name:<16} c={level['concurrency']:<3} p50 {delta('p50_ms')}  p95 {delta('p95_ms')}  "
+                  f"req/s {delta('rps')}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline do Gerador de Anúncios")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Cenários separados por vírgula ({', '.join(SCENARIOS)})")
+    parser.add_argument("--concurrency", default="1,4,16", help="Níveis de concorrência (ex: 1,4,16)")
+    parser.add_argument("--requests", type=int, default=20, help="Requisições por nível de concorrência")
+    parser.add_argument("--workers", type=int, default=2, help="Workers do gunicorn")
+    parser.add_argument("--autocomplete-latency", type=float, default=40, help="Latência média do autocomplete (ms)")
+    parser.add_argument("--openai-ttft", type=float, default=300, help="Tempo até o primeiro token (ms)")
+    parser.add_argument("--openai-token-latency", type=float, default=2, help="Latência por token (ms)")
+    parser.add_argument("--anthropic-ttft", type=float, default=300,
+                        help="Tempo até o primeiro token da Anthropic (ms)")
+    parser.add_argument("--env", action="append", default=[], help="Variável extra para o app (CHAVE=VALOR)")
+    parser.add_argument("--verbose", action="store_true", help="Mostra os logs do app")
+    parser.add_argument("--output", help="Grava o relatório em JSON")
+    parser.add_argument("--baseline", help="Relatório JSON anterior para comparação")
+    args = parser.parse_args(argv)
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Cenários desconhecidos: {', '.join(unknown)}")
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmark(args)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Relatório gravado em {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare_with_baseline(report, json.load(f))
@@ -0,0 +1,48 @@
+# =============================================================================
+# GUNICORN - Perfil de Alta Concorrência
+# =============================================================================
+# O app passa quase todo o tempo esperando I/O (Google Autocomplete e OpenAI).
+# Com workers "sync", cada requisição lenta prende um processo inteiro; com
+# "gthread", cada worker atende várias requisições em threads.
+#
+# Uso: gunicorn -c gunicorn.conf.py app:app
+# Todos os valores podem ser ajustados por variáveis de ambiente (ver .env.example).
+
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Processos x threads: WEB_CONCURRENCY workers, cada um com GUNICORN_THREADS threads
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", str(min(4, multiprocessing.cpu_count()))))
+threads = int(os.getenv("GUNICORN_THREADS", "64"))
+
+# Conexões simultâneas aceitas por worker (inclui keep-alive ociosas)
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+backlog = int(os.getenv("GUNICORN_BACKLOG", "2048"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# Com gthread, o timeout vale para o worker travado (sem heartbeat), não para a
+# requisição: pipelines longos e streams SSE não são mais derrubados aos 30s
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+# Tempo para terminar as requisições em andamento ao reiniciar/desligar
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "60"))
+
+# Recicla workers periodicamente (evita crescimento de memória)
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "200"))
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-") or None
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# O limite de requisições pesadas por worker (503 + Retry-After quando saturado)
+# acompanha o número de threads, reservando algumas para /health, /metrics e /jobs
+os.environ.setdefault("SERVER_MAX_IN_FLIGHT", str(max(1, threads - 4)))
+
+
+def post_worker_init(worker):
+    # Cada worker renova os leases dos seus jobs e retoma os que ficaram órfãos
+    # quando outro worker foi reciclado (max_requests) ou reiniciado (deploy)
+    from app import ensure_jobs_heartbeat
+    ensure_jobs_heartbeat()
@@ -0,0 +1,15 @@
+"""
+Configuração dos testes - Gerador de Anúncios
+O app lê a configuração do ambiente na importação: os bancos SQLite vão para um
+diretório temporário e nenhum teste chama o Google ou a IA de verdade.
+"""
+
+import os
+import sys
+import tempfile
+
+os.environ["CACHE_DIR"] = tempfile.mkdtemp(prefix="gerador-testes-")
+os.environ["TRACE_LOG"] = "false"
+os.environ["LOCATION_FILTER_ENABLED"] = "true"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
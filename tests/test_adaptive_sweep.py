@@ -0,0 +1,49 @@
+import app
+from app import ProbeFrontier, run_adaptive_sweep
+
+
+def test_base_query_first_then_common_letters():
+    frontier = ProbeFrontier("dentista", "Curitiba")
+    assert frontier.next_query() == "dentista em Curitiba"
+    assert frontier.next_query() == "dentista em Curitiba c"
+    assert frontier.next_query() == "dentista em Curitiba p"
+
+
+def test_productive_letter_is_expanded_with_two_letters_and_seeds(monkeypatch):
+    monkeypatch.setattr(app, "SCRAPER_EXPAND_FANOUT", 4)
+    frontier = ProbeFrontier("dentista")
+    frontier.next_query()
+    query = frontier.next_query()
+    assert query == "dentista c"
+    suggestions = ["dentista centro", "dentista clareamento", "dentista canal", "dentista criança"]
+    assert frontier.record(query, suggestions) == suggestions
+    # Duas letras (as mais frequentes nas sugestões) disputam com as letras restantes
+    children = {q: kind for q, (_, kind, depth) in frontier._frontier.items() if depth == 2}
+    assert children == {"dentista ce": "two_letter", "dentista cl": "two_letter",
+                        "dentista centro": "suggestion", "dentista clareamento": "suggestion"}
+
+
+def test_low_yield_kind_loses_priority():
+    frontier = ProbeFrontier("dentista")
+    frontier.next_query()
+    query = frontier.next_query()
+    assert frontier._probes[query][1] == "letter"
+    frontier.record(query, [])
+    # A estimativa das letras é recalibrada pelo rendimento real: as variações passam na frente
+    assert frontier._probes[frontier.next_query()][1] == "variation"
+
+
+def test_sweep_stops_on_saturation(monkeypatch):
+    monkeypatch.setattr(app, "SCRAPER_SATURATION_WINDOW", 5)
+    monkeypatch.setattr(app, "SCRAPER_SATURATION_MIN_NEW", 3)
+    monkeypatch.setattr(app, "get_google_autocomplete", lambda query: ["dentista curitiba"])
+    results, stop = run_adaptive_sweep("dentista", budget=40, max_in_flight=1, deadline=5)
+    assert stop == "saturation"
+    assert len(results) == 5
+
+
+def test_sweep_respects_the_probe_budget(monkeypatch):
+    monkeypatch.setattr(app, "get_google_autocomplete", lambda query: [f"{query} {i}" for i in range(3)])
+    results, stop = run_adaptive_sweep("dentista", budget=7, max_in_flight=2, deadline=5)
+    assert stop == "budget"
+    assert len(results) == 7
@@ -0,0 +1,45 @@
+import pytest
+
+import app
+from app import AdmissionControl
+
+DRAFT_ASSETS = {"oferta": "Implante", "localizacao": "Curitiba", "ramo": "dentista", "draft": True}
+
+
+@pytest.fixture
+def admission(monkeypatch):
+    admission = AdmissionControl(1)
+    monkeypatch.setattr(app, "admission", admission)
+    return admission
+
+
+def test_saturated_worker_answers_503_with_retry_after(admission):
+    client = app.app.test_client()
+    assert admission.try_acquire()
+    response = client.post("/generate_assets", json=DRAFT_ASSETS)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(app.SERVER_RETRY_AFTER)
+    assert admission.stats() == {"limit": 1, "in_flight": 1, "rejected": 1}
+    # Rotas leves não passam pela admissão
+    assert client.get("/health").status_code == 200
+
+
+def test_slot_is_released_when_the_response_closes(admission):
+    client = app.app.test_client()
+    response = client.post("/generate_assets", json=DRAFT_ASSETS)
+    assert response.status_code == 200
+    response.close()
+    assert admission.stats()["in_flight"] == 0
+    assert client.post("/generate_assets", json=DRAFT_ASSETS).status_code == 200
+
+
+def test_slot_is_released_when_the_handler_fails(admission, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("bug")
+
+    monkeypatch.setattr(app, "draft_responsive_assets", broken)
+    client = app.app.test_client()
+    response = client.post("/generate_assets", json=DRAFT_ASSETS)
+    assert response.status_code == 500
+    response.close()
+    assert admission.stats()["in_flight"] == 0
@@ -0,0 +1,30 @@
+import asyncio
+import threading
+
+import pytest
+
+import app
+
+
+def test_failed_ads_stream_cancels_the_assets_generation(monkeypatch):
+    cancelled = threading.Event()
+
+    async def slow_assets(*args, **kwargs):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    def failing_ads(*args, **kwargs):
+        yield {"titulo": "primeiro"}
+        raise ValueError("Erro ao processar resposta da IA")
+
+    monkeypatch.setattr(app, "find_keywords_with_fallback",
+                        lambda *args, **kwargs: (["dentista curitiba"], None, {}))
+    monkeypatch.setattr(app, "generate_responsive_assets_async", slow_assets)
+    monkeypatch.setattr(app, "stream_analyze_and_model_ads", failing_ads)
+    with pytest.raises(ValueError):
+        app._run_pipeline_stages("dentista", "Curitiba", "implante", "Clínica", "adultos", "bypass",
+                                 lambda event, payload: None, None, None, True)
+    assert cancelled.wait(1)
@@ -0,0 +1,65 @@
+import pytest
+
+import app
+from app import (RSA_DESCRIPTION_MAX, RSA_TITLE_COUNT, RSA_TITLE_MAX, clean_asset, generate_responsive_assets,
+                 normalize_keyword, repair_assets, shorten_at_word_boundary)
+
+KEYWORDS = ["dentista em curitiba"]
+
+
+def covered(titles: list, terms: str) -> int:
+    return sum(1 for title in titles if f" {terms} " in f" {normalize_keyword(title)} ")
+
+
+@pytest.mark.parametrize("text, limit, expected", [
+    ("Implante Dentário com Garantia", 30, "Implante Dentário com Garantia"),
+    ("Implante Dentário em Curitiba Hoje", 30, "Implante Dentário em Curitiba"),
+    ("Clareamento Dental para", 20, "Clareamento Dental"),
+    ("Supercalifragilisticoexpialidoso", 30, ""),
+])
+def test_shorten_at_word_boundary(text, limit, expected):
+    assert shorten_at_word_boundary(text, limit) == expected
+
+
+def test_clean_asset_removes_exclamation_from_titles_only():
+    assert clean_asset("Agende Já!!", RSA_TITLE_MAX, is_title=True) == "Agende Já"
+    assert clean_asset("Agende Já!!", RSA_DESCRIPTION_MAX, is_title=False) == "Agende Já!"
+    assert clean_asset(None, RSA_TITLE_MAX, is_title=True) == ""
+
+
+def test_repair_dedupes_and_fills_coverage_with_local_templates():
+    assets, pending = repair_assets({
+        "titulos": ["Sorriso Novo", "sorriso novo", "Sorríso Novo!", "Agende Sua Avaliação"],
+        "descricoes": ["Atendimento humanizado e sem dor. Agende sua avaliação hoje mesmo."],
+    }, KEYWORDS, "Curitiba", "dentista")
+    titles = assets["titulos"]
+    assert titles[:2] == ["Sorriso Novo", "Agende Sua Avaliação"]
+    assert assets["validacao"]["descartados"] == 2
+    assert assets["validacao"]["gerados_localmente"] > 0
+    assert covered(titles, "curitiba") >= app.RSA_MIN_LOCATION_TITLES
+    assert pending["titulos"] == RSA_TITLE_COUNT - len(titles)
+    assert pending["descricoes"] == 3
+    assert len(assets["fixacao"]["titulo_1"]) >= 2
+
+
+def test_llm_repair_round_only_asks_for_missing_assets(monkeypatch):
+    prompts = []
+    first = {"titulos": ["Dentista em Curitiba"], "descricoes": ["Consulta com hora marcada e atendimento humanizado."]}
+    repair = {
+        "titulos": [f"Dentista Opção {i}" for i in range(20)],
+        "descricoes": [f"Descrição completa número {i} com atendimento perto de você." for i in range(5)],
+    }
+
+    def fake_llm(system_prompt, user_prompt, max_tokens, temperature, output, cache_mode="bypass"):
+        prompts.append(user_prompt)
+        return first if len(prompts) == 1 else repair
+
+    monkeypatch.setattr(app, "request_llm_json", fake_llm)
+    monkeypatch.setattr(app, "RSA_REPAIR_ROUNDS", 1)
+    assets = generate_responsive_assets("Implante", "Curitiba", "dentista", KEYWORDS)
+    assert len(prompts) == 2
+    assert "ATIVOS JÁ APROVADOS" in prompts[1] and "- Dentista em Curitiba" in prompts[1]
+    assert len(assets["titulos"]) == RSA_TITLE_COUNT
+    assert len(assets["descricoes"]) == 4
+    assert assets["validacao"]["rodadas_reparo"] == 1
+    assert assets["validacao"]["pendentes"]["titulos"] == 0
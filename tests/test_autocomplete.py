@@ -0,0 +1,75 @@
+import httpx
+import pytest
+
+import app
+from app import SharedCircuitBreaker, SharedTokenBucket
+
+
+def respond(status: int, body: bytes = b'["q", ["dentista curitiba"]]'):
+    def get(url, **kwargs):
+        return httpx.Response(status, content=body, request=httpx.Request("GET", url))
+    return get
+
+
+@pytest.fixture
+def breaker(monkeypatch, request):
+    breaker = SharedCircuitBreaker(f"teste_{request.node.name}", threshold=2, cooldown=60)
+    monkeypatch.setattr(app, "scraper_breaker", breaker)
+    monkeypatch.setattr(app, "scraper_rate_limiter", SharedTokenBucket("teste", 0, 1))
+    monkeypatch.setattr(app, "SCRAPER_MAX_RETRIES", 0)
+    return breaker
+
+
+@pytest.mark.parametrize("status, body", [(404, b""), (200, b"<html>")])
+def test_invalid_response_is_negative_cached_without_opening_the_breaker(monkeypatch, breaker, status, body):
+    query = f"invalida {status}"
+    monkeypatch.setattr(app.http_pool, "get", respond(status, body))
+    assert app.get_google_autocomplete(query) == []
+    assert breaker.stats()["consecutive_failures"] == 0
+    assert app.autocomplete_cache.get(query) == (True, [])
+
+
+def test_programming_errors_propagate_and_are_not_cached(monkeypatch, breaker):
+    def broken(url, **kwargs):
+        raise KeyError("bug")
+
+    monkeypatch.setattr(app.http_pool, "get", broken)
+    with pytest.raises(KeyError):
+        app.get_google_autocomplete("bug no scraper")
+    assert breaker.stats()["consecutive_failures"] == 0
+    assert app.autocomplete_cache.get("bug no scraper") == (False, None)
+
+
+def test_throttling_opens_the_breaker_and_is_not_cached(monkeypatch, breaker):
+    calls = []
+
+    def throttled(url, **kwargs):
+        calls.append(url)
+        return respond(429)(url, **kwargs)
+
+    monkeypatch.setattr(app.http_pool, "get", throttled)
+    assert app.get_google_autocomplete("bloqueio 1") == []
+    assert app.get_google_autocomplete("bloqueio 2") == []
+    assert breaker.stats()["state"] == "open"
+    assert app.get_google_autocomplete("bloqueio 3") == []
+    assert len(calls) == 2
+    assert app.autocomplete_cache.get("bloqueio 1") == (False, None)
+
+
+def test_retries_with_backoff_and_success_resets_the_breaker(monkeypatch, breaker):
+    responses = [respond(503), respond(200)]
+    delays = []
+    monkeypatch.setattr(app, "SCRAPER_MAX_RETRIES", 1)
+    monkeypatch.setattr(app.http_pool, "get", lambda url, **kwargs: responses.pop(0)(url, **kwargs))
+    monkeypatch.setattr(app, "backoff_delay", lambda attempt, retry_after=None: delays.append(attempt) or 0)
+    assert app.get_google_autocomplete("instavel") == ["dentista curitiba"]
+    assert delays == [0]
+    assert breaker.stats()["consecutive_failures"] == 0
+
+
+def test_backoff_is_capped_and_honours_retry_after(monkeypatch):
+    monkeypatch.setattr(app, "SCRAPER_BACKOFF_BASE", 0.5)
+    monkeypatch.setattr(app, "SCRAPER_BACKOFF_MAX", 4)
+    assert all(0 <= app.backoff_delay(attempt) <= min(4, 0.5 * 2 ** attempt) for attempt in range(6))
+    assert app.backoff_delay(0, retry_after=2) == 2
+    assert app.backoff_delay(0, retry_after=30) == 4
@@ -0,0 +1,129 @@
+import time
+
+import pytest
+
+import app
+from app import (AD_GROUPS_OUTPUT, Deadline, DeadlineExceeded, _llm_call_budget, deadline_expired,
+                 deadline_remaining, deadline_scope, parse_deadline, record_cut)
+
+
+def test_deadline_expires():
+    deadline = Deadline(0.05)
+    assert not deadline.expired()
+    time.sleep(0.06)
+    assert deadline.expired()
+    assert deadline.remaining() == 0
+
+
+def test_sub_deadline_ends_first_and_reports_to_the_root():
+    deadline = Deadline(1)
+    keywords = deadline.within(0.1)
+    assert keywords.remaining() <= 0.1
+    with deadline_scope(keywords):
+        time.sleep(0.11)
+        assert deadline_expired()
+        record_cut("autocomplete_sweep", "partial", probes=3)
+    assert not deadline.expired()
+    assert deadline.report()["cut_short"] == [{"stage": "autocomplete_sweep", "action": "partial", "probes": 3}]
+
+
+def test_deadline_remaining_is_capped_by_the_scope():
+    assert deadline_remaining(5) == 5
+    assert deadline_remaining() is None
+    with deadline_scope(Deadline(1)):
+        assert deadline_remaining(5) <= 1
+        assert deadline_remaining(0.5) == 0.5
+    assert not deadline_expired()
+
+
+def test_llm_call_is_skipped_without_time_left():
+    with deadline_scope(Deadline(0.5)) as deadline:
+        with pytest.raises(DeadlineExceeded):
+            _llm_call_budget(AD_GROUPS_OUTPUT)
+    assert deadline.cuts == [{"stage": f"llm.{AD_GROUPS_OUTPUT.name}", "action": "skipped"}]
+
+
+@pytest.mark.parametrize("value, expected", [(None, (None, None)), ("", (None, None)), ("2.5", (2.5, None))])
+def test_parse_deadline(value, expected):
+    assert parse_deadline(value) == expected
+
+
+@pytest.mark.parametrize("value", [0, -1, "abc", app.PIPELINE_DEADLINE_MAX + 1])
+def test_parse_deadline_rejects_out_of_range(value):
+    seconds, error = parse_deadline(value)
+    assert seconds is None and "deadline" in error
+
+
+WINNING_ADS = {"keywords": ["dentista curitiba"], "oferta": "Implante", "cliente": "Clínica", "nicho": "dentista"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, "llm_configured", lambda: True)
+    return app.app.test_client()
+
+
+def test_winning_ads_runs_within_the_request_deadline(client, monkeypatch):
+    seen = {}
+
+    def fake_ads(*args, **kwargs):
+        seen["remaining"] = deadline_remaining()
+        return []
+
+    monkeypatch.setattr(app, "analyze_and_model_ads", fake_ads)
+    response = client.post("/generate_winning_ads", json={**WINNING_ADS, "deadline": 3})
+    assert response.status_code == 200
+    assert 0 < seen["remaining"] <= 3
+    assert response.get_json()["deadline"]["budget_s"] == 3
+
+
+def test_winning_ads_answers_504_when_the_deadline_expires(client, monkeypatch):
+    def slow_ads(*args, **kwargs):
+        while not deadline_expired():
+            time.sleep(0.01)
+        record_cut(f"llm.{AD_GROUPS_OUTPUT.name}", "timeout", items=0)
+        raise DeadlineExceeded("A IA não concluiu nenhum item dentro do prazo da requisição")
+
+    monkeypatch.setattr(app, "analyze_and_model_ads", slow_ads)
+    response = client.post("/generate_winning_ads", json={**WINNING_ADS, "deadline": 0.1})
+    body = response.get_json()
+    assert response.status_code == 504
+    assert body["deadline"]["cut_short"][0]["action"] == "timeout"
+
+
+def test_assets_fall_back_to_the_draft_when_the_deadline_expires(client, monkeypatch):
+    def slow_assets(*args, **kwargs):
+        while not deadline_expired():
+            time.sleep(0.01)
+        raise DeadlineExceeded("Sem tempo para chamar a IA")
+
+    monkeypatch.setattr(app, "generate_responsive_assets", slow_assets)
+    monkeypatch.setattr(app, "ASSETS_DRAFT_FALLBACK", True)
+    response = client.post("/generate_assets", json={
+        "oferta": "Implante", "localizacao": "Curitiba", "ramo": "dentista", "deadline": 0.1
+    })
+    data = response.get_json()["data"]
+    assert response.status_code == 200
+    assert data["fallback_used"] == "rascunho_local"
+    assert data["deadline"]["budget_s"] == 0.1
+
+
+def test_speculative_cascade_waits_without_spinning_after_the_deadline(monkeypatch):
+    calls = []
+    real_wait = app.wait
+
+    def counting_wait(*args, **kwargs):
+        calls.append(kwargs.get("timeout"))
+        return real_wait(*args, **kwargs)
+
+    def slow_stage(cancel_event):
+        time.sleep(0.3)
+        return ["dentista curitiba"]
+
+    monkeypatch.setattr(app, "wait", counting_wait)
+    runners = {stage: slow_stage for stage in app.CASCADE_STAGES}
+    with deadline_scope(Deadline(0.05)):
+        keywords, winner, report = app._run_cascade_speculative(runners, lambda event, payload: None, 10)
+    assert winner == app.CASCADE_STAGES[0]
+    assert report[app.CASCADE_STAGES[1]]["status"] == "skipped"
+    assert len(calls) < 5
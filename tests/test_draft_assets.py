@@ -0,0 +1,44 @@
+import pytest
+
+from app import (RSA_DESCRIPTION_COUNT, RSA_DESCRIPTION_MAX, RSA_MIN_KEYWORD_TITLES, RSA_MIN_LOCATION_TITLES,
+                 RSA_TITLE_COUNT, RSA_TITLE_MAX, draft_responsive_assets, normalize_keyword, title_case)
+
+CASES = [
+    ("Implante Dentário", "Curitiba", "dentista", ["dentista em curitiba", "implante dentário curitiba"]),
+    ("Instalação de Ar-Condicionado Split", "São José dos Campos", "refrigeração", []),
+    ("Reforma Completa de Apartamentos e Casas de Alto Padrão", "Santana de Parnaíba", "arquitetura e interiores",
+     ["arquiteto de interiores em santana de parnaíba com projeto 3d"]),
+]
+
+
+def covered(titles: list, terms: str) -> int:
+    return sum(1 for title in titles if f" {normalize_keyword(terms)} " in f" {normalize_keyword(title)} ")
+
+
+@pytest.mark.parametrize("oferta, localizacao, ramo, keywords", CASES)
+def test_draft_respects_google_limits(oferta, localizacao, ramo, keywords):
+    assets = draft_responsive_assets(oferta, localizacao, ramo, keywords)
+    assert all(0 < len(title) <= RSA_TITLE_MAX for title in assets["titulos"])
+    assert all(0 < len(text) <= RSA_DESCRIPTION_MAX for text in assets["descricoes"])
+    assert len(assets["descricoes"]) == RSA_DESCRIPTION_COUNT
+    assert len({normalize_keyword(t) for t in assets["titulos"]}) == len(assets["titulos"])
+    assert assets["validacao"]["origem"] == "rascunho_local"
+    # Modelos longos demais são ignorados, nunca cortados
+    assert assets["validacao"]["encurtados"] == 0
+
+
+def test_short_inputs_fill_every_slot_with_full_coverage():
+    assets = draft_responsive_assets(*CASES[0])
+    assert len(assets["titulos"]) == RSA_TITLE_COUNT
+    assert covered(assets["titulos"], "dentista") >= RSA_MIN_KEYWORD_TITLES
+    assert covered(assets["titulos"], "Curitiba") >= RSA_MIN_LOCATION_TITLES
+    assert assets["validacao"]["pendentes"]["titulos"] == 0
+
+
+def test_draft_is_deterministic():
+    assert draft_responsive_assets(*CASES[1])["titulos"] == draft_responsive_assets(*CASES[1])["titulos"]
+
+
+def test_title_case_keeps_connectives_and_acronyms():
+    assert title_case("dentista em curitiba") == "Dentista em Curitiba"
+    assert title_case("ar-condicionado SP") == "Ar-condicionado SP"
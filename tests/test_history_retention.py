@@ -0,0 +1,56 @@
+import pytest
+
+import app
+from app import history_db, purge_history, record_history_run
+
+
+@pytest.fixture
+def history():
+    conn = history_db()
+    conn.execute("DELETE FROM history_fts")
+    conn.execute("DELETE FROM history_runs")
+    conn.commit()
+    return conn
+
+
+def record(nicho: str) -> str:
+    return record_history_run("pipeline", "dentista", "Curitiba", "implante", "Clínica", nicho,
+                              {"ok": True}, [f"dentista {nicho}"])
+
+
+def counts(conn) -> tuple:
+    return (conn.execute("SELECT COUNT(*) FROM history_runs").fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM history_fts").fetchone()[0])
+
+
+def test_max_rows_keeps_the_newest_runs(history):
+    ids = [record(f"nicho{i}") for i in range(5)]
+    assert purge_history(max_age=0, max_rows=3) == 2
+    assert counts(history) == (3, 3)
+    kept = {row[0] for row in history.execute("SELECT id FROM history_runs")}
+    assert kept == set(ids[2:])
+
+
+def test_max_age_removes_old_runs_and_their_search_index(history):
+    old = record("antigo")
+    record("recente")
+    history.execute("UPDATE history_runs SET created_at = created_at - 1000 WHERE id = ?", (old,))
+    history.commit()
+    assert purge_history(max_age=500, max_rows=0) == 1
+    assert counts(history) == (1, 1)
+    assert app.search_history("antigo")["total"] == 0
+
+
+def test_zero_limits_keep_everything(history):
+    for i in range(3):
+        record(f"nicho{i}")
+    assert purge_history(max_age=0, max_rows=0) == 0
+    assert counts(history) == (3, 3)
+
+
+def test_recording_purges_periodically(history, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_MAX_ROWS", 2)
+    monkeypatch.setattr(app, "HISTORY_PURGE_INTERVAL", 1)
+    for i in range(4):
+        record(f"nicho{i}")
+    assert counts(history) == (2, 2)
@@ -0,0 +1,71 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from app import Deadline, PooledHTTPClient, deadline_scope
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if "lento" in self.path:
+            time.sleep(0.3)
+        body = b'["q", []]'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_counts_new_and_reused_connections(server_url):
+    pool = PooledHTTPClient(4, 4, 30, max_per_host=1, http2=False)
+    for _ in range(3):
+        pool.get(server_url + "/")
+    stats = pool.stats()
+    assert stats["requests"] == 3
+    assert stats["new_connections"] == 1
+    assert stats["reused_connections"] == 2
+
+
+def test_host_slot_wait_is_bounded_by_the_timeout(server_url):
+    pool = PooledHTTPClient(4, 4, 30, max_per_host=1, http2=False, timeout=5)
+    busy = threading.Thread(target=pool.get, args=(server_url + "/lento",))
+    busy.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    with pytest.raises(httpx.PoolTimeout):
+        pool.get(server_url + "/", timeout=0.1)
+    assert time.monotonic() - started < 0.25
+    busy.join()
+    assert pool.stats()["host_slot_timeouts"] == 1
+
+
+def test_host_slot_wait_is_bounded_by_the_deadline(server_url):
+    pool = PooledHTTPClient(4, 4, 30, max_per_host=1, http2=False, timeout=5)
+    busy = threading.Thread(target=pool.get, args=(server_url + "/lento",))
+    busy.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    with deadline_scope(Deadline(0.1)):
+        with pytest.raises(httpx.PoolTimeout):
+            pool.get(server_url + "/")
+    assert time.monotonic() - started < 0.25
+    busy.join()
+    assert pool.stats()["host_slot_timeouts"] == 1
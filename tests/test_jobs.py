@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+import app
+from app import KEYWORDS_OUTPUT, PipelineCancelled, cancel_scope
+
+ASSETS_JOB = {"oferta": "Implante", "localizacao": "Curitiba", "ramo": "dentista", "keywords": ["dentista curitiba"]}
+
+
+def wait_for_status(job_id: str, statuses: tuple, timeout: float = 5) -> dict:
+    expires_at = time.monotonic() + timeout
+    while time.monotonic() < expires_at:
+        job = app.get_job(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} ficou em {job['status']}")
+
+
+def test_llm_stream_stops_when_the_pipeline_is_cancelled(monkeypatch):
+    cancel_event = threading.Event()
+    chunks = []
+
+    def text_stream(task, prompt, timeout=None):
+        for chunk in ('{"keywords": ["dentista curitiba"', ', "dentista perto de mim"', "]}"):
+            chunks.append(chunk)
+            cancel_event.set()
+            yield chunk
+
+    monkeypatch.setattr(app, "llm_text_stream", text_stream)
+    with cancel_scope(cancel_event), pytest.raises(PipelineCancelled):
+        app.request_llm_json("sistema", "usuario cancelado", 100, 0.5, KEYWORDS_OUTPUT)
+    assert len(chunks) == 1
+
+
+def test_running_assets_job_is_cancelled(monkeypatch):
+    started = threading.Event()
+
+    def slow_assets(*args, **kwargs):
+        started.set()
+        cancel_event = app.current_cancel.get()
+        cancel_event.wait(5)
+        app.check_cancelled(cancel_event)
+        return {"titulos": [], "descricoes": []}
+
+    monkeypatch.setattr(app, "generate_responsive_assets", slow_assets)
+    job_id = app.submit_job("assets", ASSETS_JOB)
+    assert started.wait(5)
+    app.cancel_job(job_id)
+    assert wait_for_status(job_id, ("cancelled", "done", "failed"))["status"] == "cancelled"
+
+
+def test_cancel_requested_by_another_worker_signals_the_running_job(monkeypatch):
+    conn = app.jobs_db()
+    conn.execute("INSERT INTO jobs (id, kind, status, params, created_at, cancel_requested) "
+                 "VALUES ('cancelado-em-outro-worker', 'assets', 'running', '{}', ?, 1)", (time.time(),))
+    conn.commit()
+    cancelled, running = threading.Event(), threading.Event()
+    monkeypatch.setitem(app._job_cancel_events, "cancelado-em-outro-worker", cancelled)
+    monkeypatch.setitem(app._job_cancel_events, "em-execucao", running)
+    app._signal_cancelled_jobs()
+    assert cancelled.is_set()
+    assert not running.is_set()
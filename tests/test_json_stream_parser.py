@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from app import JSONStreamParser
+
+RESPONSE = '```json\n{"titulos": [{"texto": "Implante \\"sem dor\\" {hoje}"}, {"texto": "Clínica, 24h ]"}], ' \
+           '"descricoes": ["a, b", 3, true, null]}\n```'
+
+EXPECTED = [
+    ("titulos", {"texto": 'Implante "sem dor" {hoje}'}),
+    ("titulos", {"texto": "Clínica, 24h ]"}),
+    ("descricoes", "a, b"),
+    ("descricoes", 3),
+    ("descricoes", True),
+    ("descricoes", None),
+]
+
+
+def feed_in_chunks(text: str, size: int) -> tuple:
+    parser = JSONStreamParser()
+    items = []
+    for start in range(0, len(text), size):
+        items.extend(parser.feed(text[start:start + size]))
+    return parser, items
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16, len(RESPONSE)])
+def test_items_survive_any_chunk_boundary(size):
+    parser, items = feed_in_chunks(RESPONSE, size)
+    assert items == EXPECTED
+    assert parser.finished
+    assert parser.malformed == 0
+
+
+def test_chunk_split_inside_escape_sequence():
+    parser = JSONStreamParser()
+    assert parser.feed('[{"t": "a\\') == []
+    assert parser.feed('"b"}, 1') == [(None, {"t": 'a"b'})]
+    assert parser.feed("]") == [(None, 1)]
+
+
+def test_item_is_emitted_as_soon_as_it_closes():
+    parser = JSONStreamParser()
+    assert parser.feed('{"titulos": [{"texto": "um"}') == [("titulos", {"texto": "um"})]
+    assert parser.feed(', {"texto": "do') == []
+    assert parser.feed('is"}') == [("titulos", {"texto": "dois"})]
+
+
+def test_malformed_item_does_not_break_the_rest():
+    parser, items = feed_in_chunks('[{"t": 1}, {"t": tru}, {"t": 3}]', 4)
+    assert items == [(None, {"t": 1}), (None, {"t": 3})]
+    assert parser.malformed == 1
+
+
+def test_text_after_the_root_is_ignored():
+    parser, items = feed_in_chunks('[1, 2] e mais [3]', 3)
+    assert items == [(None, 1), (None, 2)]
+    assert json.loads(parser.buffer[:parser.buffer.index("]") + 1]) == [1, 2]
@@ -0,0 +1,54 @@
+import json
+
+import httpx
+import pytest
+
+import app
+from app import DeadlineExceeded, LLMBudgetExceeded, find_keywords_with_fallback, generate_ai_keywords
+
+
+def failing_llm(error):
+    def request_llm_json(*args, **kwargs):
+        raise error
+    return request_llm_json
+
+
+@pytest.mark.parametrize("error", [
+    json.JSONDecodeError("Expecting value", "", 0),
+    httpx.ConnectError("recusada"),
+    TimeoutError("provedor lento"),
+])
+def test_provider_and_parse_errors_fall_back_to_generic_keywords(monkeypatch, error):
+    monkeypatch.setattr(app, "request_llm_json", failing_llm(error))
+    keywords = generate_ai_keywords("dentista", "Curitiba", "implante", "adultos")
+    assert "dentista em Curitiba" in keywords
+
+
+@pytest.mark.parametrize("error", [
+    DeadlineExceeded("Sem tempo para chamar a IA"),
+    LLMBudgetExceeded("Orçamento esgotado", retry_after=10),
+])
+def test_deadline_and_budget_errors_are_not_masked(monkeypatch, error):
+    monkeypatch.setattr(app, "request_llm_json", failing_llm(error))
+    with pytest.raises(type(error)):
+        generate_ai_keywords("dentista", "Curitiba", "implante", "adultos")
+
+
+@pytest.mark.parametrize("mode", ["sequential", "speculative"])
+def test_cascade_reports_ai_stage_timeout(monkeypatch, mode):
+    monkeypatch.setattr(app, "request_llm_json", failing_llm(DeadlineExceeded("Sem tempo para chamar a IA")))
+    monkeypatch.setattr(app, "CASCADE_HEDGE_DELAY", 0)
+    keywords, fallback_mode, report = find_keywords_with_fallback(
+        "dentista", "Curitiba", "implante", "adultos", scraper=lambda *args, **kwargs: [], cascade_mode=mode)
+    assert report["stages"]["ia_prediction"]["status"] == "timeout"
+    assert fallback_mode == "ia_prediction"
+    assert keywords
+
+
+@pytest.mark.parametrize("mode", ["sequential", "speculative"])
+def test_cascade_propagates_budget_exceeded(monkeypatch, mode):
+    monkeypatch.setattr(app, "request_llm_json", failing_llm(LLMBudgetExceeded("Orçamento esgotado", 10)))
+    monkeypatch.setattr(app, "CASCADE_HEDGE_DELAY", 0)
+    with pytest.raises(LLMBudgetExceeded):
+        find_keywords_with_fallback("dentista", "Curitiba", "implante", "adultos",
+                                    scraper=lambda *args, **kwargs: [], cascade_mode=mode)
@@ -0,0 +1,42 @@
+import pytest
+
+import app
+from app import KeywordCorpus
+
+
+@pytest.fixture
+def corpus(monkeypatch, request):
+    corpus = KeywordCorpus(f"corpus_{request.node.name}")
+    revalidated = []
+    monkeypatch.setattr(corpus, "revalidate", lambda ramo, localizacao="": revalidated.append((ramo, localizacao)))
+    monkeypatch.setattr(app, "keyword_corpus", corpus)
+    corpus.revalidated = revalidated
+    return corpus
+
+
+def no_scrape(*args, **kwargs):
+    raise AssertionError("não deveria varrer de novo")
+
+
+def test_partial_sweep_is_served_and_revalidated_on_first_access(monkeypatch, corpus):
+    monkeypatch.setattr(app, "scrape_autocomplete_az", no_scrape)
+    corpus.put("dentista", "Curitiba", ["dentista curitiba"], {"dentista a": ["dentista curitiba"]}, partial=True)
+
+    assert app.scrape_keywords("dentista", "Curitiba") == ["dentista curitiba"]
+    assert corpus.revalidated == [("dentista", "Curitiba")]
+
+
+def test_partial_sweep_never_replaces_a_complete_one(corpus):
+    corpus.put("dentista", "Curitiba", ["completa"], {})
+    corpus.put("dentista", "Curitiba", ["parcial"], {}, partial=True)
+    entry = corpus.get("dentista", "Curitiba")
+    assert entry["keywords"] == ["completa"]
+    assert entry["status"] == "fresh"
+
+
+def test_complete_sweep_replaces_the_partial_one(corpus):
+    corpus.put("dentista", "Curitiba", ["parcial"], {}, partial=True)
+    corpus.put("dentista", "Curitiba", ["completa"], {})
+    entry = corpus.get("dentista", "Curitiba")
+    assert entry["keywords"] == ["completa"]
+    assert entry["status"] == "fresh"
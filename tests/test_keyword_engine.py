@@ -0,0 +1,50 @@
+import random
+
+from app import _minhash_signature, cluster_keywords, keyword_tokens, normalize_keyword, rank_keywords
+
+
+def test_normalization_ignores_accents_punctuation_stopwords_and_plurals():
+    assert normalize_keyword("  Implante Dentário, Curitiba! ") == "implante dentario curitiba"
+    assert keyword_tokens("implantes dentários em Curitiba") == keyword_tokens("curitiba implante dentario")
+
+
+def test_near_duplicates_share_a_cluster():
+    clusters = cluster_keywords([
+        "implante dentário curitiba",
+        "curitiba implantes dentarios",
+        "implante dentário curitiba preço",
+        "clareamento dental",
+    ], threshold=0.75)
+    assert sorted(map(sorted, clusters)) == [
+        ["clareamento dental"],
+        ["curitiba implantes dentarios", "implante dentário curitiba", "implante dentário curitiba preço"],
+    ]
+
+
+def test_signature_is_deterministic_and_tracks_jaccard():
+    a = frozenset(f"t{i}" for i in range(20))
+    near = frozenset(list(a)[:19] + ["outro"])
+    far = frozenset(f"x{i}" for i in range(20))
+    assert _minhash_signature(a) == _minhash_signature(frozenset(a))
+    same_near = sum(x == y for x, y in zip(_minhash_signature(a), _minhash_signature(near)))
+    same_far = sum(x == y for x, y in zip(_minhash_signature(a), _minhash_signature(far)))
+    assert same_near > same_far
+
+
+def test_clustering_scales_and_keeps_distinct_keywords_apart():
+    rng = random.Random(7)
+    words = [f"palavra{i}" for i in range(400)]
+    keywords = list(dict.fromkeys(" ".join(rng.sample(words, 3)) for _ in range(2000)))
+    clusters = cluster_keywords(keywords, threshold=0.75)
+    assert sum(map(len, clusters)) == len(keywords)
+    # Três palavras distintas só se juntam com Jaccard >= 0.75, ou seja, o mesmo conjunto
+    assert all(len({keyword_tokens(k) for k in cluster}) == 1 for cluster in clusters)
+
+
+def test_rank_uses_probe_scores_and_picks_a_representative():
+    probes = {
+        "dentista a": ["dentista curitiba", "aparelho dentário"],
+        "dentista b": ["dentistas curitiba", "dentista curitiba"],
+    }
+    ranked = rank_keywords(["aparelho dentário", "dentistas curitiba", "dentista curitiba"], probes)
+    assert ranked == ["dentista curitiba", "aparelho dentário"]
@@ -0,0 +1,59 @@
+import pytest
+
+import app
+from app import KEYWORDS_OUTPUT, LLMCacheMiss, get_cache_mode, request_llm_json
+
+
+class LLMCalls(list):
+    response = '{"keywords": ["dentista curitiba", "implante dentário"]}'
+
+
+@pytest.fixture
+def llm_calls(monkeypatch):
+    calls = LLMCalls()
+
+    def text_stream(task, prompt, timeout=None):
+        calls.append(prompt)
+        yield calls.response
+
+    monkeypatch.setattr(app, "llm_text_stream", text_stream)
+    return calls
+
+
+def ask(prompt: str, cache_mode: str):
+    return request_llm_json("sistema", prompt, 100, 0.5, KEYWORDS_OUTPUT, cache_mode=cache_mode)
+
+
+def test_prefer_answers_from_the_cache_after_the_first_call(llm_calls):
+    first = ask("prefer", "prefer")
+    assert ask("prefer", "prefer") == first
+    assert len(llm_calls) == 1
+
+
+def test_bypass_always_calls_but_refreshes_the_cache(llm_calls):
+    ask("bypass", "bypass")
+    llm_calls.response = '{"keywords": ["dentista 24h"]}'
+    assert ask("bypass", "bypass") == {"keywords": ["dentista 24h"]}
+    assert len(llm_calls) == 2
+    assert ask("bypass", "only") == {"keywords": ["dentista 24h"]}
+    assert len(llm_calls) == 2
+
+
+def test_only_raises_on_miss_without_calling(llm_calls):
+    with pytest.raises(LLMCacheMiss):
+        ask("sem cache", "only")
+    assert llm_calls == []
+
+
+def test_responses_with_dropped_items_are_not_cached(llm_calls):
+    llm_calls.response = '{"keywords": ["dentista curitiba", ""]}'
+    assert ask("incompleta", "prefer") == {"keywords": ["dentista curitiba"]}
+    ask("incompleta", "prefer")
+    assert len(llm_calls) == 2
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, app.LLM_CACHE_DEFAULT_MODE), (" Prefer ", "prefer"), ("only", "only"), ("sempre", None)
+])
+def test_get_cache_mode(value, expected):
+    assert get_cache_mode({"cache": value}) == expected
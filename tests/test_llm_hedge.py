@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+import app
+from app import LatencyTracker, LLMTarget, _hedged_text_stream
+
+
+class FakeStream:
+    def __init__(self, delay: float, text: str):
+        self.delay = delay
+        self.text = text
+
+    def __aiter__(self):
+        return self._events()
+
+    async def _events(self):
+        await asyncio.sleep(self.delay)
+        yield self.text
+
+    async def close(self):
+        pass
+
+
+class FakeProvider:
+    configured = True
+
+    def __init__(self, name: str, delay: float):
+        self.name = name
+        self.delay = delay
+
+    async def aopen(self, model, *prompt, timeout=None, max_retries=None):
+        return FakeStream(self.delay, self.name)
+
+    @staticmethod
+    def read(event, usage):
+        return event
+
+
+def test_only_the_winner_latency_is_recorded(monkeypatch):
+    latency = LatencyTracker(10)
+    monkeypatch.setattr(app, "llm_latency", latency)
+    monkeypatch.setattr(app, "LLM_HEDGE_DELAY", 0.05)
+    monkeypatch.setattr(app, "LLM_HEDGE_MIN_DELAY", 0)
+    slow = LLMTarget(FakeProvider("lento", 0.5), "m")
+    fast = LLMTarget(FakeProvider("rapido", 0.01), "m")
+    prompt = ("sistema", "usuario", 100, 0.5)
+
+    text = "".join(_hedged_text_stream([slow, fast], "teste", prompt))
+
+    assert text == "rapido"
+    time.sleep(0.1)  # o cancelamento do perdedor roda no event loop
+    stats = latency.stats()
+    assert list(stats) == [fast.key]
+    assert stats[fast.key]["samples"] == 1
+    assert stats[fast.key]["p95"] < 0.5
@@ -0,0 +1,112 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app
+from app import FairLLMScheduler, LLMTenant, LLMUsage, TenantTokenLedger, llm_ledger_db
+
+
+def grant_order(scheduler: FairLLMScheduler, requests: list) -> list:
+    """Enfileira `requests` (tenant, lane) com a única vaga ocupada e devolve a ordem em que foram atendidos."""
+    held = scheduler.acquire(LLMTenant("ocupante", "interactive"), 1)
+    order = []
+    threads = []
+    for name, lane in requests:
+        def worker(name=name, lane=lane):
+            ticket = scheduler.acquire(LLMTenant(name, lane), 1, timeout=5)
+            order.append(name)
+            scheduler.release(ticket)
+
+        queued = sum(scheduler.stats()["queued"].values())
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+        while sum(scheduler.stats()["queued"].values()) == queued:
+            time.sleep(0.001)
+    scheduler.release(held)
+    for thread in threads:
+        thread.join(5)
+    return order
+
+
+def test_tenants_alternate_instead_of_first_come_first_served():
+    scheduler = FairLLMScheduler(1, 1.0, {})
+    order = grant_order(scheduler, [("a", "interactive")] * 3 + [("b", "interactive")] * 3)
+    assert order == ["a", "b", "a", "b", "a", "b"]
+
+
+def test_weight_gives_proportional_share():
+    scheduler = FairLLMScheduler(1, 1.0, {"b": 2.0})
+    order = grant_order(scheduler, [("a", "interactive")] * 3 + [("b", "interactive")] * 4)
+    assert order[:6] == ["a", "b", "b", "a", "b", "b"]
+
+
+def test_interactive_lane_goes_before_batch():
+    scheduler = FairLLMScheduler(1, 1.0, {})
+    order = grant_order(scheduler, [("lote", "batch"), ("lote", "batch"), ("usuario", "interactive")])
+    assert order == ["usuario", "lote", "lote"]
+
+
+def test_acquire_times_out_and_gives_up_its_place():
+    scheduler = FairLLMScheduler(1, 1.0, {})
+    held = scheduler.acquire(LLMTenant("a", "interactive"), 1)
+    assert scheduler.acquire(LLMTenant("b", "interactive"), 1, timeout=0.05) is None
+    scheduler.release(held)
+    assert scheduler.stats()["running"]["interactive"] == 0
+
+
+def bucket(tenant: str) -> float:
+    return llm_ledger_db().execute("SELECT tokens FROM llm_budgets WHERE tenant = ?", (tenant,)).fetchone()[0]
+
+
+def test_ledger_release_returns_the_reservation():
+    ledger = TenantTokenLedger(0, {"devolve": 6000})
+    assert ledger.reserve("devolve", 1000, timeout=0) == 0
+    assert bucket("devolve") == pytest.approx(5000, abs=1)
+    ledger.release("devolve", 1000)
+    assert bucket("devolve") == pytest.approx(6000, abs=1)
+
+
+def test_ledger_settle_charges_the_real_usage():
+    ledger = TenantTokenLedger(0, {"acerta": 6000})
+    ledger.reserve("acerta", 1000, timeout=0)
+    ledger.settle(LLMTenant("acerta", "interactive"), 1000, LLMUsage(100, 200))
+    assert bucket("acerta") == pytest.approx(5700, abs=1)
+    assert ledger.summary(1, "acerta")[0]["completion_tokens"] == 200
+
+
+def test_ledger_rejects_when_budget_is_exhausted():
+    ledger = TenantTokenLedger(0, {"esgotado": 600})
+    assert ledger.reserve("esgotado", 600, timeout=0) == 0
+    assert ledger.reserve("esgotado", 300, timeout=0) == pytest.approx(30, abs=1)
+
+
+@pytest.mark.parametrize("usage, expected", [(None, 6000), (LLMUsage(100, 50), 5850)])
+def test_failed_call_refunds_reservation_unless_usage_was_reported(monkeypatch, usage, expected):
+    name = f"falha-{bool(usage)}"
+    monkeypatch.setattr(app, "llm_ledger", TenantTokenLedger(0, {name: 6000}))
+    collector = SimpleNamespace(usage=usage)
+    with app.llm_tenant_scope(LLMTenant(name, "interactive")):
+        with pytest.raises(RuntimeError):
+            with app.llm_call_slot("teste", ("sistema", "usuario", 500, 0.5), collector):
+                raise RuntimeError("provedor caiu")
+    assert bucket(name) == pytest.approx(expected, abs=1)
+
+
+def test_hedge_is_skipped_without_budget_unless_it_may_wait(monkeypatch):
+    ledger = TenantTokenLedger(0, {"hedge": 60000})
+    monkeypatch.setattr(app, "llm_ledger", ledger)
+    prompt = ("s" * 400, "u" * 400, 100, 0.5)
+
+    async def hedge():
+        async with app.llm_hedge_slot_async("teste", prompt):
+            return True
+
+    with app.llm_tenant_scope(LLMTenant("hedge", "interactive")):
+        ledger.reserve("hedge", 60000, timeout=0)
+        with pytest.raises(app.LLMBudgetExceeded):
+            app.run_async(hedge())
+        monkeypatch.setattr(app, "LLM_HEDGE_BUDGET_WAIT", 5)
+        assert app.run_async(hedge())
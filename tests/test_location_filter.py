@@ -0,0 +1,86 @@
+import pytest
+
+from app import TokenAutomaton, app, filter_keywords_by_location, get_gazetteer
+
+
+def test_keeps_ambiguous_words_and_own_city():
+    kept, dropped = filter_keywords_by_location(
+        ["clinica sorriso curitiba", "dentista sorriso perfeito", "dentista boa vista", "dentista londrina"],
+        "Curitiba", "dentista implante")
+    assert kept == ["clinica sorriso curitiba", "dentista sorriso perfeito", "dentista boa vista"]
+    assert dropped == ["dentista londrina"]
+
+
+def test_ambiguous_name_with_place_marker_counts_as_place():
+    _, dropped = filter_keywords_by_location(["dentista em boa vista", "dentista boa vista rr"], "Curitiba")
+    assert dropped == ["dentista em boa vista", "dentista boa vista rr"]
+
+
+def test_own_city_wins_over_other_places():
+    kept, _ = filter_keywords_by_location(["implante curitiba perto de londrina"], "Curitiba")
+    assert kept == ["implante curitiba perto de londrina"]
+
+
+def test_city_client_does_not_get_whole_state():
+    kept, dropped = filter_keywords_by_location(
+        ["dentista campinas", "dentista santos", "dentista em guarulhos", "dentista sp", "dentista sao paulo",
+         "dentista zona sul"], "São Paulo")
+    assert kept == ["dentista sp", "dentista sao paulo", "dentista zona sul"]
+    assert dropped == ["dentista campinas", "dentista santos", "dentista em guarulhos"]
+
+
+def test_state_client_allows_cities_of_the_state():
+    kept, dropped = filter_keywords_by_location(["dentista londrina", "dentista curitiba", "dentista sp"], "Paraná")
+    assert kept == ["dentista londrina", "dentista curitiba"]
+    assert dropped == ["dentista sp"]
+
+    kept, dropped = filter_keywords_by_location(["dentista campinas", "dentista curitiba"], "SP")
+    assert kept == ["dentista campinas"]
+    assert dropped == ["dentista curitiba"]
+
+
+def test_city_and_state_with_same_name_are_separate_entries():
+    place = get_gazetteer().places["sao paulo"]
+    assert place == {"cities": {"SP"}, "states": {"SP"}}
+
+
+def test_unknown_location_keeps_everything():
+    keywords = ["dentista londrina", "dentista santos"]
+    assert filter_keywords_by_location(keywords, "Zona Sul") == (keywords, [])
+
+
+def automaton(*patterns: str) -> TokenAutomaton:
+    result = TokenAutomaton()
+    for pattern in patterns:
+        result.add(tuple(pattern.split()))
+    result.build()
+    return result
+
+
+def test_automaton_prefers_longest_match():
+    tokens = "dentista sao jose dos campos centro".split()
+    assert automaton("sao jose", "sao jose dos campos", "campos").find(tokens) == [(1, 5)]
+
+
+def test_automaton_keeps_non_overlapping_matches():
+    tokens = "rio de janeiro e sao paulo".split()
+    assert automaton("rio de janeiro", "janeiro", "sao paulo", "paulo").find(tokens) == [(0, 3), (4, 6)]
+
+
+def test_automaton_overlap_of_equal_length_keeps_the_first():
+    tokens = "campo grande bahia".split()
+    assert automaton("campo grande", "grande bahia").find(tokens) == [(0, 2)]
+
+
+def test_automaton_follows_failure_links():
+    tokens = "sao sao paulo".split()
+    assert automaton("sao paulo").find(tokens) == [(1, 3)]
+
+
+@pytest.mark.parametrize("keywords, status", [(None, 200), ([1, None, "dentista londrina"], 200), ("dentista", 400)])
+def test_generate_assets_validates_keywords(keywords, status):
+    response = app.test_client().post("/generate_assets", json={
+        "oferta": "Implante", "localizacao": "Curitiba", "ramo": "dentista", "keywords": keywords, "draft": True
+    })
+    assert response.status_code == status
+    assert response.get_json()["success"] is (status == 200)
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+import app
+from app import SharedSweeps
+
+
+def fake_scrape(calls: list, started: threading.Event):
+    def scrape(ramo, localizacao="", on_batch=None, cancel_event=None, probe_results=None):
+        calls.append(cancel_event)
+        started.set()
+        keywords = []
+        for letter in "abc":
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            time.sleep(0.05)
+            keywords.append(f"{ramo} {letter}")
+            probe_results[f"{ramo} {letter}"] = [f"{ramo} {letter}"]
+            if on_batch:
+                on_batch(f"{ramo} {letter}", [f"{ramo} {letter}"])
+        return keywords
+    return scrape
+
+
+def test_owner_streams_and_follower_gets_replayed_probes(monkeypatch):
+    calls, started = [], threading.Event()
+    monkeypatch.setattr(app, "scrape_keywords", fake_scrape(calls, started))
+    sweeps = SharedSweeps()
+    owner_batches, follower_batches, results = [], [], {}
+
+    owner = threading.Thread(target=lambda: results.update(
+        owner=sweeps("dentista", on_batch=lambda q, s: owner_batches.append(q))))
+    owner.start()
+    started.wait(1)
+    results["follower"] = sweeps("dentista", on_batch=lambda q, s: follower_batches.append(q))
+    owner.join(1)
+
+    assert len(calls) == 1
+    assert results["owner"] == results["follower"] == ["dentista a", "dentista b", "dentista c"]
+    assert owner_batches == follower_batches == ["dentista a", "dentista b", "dentista c"]
+
+
+def test_failed_sweep_is_raised_to_everyone(monkeypatch):
+    def failing_scrape(ramo, localizacao="", on_batch=None, cancel_event=None, probe_results=None):
+        raise RuntimeError("falhou")
+
+    monkeypatch.setattr(app, "scrape_keywords", failing_scrape)
+    sweeps = SharedSweeps()
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            sweeps("dentista")
+
+
+def test_cancelled_owner_stops_and_follower_sweeps_again(monkeypatch):
+    calls, started = [], threading.Event()
+    monkeypatch.setattr(app, "scrape_keywords", fake_scrape(calls, started))
+    sweeps = SharedSweeps()
+    cancel = threading.Event()
+    results = {}
+
+    owner = threading.Thread(target=lambda: results.update(owner=sweeps("dentista", cancel_event=cancel)))
+    owner.start()
+    started.wait(1)
+    cancel.set()
+    results["follower"] = sweeps("dentista")
+    owner.join(1)
+
+    assert len(calls) == 2
+    assert len(results["owner"]) < 3
+    assert results["follower"] == ["dentista a", "dentista b", "dentista c"]
+
+
+def test_cancelled_follower_stops_waiting(monkeypatch):
+    calls, started = [], threading.Event()
+    monkeypatch.setattr(app, "scrape_keywords", fake_scrape(calls, started))
+    sweeps = SharedSweeps()
+    owner = threading.Thread(target=lambda: sweeps("dentista"))
+    owner.start()
+    started.wait(1)
+    cancel = threading.Event()
+    cancel.set()
+    assert sweeps("dentista", cancel_event=cancel) == []
+    owner.join(1)
+    assert len(calls) == 1
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+import app
+from app import SingleFlight
+
+
+def test_async_lease_poll_runs_off_the_event_loop(monkeypatch):
+    monkeypatch.setattr(app, "SINGLEFLIGHT_CROSS_PROCESS", True)
+    monkeypatch.setattr(app, "SINGLEFLIGHT_POLL_INTERVAL", 0.01)
+    flights = SingleFlight("teste_async", lease_ttl=5)
+    assert flights._try_lease("chave", "outro-worker")
+    poll_threads = []
+    real_poll = flights._poll_lease
+
+    def poll(*args):
+        poll_threads.append(threading.get_ident())
+        if len(poll_threads) == 3:
+            # O líder do outro worker grava o resultado (o lease só sai depois)
+            conn = flights._db()
+            conn.execute("INSERT INTO flight_results (name, key, value, finished_at) VALUES (?, ?, ?, ?)",
+                         ("teste_async", "chave", '["resultado"]', time.time()))
+            conn.commit()
+        return real_poll(*args)
+
+    monkeypatch.setattr(flights, "_poll_lease", poll)
+
+    async def follow():
+        return threading.get_ident(), await flights.begin_async("chave", timeout=2)
+
+    loop_thread, flight = app.run_async(follow())
+    assert not flight.leader
+    assert flight.result == ["resultado"]
+    assert loop_thread not in poll_threads
+
+
+@pytest.fixture
+def cross_process(monkeypatch):
+    monkeypatch.setattr(app, "SINGLEFLIGHT_CROSS_PROCESS", True)
+    monkeypatch.setattr(app, "SINGLEFLIGHT_POLL_INTERVAL", 0.01)
+
+
+def begin_in_thread(flights: SingleFlight, key: str, timeout: float | None = None) -> tuple:
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(flight=flights.begin(key, timeout=timeout)))
+    thread.start()
+    return thread, result
+
+
+def test_follower_in_another_worker_gets_the_leader_result(cross_process, request):
+    # Duas instâncias com o mesmo nome fazem o papel de dois workers (só o SQLite é compartilhado)
+    worker_a, worker_b = SingleFlight(request.node.name, 5), SingleFlight(request.node.name, 5)
+    leader = worker_a.begin("chave")
+    assert leader.leader
+    thread, result = begin_in_thread(worker_b, "chave")
+    time.sleep(0.05)
+    leader.finish(["resultado"])
+    thread.join(2)
+    assert not result["flight"].leader
+    assert result["flight"].result == ["resultado"]
+
+
+def test_follower_takes_over_when_the_leader_abandons(cross_process, request):
+    worker_a, worker_b = SingleFlight(request.node.name, 5), SingleFlight(request.node.name, 5)
+    leader = worker_a.begin("chave")
+    thread, result = begin_in_thread(worker_b, "chave")
+    time.sleep(0.05)
+    leader.abandon()
+    thread.join(2)
+    assert result["flight"].leader
+    result["flight"].abandon()
+
+
+def test_expired_lease_of_a_dead_leader_is_taken_over(cross_process, request):
+    worker_a, worker_b = SingleFlight(request.node.name, 0.1), SingleFlight(request.node.name, 0.1)
+    assert worker_a.begin("chave").leader  # o líder "morre" sem liberar o lease
+    started = time.monotonic()
+    flight = worker_b.begin("chave")
+    assert flight.leader
+    assert time.monotonic() - started < 1
+    flight.abandon()
+
+
+def test_followers_in_the_same_worker_share_the_future(cross_process, request):
+    flights = SingleFlight(request.node.name, 5)
+    leader = flights.begin("chave")
+    thread, result = begin_in_thread(flights, "chave")
+    time.sleep(0.05)
+    leader.finish({"ok": True})
+    thread.join(2)
+    assert result["flight"].result == {"ok": True}
+
+
+def test_local_follower_times_out(cross_process, request):
+    flights = SingleFlight(request.node.name, 5)
+    leader = flights.begin("chave")
+    with pytest.raises(app.DeadlineExceeded):
+        flights.begin("chave", timeout=0.05)
+    leader.abandon()
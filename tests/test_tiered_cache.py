@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from app import TieredCache
+
+
+@pytest.fixture
+def cache(request):
+    return TieredCache(f"cache_{request.node.name}", ttl=60, negative_ttl=0.05, max_memory_items=2)
+
+
+def test_memory_hit_then_disk_hit_after_lru_eviction(cache):
+    cache.set("a", ["dentista"])
+    assert cache.get("a") == (True, ["dentista"])
+    cache.set("b", [])
+    cache.set("c", [])
+    assert cache.get("a") == (True, ["dentista"])
+    stats = cache.stats()
+    assert stats["memory_hits"] == 1
+    assert stats["disk_hits"] == 1
+    # "a" saiu da memória ao gravar "c" e, lido do disco, volta empurrando "b"
+    assert stats["evictions"] == 2
+
+
+def test_negative_entries_use_the_short_ttl(cache):
+    cache.set("positivo", ["dentista"])
+    cache.set("vazio", [], negative=True)
+    assert cache.get("vazio") == (True, [])
+    time.sleep(0.06)
+    assert cache.get("vazio") == (False, None)
+    assert cache.get("positivo") == (True, ["dentista"])
+    assert cache.stats()["negative_hits"] == 1
+
+
+def test_expired_entries_are_misses_on_both_tiers(cache):
+    cache.set("curto", ["x"], ttl=0.05)
+    time.sleep(0.06)
+    assert cache.get("curto") == (False, None)
+    cache._memory.clear()
+    assert cache.get("curto") == (False, None)
+    assert cache.stats()["misses"] == 2
@@ -0,0 +1,142 @@
+"""
+Warm-up do Corpus de Keywords - Gerador de Anúncios
+Pré-varre os nichos x cidades mais comuns e renova as entradas do corpus antes
+de ficarem velhas, para que /hunt_keywords e /full_pipeline quase nunca
+precisem varrer o autocomplete durante a requisição.
+
+O corpus fica no SQLite de CACHE_DIR: rode na mesma máquina/disco do app.
+
+Uso:
+    python warmup.py                          # uma rodada (data/warmup.json + entradas populares)
+    python warmup.py --loop                   # repete a cada WARMUP_INTERVAL segundos
+    python warmup.py --ramos "dentista,advogado" --cidades "Curitiba,Recife"
+    python warmup.py --dry-run                # só mostra o que seria varrido
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from app import (CORPUS_ENABLED, CORPUS_FRESH_TTL, keyword_corpus, metrics, refresh_keyword_corpus,
+                 scraper_breaker, sweep_key)
+
+# WARMUP_CONFIG: JSON com {"ramos": [...], "cidades": [...], "nacional": true}
+# WARMUP_INTERVAL: segundos entre as rodadas no modo --loop
+# WARMUP_REFRESH_AHEAD: fração de CORPUS_FRESH_TTL a partir da qual a entrada é renovada
+# WARMUP_MAX_PER_CYCLE: máximo de varreduras por rodada (protege a cota do autocomplete)
+WARMUP_CONFIG = os.getenv("WARMUP_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        "data", "warmup.json"))
+WARMUP_INTERVAL = float(os.getenv("WARMUP_INTERVAL", "3600"))
+WARMUP_REFRESH_AHEAD = float(os.getenv("WARMUP_REFRESH_AHEAD", "0.8"))
+WARMUP_MAX_PER_CYCLE = int(os.getenv("WARMUP_MAX_PER_CYCLE", "100"))
+
+
+def load_pairs(config_path: str | None, ramos: list | None = None, cidades: list | None = None,
+               nacional: bool | None = None) -> list:
+    """Pares (ramo, localização) configurados: ramos x cidades (+ cada ramo sem cidade)."""
+    config = {}
+    if config_path and os.path.exists(config_path):
+        with open(config_path, encoding="utf-8") as f:
+            config = json.load(f)
+
+    ramos = ramos or config.get("ramos", [])
+    cidades = cidades or config.get("cidades", [])
+    nacional = config.get("nacional", True) if nacional is None else nacional
+
+    pairs = [(ramo, cidade) for ramo in ramos for cidade in cidades]
+    # O estágio "scraper_nacional" da cascata varre o ramo sem localização
+    if nacional:
+        pairs.extend((ramo, "") for ramo in ramos)
+    return pairs
+
+
+def plan_cycle(pairs: list, refresh_after: float, limit: int, force: bool = False) -> list:
+    """Lista (ramo, localização, motivo) a varrer nesta rodada.
+
+    Motivos: "novo" (fora do corpus), "renovar" (configurado e perto de vencer)
+    e "popular" (veio do tráfego real e está perto de vencer).
+    """
+    planned = {}
+    for ramo, localizacao in pairs:
+        entry = keyword_corpus.peek(ramo, localizacao)
+        if force or entry is None:
+            planned.setdefault(sweep_key(ramo, localizacao), (ramo, localizacao, "novo"))
+        elif entry["age"] > refresh_after:
+            planned.setdefault(sweep_key(ramo, localizacao), (ramo, localizacao, "renovar"))
+
+    for ramo, localizacao in keyword_corpus.due_for_refresh(refresh_after, limit):
+        planned.setdefault(sweep_key(ramo, localizacao), (ramo, localizacao, "popular"))
+
+    return list(planned.values())[:limit]
+
+
+def run_cycle(pairs: list, refresh_after: float, limit: int, force: bool = False, dry_run: bool = False) -> dict:
+    """Executa uma rodada de warm-up e retorna o resumo."""
+    plan = plan_cycle(pairs, refresh_after, limit, force)
+    summary = {"planned": len(plan), "scraped": 0, "empty": 0, "keywords": 0}
+    print(f"[Warmup] {len(plan)} varreduras planejadas ({len(pairs)} pares configurados)")
+
+    for index, (ramo, localizacao, reason) in enumerate(plan, 1):
+        label = f"'{ramo}' em '{localizacao or 'Brasil'}'"
+        if dry_run:
+            print(f"[Warmup] {index}/{len(plan)} {label} ({reason})")
+            continue
+        if scraper_breaker.is_open():
+            print("[Warmup] Circuit breaker aberto: rodada interrompida")
+            break
+
+        started = time.monotonic()
+        keywords = refresh_keyword_corpus(ramo, localizacao)
+        summary["scraped"] += 1
+        summary["keywords"] += len(keywords)
+        if not keywords:
+            summary["empty"] += 1
+        print(f"[Warmup] {index}/{len(plan)} {label} ({reason}): {len(keywords)} keywords "
+              f"em {time.monotonic() - started:.1f}s")
+
+    metrics.flush()
+    print(f"[Warmup] Rodada concluída: {summary} | corpus: {keyword_corpus.stats()}")
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Warm-up do corpus de keywords do Gerador de Anúncios")
+    parser.add_argument("--config", default=WARMUP_CONFIG, help="JSON com ramos, cidades e nacional")
+    parser.add_argument("--ramos", help="Ramos separados por vírgula (substitui os do JSON)")
+    parser.add_argument("--cidades", help="Cidades separadas por vírgula (substitui as do JSON)")
+    parser.add_argument("--sem-nacional", action="store_true", help="Não varre os ramos sem localização")
+    parser.add_argument("--loop", action="store_true", help="Repete as rodadas a cada --interval segundos")
+    parser.add_argument("--interval", type=float, default=WARMUP_INTERVAL, help="Segundos entre as rodadas")
+    parser.add_argument("--max-per-cycle", type=int, default=WARMUP_MAX_PER_CYCLE,
+                        help="Máximo de varreduras por rodada")
+    parser.add_argument("--force", action="store_true", help="Varre todos os pares configurados, mesmo frescos")
+    parser.add_argument("--dry-run", action="store_true", help="Só mostra o que seria varrido")
+    args = parser.parse_args(argv)
+
+    args.ramos = [item.strip() for item in args.ramos.split(",") if item.strip()] if args.ramos else None
+    args.cidades = [item.strip() for item in args.cidades.split(",") if item.strip()] if args.cidades else None
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not CORPUS_ENABLED:
+        print("[Warmup] CORPUS_ENABLED=false: o app não lê o corpus, nada a fazer")
+        sys.exit(0)
+
+    pairs = load_pairs(args.config, args.ramos, args.cidades, False if args.sem_nacional else None)
+    refresh_after = CORPUS_FRESH_TTL * WARMUP_REFRESH_AHEAD
+
+    while True:
+        try:
+            run_cycle(pairs, refresh_after, args.max_per_cycle, force=args.force, dry_run=args.dry_run)
+            if not args.loop:
+                break
+            # --force vale só para a primeira rodada
+            args.force = False
+            time.sleep(args.interval)
+        except KeyboardInterrupt:
+            print("\n[Warmup] Interrompido")
+            break